@@ -3,27 +3,48 @@ from pyrogram.types import Message, CallbackQuery
 import os
 import sys
 import asyncio
+import contextlib
 import re
 from .database.db_manager import Database
-from .utils.downloader import get_video_formats, download_video
-from .utils.compressor import compress_video
-from .utils.helpers import Helper, create_format_buttons, clean_files, get_video_duration, take_screenshot
-from config import API_ID, API_HASH, BOT_TOKEN, DUMP_CHANNEL, DOWNLOADS_DIR, AUTH_USERS
+from .utils.downloader import get_video_formats, get_audio_formats, download_video, expand_urls
+from .utils.compressor import (
+    compress_video, compress_stream, compress_ladder, estimate_compression, format_estimate,
+    extract_duration_from_ffmpeg, prepare_audio, audio_output_ext
+)
+from .utils.helpers import (
+    Helper, create_format_buttons, create_audio_format_buttons, clean_files, get_video_duration, take_screenshot
+)
+from config import (
+    API_ID, API_HASH, BOT_TOKEN, DUMP_CHANNEL, AUTH_USERS, STATS_WINDOW_DAYS,
+    BATCH_MAX_ITEMS, BATCH_DEFAULT_HEIGHT, ADD_BATCH_MAX_FILES, LADDER_RUNGS,
+    PREFLIGHT_ENABLED, PREFLIGHT_MIN_DURATION, PREFLIGHT_SAMPLES, PREFLIGHT_SAMPLE_SECONDS, PREFLIGHT_TIMEOUT,
+    PROGRESSIVE_UPLOAD
+)
 import logging
-from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaVideo
 import time
-from .utils.l_download import HTTPDownloader
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+from .utils.l_download import HTTPDownloader, is_pipe_friendly
+from .utils.bandwidth import BandwidthManager
+from .utils.tg_transfer import ParallelDownloader, ParallelUploader
+from .utils.access import AccessControl, QuotaExceeded
+from .utils.tracing import JobTrace, summarize
+from .utils.workspace import Workspace, purge_workspaces, partial_path
+from .utils.upload_pool import UploadPool
+from .utils.trim import TrimError, parse_ranges, probe_media, smart_trim, format_timestamp
+from .utils.tg_calls import ScheduledClient, scheduler, background
+from .utils.startup import profiler
+from .utils.watchdog import watchdog
+from .utils.sessions import Session, SessionStore
+from .utils.prefetch import Prefetcher, input_stem
+from .utils.singleflight import SingleFlight
+from .utils.calibration import CalibrationError, PresetTuner, run_calibration
+from .utils.batch import BatchItem, BatchRunner, parse_batch_args, is_playlist_url, policy_format
 
 
-ENCODE_DIR = os.path.join(DOWNLOADS_DIR, "Encode")
-os.makedirs(ENCODE_DIR, exist_ok=True)
-
 class Bot:
     def __init__(self):
         logging.info("Initializing bot...")
-        self.app = Client(
+        self.app = ScheduledClient(
             "video_bot",
             api_id=API_ID,
             api_hash=API_HASH,
@@ -31,16 +52,31 @@ class Bot:
         )
         self.db = Database()
         self.tasks = []
-        self.video_urls = {}
+        self.sessions = SessionStore()
+        self.confirmations = {}
         self.helper = Helper()  # Initialize the Helper class
+        self.access = AccessControl(self.db)
         self.setup_handlers()
         self.download_tasks = {}
         self.current_processes = []
         self.http_downloader = HTTPDownloader() 
+        self.bandwidth = BandwidthManager()
+        self.prefetcher = Prefetcher(self.db, self.bandwidth)
+        self.downloads = SingleFlight("download")
+        self.encodes = SingleFlight("encode")
+        self.tuner = PresetTuner(self.db)
+        self.uploader = ParallelUploader(self.app)
+        self.tg_downloader = ParallelDownloader(self.app)
+        self.upload_pool = UploadPool.from_tokens()
 
     def setup_handlers(self):
         logging.info("Setting up handlers...")
 
+        @self.app.on_raw_update(group=-1)
+        async def startup_probe(_, update, users, chats):
+            # Group -1 runs before the command handlers on every update, so this must stay trivial
+            profiler.first_update()
+
         @self.app.on_message(filters.command("start"))
         async def start_command(_, message: Message):
             logging.info("Received /start command")
@@ -49,12 +85,22 @@ class Bot:
                 "Commands:\n"
                 "/yl <url> - Download YouTube video\n"
                 "/l <url> - Download Direct files\n"
+                "/lc <url> [-n name] - Download Direct files and Compress them while downloading\n"
                 "/ylc <url> - Download YouTube video and Compress them\n"
-                "/set <ffmpeg_code> - Set custom FFmpeg code\n"
+                "/ya <url> - Download only the audio of a YouTube video\n"
+                "/yl or /ylc [-q 720] <playlist or several urls> - Batch download\n"
+                "/set <ffmpeg_code> - Set custom FFmpeg code; -preset auto[:speed=2|:ssim=0.97] uses calibration\n"
                 "/add - Reply to video/document to compress\n"
-                "/cancel - Cancel ongoing tasks\n"   
+                "/add [count] - Reply to an album or the first of count files to compress them all\n"
+                "/ladder [1080 720 480] - Reply to a video to encode several sizes in one pass\n"
+                "/trim 1:00-3:00 [...] - Reply to a video to cut ranges into one video without a full encode\n"
+                "/clip 1:00-3:00 [...] - Like /trim, but one video per range\n"
+                "/cancel - Cancel ongoing tasks\n"
+                "/auth or /unauth <id> - (owner) Manage authorized users and groups\n"
+                "/stats - (owner) Stage timings and slowest recent jobs\n"
+                "/calibrate [encoders|show] - (owner) Measure encoder presets on this host\n"
             )
-        @self.app.on_message(filters.command("l"))
+        @self.app.on_message(filters.command("l") & self.access.filter)
         async def download_and_upload(client: Client, message: Message):
             url = message.text.split(" ", 1)[1]
             output_name = None
@@ -66,28 +112,42 @@ class Bot:
                 output_name = parts[1].strip()
 
             status_msg = await message.reply_text("🚀 Starting download...")
+            user_id = message.from_user.id
+            ticket = None
+            workspace = None
+            trace = JobTrace("l", user_id)
 
             try:
+                size = await self.http_downloader.content_length(url)
+                ticket = await self.admit_job(status_msg, user_id, size)
+                if ticket is None:
+                    return
+                workspace = Workspace(trace.job_id, size)
+
                 # Download the file
-                file_path = await self.http_downloader.download_file(url, output_name, status_msg)
+                async with trace.stage("download") as span, self.bandwidth.flow("down", user_id) as down_flow:
+                    file_path = await self.http_downloader.download_file(
+                        url, output_name, status_msg, flow=down_flow, download_dir=workspace.path
+                    )
+                    span.bytes = os.path.getsize(file_path) if file_path else None
 
                 if file_path and os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+                    await ticket.charge(os.path.getsize(file_path))
                     # Upload the file as a document
                     try:
-                        upload_msg = await client.send_document(
-                            chat_id=message.chat.id,
-                            document=file_path,
-                            caption=f"Downloaded {output_name or os.path.basename(file_path)}",
-                            progress=self.helper.progress_for_pyrogram,
-                            progress_args=(status_msg, time.time(), "Uploading to user")
-                        )
+                        async with trace.stage("upload", os.path.getsize(file_path)), \
+                                self.bandwidth.flow("up", user_id) as up_flow:
+                            upload_msg = await self.send_document(
+                                chat_id=message.chat.id,
+                                document=file_path,
+                                caption=f"Downloaded {output_name or os.path.basename(file_path)}",
+                                progress=self.helper.progress_for_pyrogram,
+                                progress_args=(status_msg, time.time(), "Uploading to user", up_flow)
+                            )
 
                         # Forward the uploaded file to the dump channel
-                        await client.forward_messages(
-                            chat_id=DUMP_CHANNEL,
-                            from_chat_id=message.chat.id,
-                            message_ids=upload_msg.id
-                        )
+                        async with trace.stage("dump_forward"):
+                            await self.dump_upload(upload_msg)
 
                         await status_msg.edit_text("✅ Download and upload complete!")
                     except Exception as e:
@@ -100,11 +160,106 @@ class Bot:
                 logging.error(f"Error during download/upload process: {e}")
                 await status_msg.edit_text("❌ An error occurred during the process.")
             finally:
-                # Clean up by removing the downloaded file if it exists
-                if file_path and os.path.exists(file_path):
-                    os.remove(file_path)
+                if ticket:
+                    ticket.release()
+                await self.save_trace(trace)
+                # Clean up the job's workspace, downloaded file included
+                if workspace:
+                    workspace.cleanup()
                     
-        @self.app.on_message(filters.command("restart"))
+        @self.app.on_message(filters.command("lc") & self.access.filter)
+        async def download_compress_and_upload(client: Client, message: Message):
+            if len(message.command) < 2:
+                await message.reply_text("Please provide a URL")
+                return
+            url = message.text.split(" ", 1)[1]
+            output_name = None
+            if "-n" in url:
+                parts = url.split("-n", 1)
+                url = parts[0].strip()
+                output_name = parts[1].strip()
+
+            user_id = message.from_user.id
+            status_msg = await message.reply_text("🚀 Probing source...")
+            title = output_name or url.split('/')[-1].split('?')[0]
+            sanitized_title = re.sub(r'[^\w\-_\.]', '_', os.path.splitext(title)[0]).strip()
+            ticket = None
+            workspace = None
+            input_path = None
+            trace = JobTrace("lc", user_id)
+
+            try:
+                ffmpeg_code = await self.ffmpeg_code_for(user_id)
+                async with trace.stage("probe"):
+                    total_size, ranges, head = await self.http_downloader.probe(url)
+                ticket = await self.admit_job(status_msg, user_id, total_size)
+                if ticket is None:
+                    return
+                workspace = Workspace(trace.job_id, total_size)
+                output_path = workspace.file(f"{sanitized_title}_Smashed.mp4")
+
+                async with self.bandwidth.flow("down", user_id) as down_flow:
+                    if is_pipe_friendly(head):
+                        # Encode while downloading; the original never lands on disk
+                        async with trace.stage("probe"):
+                            duration = await asyncio.to_thread(extract_duration_from_ffmpeg, url)
+                        encode = compress_stream(
+                            lambda sink: self.http_downloader.stream_file(
+                                url, sink, flow=down_flow, total_size=total_size if ranges else 0
+                            ),
+                            output_path, ffmpeg_code, status_msg, self, duration, total_size
+                        )
+                        stage = "stream_encode"
+                    else:
+                        await status_msg.edit_text("⚠️ Index is at the end of this file, downloading it first...")
+                        async with trace.stage("download", total_size):
+                            input_path = await self.http_downloader.download_file(
+                                url, title, status_msg, flow=down_flow, download_dir=workspace.path
+                            )
+                        if not input_path or not os.path.exists(input_path) or os.path.getsize(input_path) == 0:
+                            logging.error("Download failed or file is empty.")
+                            await status_msg.edit_text("❌ Download failed or file is empty.")
+                            return
+                        encode = compress_video(input_path, output_path, ffmpeg_code, status_msg, self)
+                        stage = "encode"
+                    # The task is created inside the stage so the encoder's fps lands on its span
+                    async with trace.stage(stage, total_size):
+                        compress_task = asyncio.create_task(encode)
+                        self.tasks.append(compress_task)
+                        success = await compress_task
+                await ticket.charge(os.path.getsize(input_path) if input_path else total_size)
+
+                if success and os.path.exists(output_path):
+                    duration = await get_video_duration(output_path)
+                    thumb_image_path = await take_screenshot(output_path, f"{output_path}.jpg")
+                    async with trace.stage("upload", os.path.getsize(output_path)), \
+                            self.bandwidth.flow("up", user_id) as up_flow:
+                        upload_msg = await self.send_video(
+                            message.chat.id,
+                            output_path,
+                            caption=f"📹 {sanitized_title} (Smashed)\n⏱️ Duration: {duration} seconds",
+                            duration=duration,
+                            thumb=thumb_image_path,
+                            reply_to_message_id=message.id,
+                            progress=self.helper.progress_for_pyrogram,
+                            progress_args=(status_msg, time.time(), "📤 Uploading compressed video", up_flow)
+                        )
+                    async with trace.stage("dump_forward"):
+                        await self.dump_upload(upload_msg)
+                    await status_msg.delete()
+            except asyncio.CancelledError:
+                await status_msg.edit_text("Task cancelled!")
+            except Exception as e:
+                logging.error(f"Error in download_compress_and_upload: {e}")
+                await status_msg.edit_text(f"Error: {str(e)}")
+            finally:
+                if ticket:
+                    ticket.release()
+                await self.save_trace(trace)
+                if workspace:
+                    workspace.cleanup()
+
+        @self.app.on_message(filters.command("restart") & self.access.filter)
         async def restart_bot(_, message: Message):
             logging.info("Received /restart command")
             if self.is_restarting:
@@ -127,102 +282,149 @@ class Bot:
             finally:
                 self.is_restarting = False
 
-        @self.app.on_message(filters.command("ylc"))
+        @self.app.on_message(filters.command("ylc") & self.access.filter)
         async def youtube_compressed_command(_, message: Message):
             logging.info("Received /ylc command")
             if len(message.command) < 2:
                 await message.reply_text("Please provide a YouTube URL")
                 return
 
+            urls, max_height = parse_batch_args(message.text.split(None, 1)[1])
+            if len(urls) > 1 or max_height is not None or is_playlist_url(urls[0]):
+                await self.run_batch(message, urls, max_height, compress=True)
+                return
+
             status_msg = await message.reply_text("Fetching video information...")
             try:
-                url = message.text.split(None, 1)[1]
+                url = urls[0]
+                extract_started = time.time()
                 formats, title = await get_video_formats(url)
-                keyboard = create_format_buttons(formats, prefix="dlc_")
+                request_id = self.sessions.new_request_id()
+                keyboard = create_format_buttons(formats, prefix=f"dlc_{request_id}_")
 
+                session = Session(
+                    request_id, message.from_user.id, url, formats=formats, title=title,
+                    extract_time=(extract_started, time.time())
+                )
+                self.sessions.put(status_msg.chat.id, status_msg.id, session)
                 await status_msg.edit_text(
                     f"Select format for: {title}",
                     reply_markup=keyboard
                 )
-                user_id = message.from_user.id
-                self.video_urls[user_id] = url
+                await self.prefetcher.start(session)
             except Exception as e:
                 await status_msg.edit_text(f"Error: {str(e)}")
                 logging.error(f"Error in youtube_compressed_command: {e}")
 
-        @self.app.on_callback_query(filters.regex(r"^dlc_"))
+        @self.app.on_callback_query(filters.regex(r"^dlc_") & self.access.filter)
         async def download_compressed_callback(_, callback_query: CallbackQuery):
-            format_id = callback_query.data.split("_")[1]
             user_id = callback_query.from_user.id
-            url = self.video_urls.get(user_id)
-
-            if not url:
-                await callback_query.answer("Session expired. Please try again.", show_alert=True)
+            session, format_id = await self.resolve_session(callback_query, "dlc_")
+            if session is None:
                 return
+            url = session.url
 
             await callback_query.answer("Processing...")
             status_msg = await callback_query.message.reply_text("Starting download process...")
 
-            input_path = None
-            output_path = None
             start_time = time.time()
+            ticket = None
+            workspace = None
+            # Shared download/encode flights this job holds until it is done with their files
+            flights = contextlib.AsyncExitStack()
+            trace = JobTrace("ylc", user_id)
+            if "extract_time" in session.extra:
+                trace.add("extract", *session.extra["extract_time"])
 
             try:
-                formats, title = await get_video_formats(url)
-                sanitized_title = re.sub(r'[^\w\-_\.]', '_', title).strip()
-                input_path = os.path.join(DOWNLOADS_DIR, f"{sanitized_title}.mp4")
-                output_path = os.path.join(ENCODE_DIR, f"{sanitized_title}_Compressed.mp4")
+                ticket = await self.admit_job(status_msg, user_id, session.filesize(format_id))
+                if ticket is None:
+                    return
+                # A prefetch for this keyboard already holds the parts yt-dlp would fetch first
+                prefetched = await self.prefetcher.claim(session, format_id)
+                await self.prefetcher.record_pick(session, format_id)
+                workspace = Workspace(trace.job_id)
+                sanitized_title = input_stem(session.title)
 
-                # Create and store the download task
-                download_task = asyncio.create_task(
-                    download_video(url, format_id, input_path, status_msg)
-                )
-                self.download_tasks[user_id] = download_task
-                success = await download_task
+                # Identical requests from other users share this download and its progress
+                async with trace.stage("download") as span:
+                    download = await self.join_download(
+                        flights, session, format_id, f"{sanitized_title}.mp4", status_msg, user_id,
+                        workspace=prefetched
+                    )
+                    input_path = download.result
+                    span.bytes = os.path.getsize(input_path) if input_path else None
 
-                if success and os.path.exists(input_path):
-                    duration = await get_video_duration(input_path)
-                    thumb_image_path = await take_screenshot(input_path)
+                if input_path:
+                    await ticket.charge(os.path.getsize(input_path))
+                    async with trace.stage("probe"):
+                        duration = await get_video_duration(input_path)
+                        thumb_image_path = await take_screenshot(input_path, workspace.file("thumb.jpg"))
 
                     await status_msg.edit_text("✅ Download complete! Preparing to upload...")
 
-                    await self.app.send_video(
-                        DUMP_CHANNEL,
-                        input_path,
-                        progress=self.helper.progress_for_pyrogram,
-                        duration=duration,
-                        caption=f"{sanitized_title}\nDuration: {duration} seconds",
-                        thumb=thumb_image_path,
-                        width=1280,
-                        height=720,
-                        progress_args=(status_msg, start_time, "📤 Uploading to dump channel")
-                    )
+                    async with trace.stage("dump_upload", os.path.getsize(input_path)), \
+                            self.bandwidth.flow("up", user_id) as up_flow:
+                        # One copy in the dump channel per download, whoever asked for it
+                        await download.deliver("dump", lambda: self.send_video(
+                            DUMP_CHANNEL,
+                            input_path,
+                            progress=self.helper.progress_for_pyrogram,
+                            duration=duration,
+                            caption=f"{sanitized_title}\nDuration: {duration} seconds",
+                            thumb=thumb_image_path,
+                            width=1280,
+                            height=720,
+                            progress_args=(status_msg, start_time, "📤 Uploading to dump channel", up_flow)
+                        ))
                     
-                    ffmpeg_code = await self.db.get_ffmpeg_code(user_id)
+                    ffmpeg_code = await self.ffmpeg_code_for(user_id)
+                    encode_key = download.key
+                    if not self.encodes.running((encode_key, ffmpeg_code)):
+                        async with trace.stage("preflight"):
+                            accepted = await self.confirm_compression(
+                                status_msg, input_path, workspace.file(f"{sanitized_title}_Compressed.mp4"),
+                                ffmpeg_code, user_id
+                            )
+                        if not accepted:
+                            return
                     await status_msg.edit_text("Starting compression process...")
 
-                    compress_task = asyncio.create_task(
-                        compress_video(input_path, output_path, ffmpeg_code, status_msg, self)
-                    )
-                    self.tasks.append(compress_task)
-                    success = await compress_task
+                    async with trace.stage("encode", os.path.getsize(input_path)):
+                        encode = await self.join_encode(
+                            flights, encode_key, input_path, ffmpeg_code, f"{sanitized_title}_Compressed.mp4",
+                            status_msg, user_id
+                        )
 
-                    if success and os.path.exists(output_path):
+                    if encode.result:
+                        output_path, streamed = encode.result
                         duration = await get_video_duration(output_path)
-                        thumb_image_path = await take_screenshot(output_path)
+                        thumb_image_path = await take_screenshot(output_path, workspace.file("thumb_out.jpg"))
+                        caption = f"{sanitized_title} (Smashed)\nDuration: {duration} seconds"
 
-                        await self.app.send_video(
-                            callback_query.message.chat.id,
-                            output_path,
-                            caption=f"{sanitized_title} (Smashed)\nDuration: {duration} seconds",
-                            duration=duration,
-                            thumb=thumb_image_path,
-                            width=1280,
-                            height=720,
-                            reply_to_message_id=callback_query.message.id,
-                            progress=self.helper.progress_for_pyrogram,
-                            progress_args=(status_msg, start_time, "📤 Uploading compressed video")
-                        )
+                        async with trace.stage("upload", os.path.getsize(output_path)), \
+                                self.bandwidth.flow("up", user_id) as up_flow:
+                            # Uploaded once per encode; the other jobs get a server-side copy
+                            await encode.deliver(
+                                "upload",
+                                lambda: self.send_video(
+                                    callback_query.message.chat.id,
+                                    output_path,
+                                    caption=caption,
+                                    duration=duration,
+                                    thumb=thumb_image_path,
+                                    width=1280,
+                                    height=720,
+                                    reply_to_message_id=callback_query.message.id,
+                                    progress=self.helper.progress_for_pyrogram,
+                                    progress_args=(status_msg, start_time, "📤 Uploading compressed video", up_flow),
+                                    file=streamed
+                                ),
+                                lambda sent: self.app.copy_message(
+                                    callback_query.message.chat.id, sent.chat.id, sent.id,
+                                    caption=caption, reply_to_message_id=callback_query.message.id
+                                )
+                            )
                         await status_msg.delete()
                         if os.path.exists(thumb_image_path):
                             os.remove(thumb_image_path)
@@ -236,68 +438,115 @@ class Bot:
                 await status_msg.edit_text(f"Error: {str(e)}")
                 logging.error(f"Error in download_compressed_callback: {e}")
             finally:
-                clean_files(input_path, output_path)
-                if user_id in self.video_urls:
-                    del self.video_urls[user_id]
+                await flights.aclose()
+                if workspace:
+                    workspace.cleanup()
+                if ticket:
+                    ticket.release()
+                await self.save_trace(trace)
+                self.sessions.pop(callback_query.message.chat.id, callback_query.message.id, session.request_id)
                 if user_id in self.download_tasks:
                     del self.download_tasks[user_id]
 
                     
-        @self.app.on_message(filters.command("add") & filters.reply)
-        async def compress_command(_, message: Message):
+        @self.app.on_message(filters.command("add") & filters.reply & self.access.filter)
+        async def compress_command(client: Client, message: Message):
             replied = message.reply_to_message
             if not (replied.video or replied.document):
                 await message.reply_text("Please reply to a video/document")
                 return
 
+            # A media group or an explicit message count switches to batch mode
+            count = int(message.command[1]) if len(message.command) > 1 and message.command[1].isdigit() else 1
+            if replied.media_group_id or count > 1:
+                if count > 1:
+                    inputs = await client.get_messages(
+                        message.chat.id, list(range(replied.id, replied.id + min(count, ADD_BATCH_MAX_FILES)))
+                    )
+                else:
+                    inputs = await client.get_media_group(message.chat.id, replied.id)
+                inputs = [msg for msg in inputs if msg and not msg.empty and (msg.video or msg.document)]
+                await self.compress_batch(message, inputs)
+                return
+
             status_msg = await message.reply_text("Starting process...")
-            input_path = None
-            output_path = None
             start_time = time.time()
+            ticket = None
+            workspace = None
+            flights = contextlib.AsyncExitStack()
+            trace = JobTrace("add", message.from_user.id)
 
             try:
+                ticket = await self.admit_job(
+                    status_msg, message.from_user.id, (replied.video or replied.document).file_size
+                )
+                if ticket is None:
+                    return
+                workspace = Workspace(trace.job_id)
                 title = replied.video.file_name if replied.video else replied.document.file_name
                 sanitized_title = re.sub(r'[^\w\-_\.]', '_', title).strip()
-                input_path = os.path.join(DOWNLOADS_DIR, f"{sanitized_title}.mp4")
                 
-                # Download with progress tracking
-                await replied.download(
-                    file_name=input_path,
-                    progress=self.helper.progress_for_pyrogram,
-                    progress_args=(status_msg, start_time, "Downloading video")
-                )
+                # Download with progress tracking; the same file sent by others is fetched once
+                async with trace.stage("download", (replied.video or replied.document).file_size):
+                    download = await self.join_tg_download(
+                        flights, replied, f"{sanitized_title}.mp4", status_msg, message.from_user.id
+                    )
+                input_path = download.result
+                if not input_path:
+                    await status_msg.edit_text("Download failed!")
+                    return
+                await ticket.charge(os.path.getsize(input_path))
 
-                await replied.forward(DUMP_CHANNEL)
+                async with trace.stage("dump_forward"):
+                    await download.deliver("dump", lambda: replied.forward(DUMP_CHANNEL))
 
-                output_path = os.path.join(ENCODE_DIR, f"{sanitized_title}_Smashed.mp4")
-                ffmpeg_code = await self.db.get_ffmpeg_code(message.from_user.id)
+                ffmpeg_code = await self.ffmpeg_code_for(message.from_user.id)
+                if not self.encodes.running((download.key, ffmpeg_code)):
+                    async with trace.stage("preflight"):
+                        accepted = await self.confirm_compression(
+                            status_msg, input_path, workspace.file(f"{sanitized_title}_Smashed.mp4"), ffmpeg_code,
+                            message.from_user.id
+                        )
+                    if not accepted:
+                        return
                 
                 await status_msg.edit_text("Starting compression process...")
-                compress_task = asyncio.create_task(
-                    compress_video(input_path, output_path, ffmpeg_code, status_msg,self)
-                )
-                self.tasks.append(compress_task)
-                await compress_task
+                async with trace.stage("encode", os.path.getsize(input_path)):
+                    encode = await self.join_encode(
+                        flights, download.key, input_path, ffmpeg_code, f"{sanitized_title}_Smashed.mp4",
+                        status_msg, message.from_user.id
+                    )
 
-                if os.path.exists(output_path):
+                if encode.result:
+                    output_path, streamed = encode.result
                     # Reset start time for final upload
                     start_time = time.time()
                     # Get duration and thumbnail
                     duration = await get_video_duration(output_path)
-                    thumb_image_path = await take_screenshot(output_path)
+                    thumb_image_path = await take_screenshot(output_path, workspace.file("thumb.jpg"))
+                    caption = f"📹 {sanitized_title} (Smashed)\n⏱️ Duration: {duration} seconds"
 
-                    await self.app.send_video(
-                        message.chat.id,
-                        output_path,
-                        caption=f"📹 {sanitized_title} (Smashed)\n⏱️ Duration: {duration} seconds",
-                        duration=duration,
-                        thumb=thumb_image_path,
-                        width=1280,
-                        height=720,
-                        reply_to_message_id=message.id,
-                        progress=self.helper.progress_for_pyrogram,
-                        progress_args=(status_msg, start_time, "📤 Uploading compressed video")
-                    )
+                    async with trace.stage("upload", os.path.getsize(output_path)), \
+                            self.bandwidth.flow("up", message.from_user.id) as up_flow:
+                        await encode.deliver(
+                            "upload",
+                            lambda: self.send_video(
+                                message.chat.id,
+                                output_path,
+                                caption=caption,
+                                duration=duration,
+                                thumb=thumb_image_path,
+                                width=1280,
+                                height=720,
+                                reply_to_message_id=message.id,
+                                progress=self.helper.progress_for_pyrogram,
+                                progress_args=(status_msg, start_time, "📤 Uploading compressed video", up_flow),
+                                file=streamed
+                            ),
+                            lambda sent: self.app.copy_message(
+                                message.chat.id, sent.chat.id, sent.id, caption=caption, reply_to_message_id=message.id
+                            )
+                        )
                     await status_msg.delete()
                     if os.path.exists(thumb_image_path):
                         os.remove(thumb_image_path)
@@ -306,10 +555,228 @@ class Bot:
                 await status_msg.edit_text(f"Error: {str(e)}")
                 logging.error(f"Error in compress_command: {e}")
             finally:
-                clean_files(input_path, output_path)
+                await flights.aclose()
+                if ticket:
+                    ticket.release()
+                await self.save_trace(trace)
+                if workspace:
+                    workspace.cleanup()
+                if message.from_user.id in self.download_tasks:
+                    del self.download_tasks[message.from_user.id]
                 self.tasks.clear()
 
-        @self.app.on_message(filters.command("get"))
+        @self.app.on_callback_query(filters.regex(r"^pre_(ok|no)_") & self.access.filter)
+        async def preflight_callback(_, callback_query: CallbackQuery):
+            _, answer, token = callback_query.data.split("_", 2)
+            pending = self.confirmations.get(token)
+            if pending is None or pending[1].done():
+                await callback_query.answer("This estimate has expired.", show_alert=True)
+                return
+            user_id, future = pending
+            if callback_query.from_user.id != user_id:
+                await callback_query.answer("These buttons belong to another request.", show_alert=True)
+                return
+            future.set_result(answer == "ok")
+            await callback_query.answer("Compressing..." if answer == "ok" else "Aborted")
+
+        @self.app.on_message(filters.command("ladder") & filters.reply & self.access.filter)
+        async def ladder_command(_, message: Message):
+            replied = message.reply_to_message
+            media = replied.video or replied.document
+            if not media:
+                await message.reply_text("Please reply to a video/document")
+                return
+
+            rungs = dict(LADDER_RUNGS)
+            heights = [int(arg.rstrip("p")) for arg in message.command[1:] if arg.rstrip("p").isdigit()]
+            unknown = [height for height in heights if height not in rungs]
+            if unknown:
+                await message.reply_text(
+                    f"❌ Unknown rendition {unknown[0]}p, available: {', '.join(f'{h}p' for h in rungs)}"
+                )
+                return
+            heights = sorted(set(heights or rungs), reverse=True)
+            source_height = getattr(media, "height", None)
+            if source_height:
+                # Never upscale; keep at least the smallest rung
+                heights = [h for h in heights if h <= source_height] or heights[-1:]
+
+            status_msg = await message.reply_text("Starting process...")
+            user_id = message.from_user.id
+            ticket = None
+            workspace = None
+            trace = JobTrace("ladder", user_id)
+
+            compress_task = None
+
+            try:
+                ticket = await self.admit_job(status_msg, user_id, media.file_size)
+                if ticket is None:
+                    return
+                workspace = Workspace(trace.job_id, media.file_size)
+                title = re.sub(r'[^\w\-_\.]', '_', os.path.splitext(getattr(media, "file_name", None) or "video")[0])
+                input_path = workspace.file(f"{title}.mp4")
+
+                async with trace.stage("download", media.file_size), \
+                        self.bandwidth.flow("down", user_id) as down_flow:
+                    await self.tg_downloader.download(
+                        replied, input_path,
+                        progress=self.helper.progress_for_pyrogram,
+                        progress_args=(status_msg, time.time(), "Downloading video", down_flow)
+                    )
+                await ticket.charge(os.path.getsize(input_path))
+
+                async with trace.stage("dump_forward"):
+                    await replied.forward(DUMP_CHANNEL)
+
+                renditions = [(h, rungs[h], workspace.file(f"{title}_{h}p.mp4")) for h in heights]
+                async with trace.stage("encode", os.path.getsize(input_path)):
+                    compress_task = asyncio.create_task(compress_ladder(input_path, renditions, status_msg, self))
+                    self.tasks.append(compress_task)
+                    outputs = await compress_task
+                if not outputs:
+                    return
+
+                source_width = getattr(media, "width", None)
+                for (rung_height, _, _), output_path in zip(renditions, outputs):
+                    # The scale filter never upscales, so a short source keeps its own height
+                    height = min(rung_height, source_height) if source_height else rung_height
+                    duration = await get_video_duration(output_path)
+                    thumb_image_path = await take_screenshot(output_path, workspace.file(f"thumb_{rung_height}.jpg"))
+                    width = round(source_width * height / source_height / 2) * 2 if source_width and source_height else 0
+                    upload_status = await message.reply_text(f"📤 Uploading {height}p...")
+                    async with trace.stage("upload", os.path.getsize(output_path)), \
+                            self.bandwidth.flow("up", user_id) as up_flow:
+                        await self.send_video(
+                            message.chat.id,
+                            output_path,
+                            caption=f"📹 {title} ({height}p)\n⏱️ Duration: {duration} seconds",
+                            duration=duration,
+                            thumb=thumb_image_path,
+                            width=width,
+                            height=height,
+                            reply_to_message_id=message.id,
+                            progress=self.helper.progress_for_pyrogram,
+                            progress_args=(upload_status, time.time(), f"📤 Uploading {height}p", up_flow)
+                        )
+                    await upload_status.delete()
+
+            except Exception as e:
+                await status_msg.edit_text(f"Error: {str(e)}")
+                logging.error(f"Error in ladder_command: {e}")
+            finally:
+                if ticket:
+                    ticket.release()
+                await self.save_trace(trace)
+                if workspace:
+                    workspace.cleanup()
+                if compress_task in self.tasks:
+                    self.tasks.remove(compress_task)
+
+        @self.app.on_message(filters.command(["trim", "clip"]) & filters.reply & self.access.filter)
+        async def trim_command(_, message: Message):
+            replied = message.reply_to_message
+            media = replied.video or replied.document
+            if not media:
+                await message.reply_text("Please reply to a video/document")
+                return
+            # /trim joins every range into one video, /clip sends one video per range
+            joined = message.command[0] == "trim"
+            try:
+                if len(message.command) < 2:
+                    raise ValueError("No time ranges given")
+                ranges = parse_ranges(message.text.split(None, 1)[1], getattr(media, "duration", None))
+            except ValueError as e:
+                await message.reply_text(
+                    f"❌ {e}\nUsage: /{message.command[0]} 1:00-3:00 [10:00-12:30 ...] (reply to a video)"
+                )
+                return
+
+            status_msg = await message.reply_text("Starting process...")
+            user_id = message.from_user.id
+            ticket = None
+            workspace = None
+            trace = JobTrace(message.command[0], user_id)
+            tasks = []
+
+            try:
+                ticket = await self.admit_job(status_msg, user_id, media.file_size)
+                if ticket is None:
+                    return
+                workspace = Workspace(trace.job_id, media.file_size)
+                title = re.sub(r'[^\w\-_\.]', '_', os.path.splitext(getattr(media, "file_name", None) or "video")[0])
+                input_path = workspace.file(f"{title}_source")
+
+                async with trace.stage("download", media.file_size), \
+                        self.bandwidth.flow("down", user_id) as down_flow:
+                    download_task = asyncio.create_task(self.tg_downloader.download(
+                        replied, input_path,
+                        progress=self.helper.progress_for_pyrogram,
+                        progress_args=(status_msg, time.time(), "Downloading video", down_flow)
+                    ))
+                    tasks.append(download_task)
+                    self.tasks.append(download_task)
+                    await download_task
+                await ticket.charge(os.path.getsize(input_path))
+
+                async with trace.stage("probe"):
+                    info = await probe_media(input_path)
+                if joined:
+                    output_paths = [workspace.file(f"{title}_trimmed.mp4")]
+                else:
+                    output_paths = [workspace.file(f"{title}_clip{index + 1}.mp4") for index in range(len(ranges))]
+
+                async with trace.stage("trim", os.path.getsize(input_path)):
+                    trim_task = asyncio.create_task(
+                        smart_trim(input_path, ranges, output_paths, workspace.path, info, status_msg)
+                    )
+                    tasks.append(trim_task)
+                    self.tasks.append(trim_task)
+                    result = await trim_task
+
+                spans = [f"{format_timestamp(start)}-{format_timestamp(end)}" for start, end in ranges]
+                labels = [", ".join(spans)] if joined else spans
+                for index, (output_path, label) in enumerate(zip(output_paths, labels)):
+                    duration = await get_video_duration(output_path)
+                    thumb_image_path = await take_screenshot(output_path, workspace.file(f"thumb{index}.jpg"))
+                    async with trace.stage("upload", os.path.getsize(output_path)), \
+                            self.bandwidth.flow("up", user_id) as up_flow:
+                        upload_msg = await self.send_video(
+                            message.chat.id,
+                            output_path,
+                            caption=f"✂️ {title} [{label}]\n⏱️ Duration: {duration} seconds",
+                            duration=duration,
+                            thumb=thumb_image_path,
+                            width=info["width"],
+                            height=info["height"],
+                            reply_to_message_id=message.id,
+                            progress=self.helper.progress_for_pyrogram,
+                            progress_args=(status_msg, time.time(), f"📤 Uploading {label}", up_flow)
+                        )
+                    async with trace.stage("dump_forward"):
+                        await self.dump_upload(upload_msg)
+
+                await status_msg.edit_text(
+                    f"✅ Done: {result['copied']:.0f}s stream-copied, {result['encoded']:.1f}s re-encoded at cut points."
+                )
+            except asyncio.CancelledError:
+                await status_msg.edit_text("Task cancelled!")
+            except TrimError as e:
+                await status_msg.edit_text(f"❌ {e}")
+            except Exception as e:
+                await status_msg.edit_text(f"Error: {str(e)}")
+                logging.error(f"Error in trim_command: {e}")
+            finally:
+                for task in tasks:
+                    if task in self.tasks:
+                        self.tasks.remove(task)
+                if ticket:
+                    ticket.release()
+                await self.save_trace(trace)
+                if workspace:
+                    workspace.cleanup()
+
+        @self.app.on_message(filters.command("get") & self.access.filter)
         async def get_ffmpeg(_, message: Message):
             logging.info("Received /get command")
             try:
@@ -329,7 +796,7 @@ class Bot:
                 await message.reply_text(f"Error retrieving FFmpeg code: {str(e)}")
                 logging.error(f"Error in get_ffmpeg command: {e}")
 
-        @self.app.on_message(filters.command("set"))
+        @self.app.on_message(filters.command("set") & self.access.filter)
         async def set_ffmpeg(_, message: Message):
             logging.info("Received /set command")
             if len(message.command) < 2:
@@ -342,8 +809,7 @@ class Bot:
             await self.db.set_ffmpeg_code(user_id, ffmpeg_code)
             await message.reply_text("Your FFmpeg code has been set!")
 
-        @self.app.on_message(filters.command("cancel"))
-
+        @self.app.on_message(filters.command("cancel") & self.access.filter)
         async def cancel_tasks(_, message: Message):
             logging.info("Received /cancel command")
             user_id = message.from_user.id
@@ -364,78 +830,104 @@ class Bot:
             await message.reply_text("All ongoing tasks have been canceled.")
 
 
-        @self.app.on_message(filters.command("yl"))
+        @self.app.on_message(filters.command("yl") & self.access.filter)
         async def youtube_no_compress_command(_, message: Message):
             logging.info("Received /yl command")
             if len(message.command) < 2:
                 await message.reply_text("Please provide a YouTube URL")
                 return
 
+            urls, max_height = parse_batch_args(message.text.split(None, 1)[1])
+            if len(urls) > 1 or max_height is not None or is_playlist_url(urls[0]):
+                await self.run_batch(message, urls, max_height, compress=False)
+                return
+
             status_msg = await message.reply_text("Fetching video information...")
             try:
-                url = message.text.split(None, 1)[1]
+                url = urls[0]
+                extract_started = time.time()
                 formats, title = await get_video_formats(url)
-                keyboard = create_format_buttons(formats, prefix="dl_nocompress_")
+                request_id = self.sessions.new_request_id()
+                keyboard = create_format_buttons(formats, prefix=f"dl_nocompress_{request_id}_")
 
+                session = Session(
+                    request_id, message.from_user.id, url, formats=formats, title=title,
+                    extract_time=(extract_started, time.time())
+                )
+                self.sessions.put(status_msg.chat.id, status_msg.id, session)
                 await status_msg.edit_text(
                     f"Select format for: {title}",
                     reply_markup=keyboard
                 )
-                user_id = message.from_user.id
-                self.video_urls[user_id] = url
+                await self.prefetcher.start(session)
             except Exception as e:
                 await status_msg.edit_text(f"Error: {str(e)}")
                 logging.error(f"Error in youtube_no_compress_command: {e}")
 
-        @self.app.on_callback_query(filters.regex(r"^dl_nocompress_"))
+        @self.app.on_callback_query(filters.regex(r"^dl_nocompress_") & self.access.filter)
         async def download_no_compress_callback(_, callback_query: CallbackQuery):
-            format_id = callback_query.data.split("_")[2]
             user_id = callback_query.from_user.id
-            url = self.video_urls.get(user_id)
-
-            if not url:
-                await callback_query.answer("Session expired. Please try again.", show_alert=True)
+            session, format_id = await self.resolve_session(callback_query, "dl_nocompress_")
+            if session is None:
                 return
+            url = session.url
 
             await callback_query.answer("Processing...")
             status_msg = await callback_query.message.reply_text("Starting download process...")
 
-            input_path = None
+            ticket = None
+            workspace = None
+            flights = contextlib.AsyncExitStack()
+            trace = JobTrace("yl", user_id)
+            if "extract_time" in session.extra:
+                trace.add("extract", *session.extra["extract_time"])
             try:
-                formats, title = await get_video_formats(url)
-                sanitized_title = re.sub(r'[^\w\-_\.]', '_', title).strip()
-                input_path = os.path.join(DOWNLOADS_DIR, f"{sanitized_title}.mp4")
+                ticket = await self.admit_job(status_msg, user_id, session.filesize(format_id))
+                if ticket is None:
+                    return
+                # A prefetch for this keyboard already holds the parts yt-dlp would fetch first
+                prefetched = await self.prefetcher.claim(session, format_id)
+                await self.prefetcher.record_pick(session, format_id)
+                workspace = Workspace(trace.job_id)
+                sanitized_title = input_stem(session.title)
 
-                download_task = asyncio.create_task(
-                    download_video(url, format_id, input_path, status_msg)
-                )
-                self.download_tasks[user_id] = download_task
-                success = await download_task
+                async with trace.stage("download") as span:
+                    download = await self.join_download(
+                        flights, session, format_id, f"{sanitized_title}.mp4", status_msg, user_id,
+                        workspace=prefetched
+                    )
+                    input_path = download.result
+                    span.bytes = os.path.getsize(input_path) if input_path else None
 
-                if success and os.path.exists(input_path):
-                    duration = await get_video_duration(input_path)
-                    thumb_image_path = await take_screenshot(input_path)
+                if input_path:
+                    await ticket.charge(os.path.getsize(input_path))
+                    async with trace.stage("probe"):
+                        duration = await get_video_duration(input_path)
+                        thumb_image_path = await take_screenshot(input_path, workspace.file("thumb.jpg"))
 
                     await status_msg.edit_text("✅ Download complete! Preparing to upload...")
 
-                    # Upload the video to the user
-                    upload_msg = await self.app.send_video(
-                        callback_query.message.chat.id,
-                        input_path,
-                        progress=self.helper.progress_for_pyrogram,
-                        duration=duration,
-                        thumb=thumb_image_path,
-                        width=1280,
-                        height=720,
-                        progress_args=(status_msg, time.time(), "📤 Uploading to user")
-                    )
+                    # Upload the video to the user, or copy the upload made for an identical request
+                    async with trace.stage("upload", os.path.getsize(input_path)), \
+                            self.bandwidth.flow("up", user_id) as up_flow:
+                        upload_msg = await download.deliver(
+                            "upload",
+                            lambda: self.send_video(
+                                callback_query.message.chat.id,
+                                input_path,
+                                progress=self.helper.progress_for_pyrogram,
+                                duration=duration,
+                                thumb=thumb_image_path,
+                                width=1280,
+                                height=720,
+                                progress_args=(status_msg, time.time(), "📤 Uploading to user", up_flow)
+                            ),
+                            lambda sent: self.app.copy_message(callback_query.message.chat.id, sent.chat.id, sent.id)
+                        )
 
                     # Now forward the uploaded video to the dump channel
-                    await self.app.forward_messages(
-                        chat_id=DUMP_CHANNEL,
-                        from_chat_id=callback_query.message.chat.id,
-                        message_ids=upload_msg.id
-                    )
+                    async with trace.stage("dump_forward"):
+                        await download.deliver("dump", lambda: self.dump_upload(upload_msg))
 
                     await status_msg.delete()
                     if os.path.exists(thumb_image_path):
@@ -450,17 +942,640 @@ class Bot:
                 await status_msg.edit_text(f"Error: {str(e)}")
                 logging.error(f"Error in download_no_compress_callback: {e}")
             finally:
-                clean_files(input_path)
-                if user_id in self.video_urls:
-                    del self.video_urls[user_id]
+                await flights.aclose()
+                if workspace:
+                    workspace.cleanup()
+                if ticket:
+                    ticket.release()
+                await self.save_trace(trace)
+                self.sessions.pop(callback_query.message.chat.id, callback_query.message.id, session.request_id)
+                if user_id in self.download_tasks:
+                    del self.download_tasks[user_id]
+
+        @self.app.on_message(filters.command("ya") & self.access.filter)
+        async def youtube_audio_command(_, message: Message):
+            logging.info("Received /ya command")
+            if len(message.command) < 2:
+                await message.reply_text("Please provide a YouTube URL")
+                return
+
+            status_msg = await message.reply_text("Fetching audio formats...")
+            try:
+                url = message.command[1]
+                extract_started = time.time()
+                formats, title = await get_audio_formats(url)
+                if not formats:
+                    await status_msg.edit_text("No audio-only formats found for this link.")
+                    return
+                request_id = self.sessions.new_request_id()
+                keyboard = create_audio_format_buttons(formats, prefix=f"dla_{request_id}_")
+
+                self.sessions.put(
+                    status_msg.chat.id, status_msg.id,
+                    Session(
+                        request_id, message.from_user.id, url, formats=formats, title=title,
+                        extract_time=(extract_started, time.time())
+                    )
+                )
+                await status_msg.edit_text(
+                    f"Select audio format for: {title}",
+                    reply_markup=keyboard
+                )
+            except Exception as e:
+                await status_msg.edit_text(f"Error: {str(e)}")
+                logging.error(f"Error in youtube_audio_command: {e}")
+
+        @self.app.on_callback_query(filters.regex(r"^dla_") & self.access.filter)
+        async def download_audio_callback(_, callback_query: CallbackQuery):
+            user_id = callback_query.from_user.id
+            session, format_id = await self.resolve_session(callback_query, "dla_")
+            if session is None:
+                return
+            chosen = next((f for f in session.formats if str(f['format_id']) == format_id), None)
+            if chosen is None:
+                await callback_query.answer("Unknown format.", show_alert=True)
+                return
+
+            await callback_query.answer("Processing...")
+            status_msg = await callback_query.message.reply_text("Starting audio download...")
+
+            ticket = None
+            workspace = None
+            flights = contextlib.AsyncExitStack()
+            trace = JobTrace("ya", user_id)
+            if "extract_time" in session.extra:
+                trace.add("extract", *session.extra["extract_time"])
+            try:
+                ticket = await self.admit_job(status_msg, user_id, session.filesize(format_id))
+                if ticket is None:
+                    return
+                workspace = Workspace(trace.job_id, session.filesize(format_id))
+                sanitized_title = input_stem(session.title)
+                output_path = workspace.file(f"{sanitized_title}{audio_output_ext(chosen['acodec'])}")
+
+                # Only the audio stream is fetched; no video format, no merge
+                async with trace.stage("download") as span:
+                    download = await self.join_download(
+                        flights, session, format_id, f"{sanitized_title}.source.{chosen['ext']}", status_msg, user_id,
+                        format_spec=format_id
+                    )
+                    input_path = download.result
+                    span.bytes = os.path.getsize(input_path) if input_path else None
+
+                if not input_path:
+                    await status_msg.edit_text("Download failed!")
+                    return
+                await ticket.charge(os.path.getsize(input_path))
+
+                async with trace.stage("remux", os.path.getsize(input_path)):
+                    prepared = await prepare_audio(input_path, output_path, chosen['acodec'], session.title)
+                if not prepared:
+                    await status_msg.edit_text("❌ Audio conversion failed.")
+                    return
+                duration = await get_video_duration(output_path)
+
+                async with trace.stage("upload", os.path.getsize(output_path)), \
+                        self.bandwidth.flow("up", user_id) as up_flow:
+                    upload_msg = await download.deliver(
+                        "audio",
+                        lambda: self.send_audio(
+                            callback_query.message.chat.id,
+                            output_path,
+                            caption=f"🎵 {session.title}",
+                            duration=duration,
+                            title=session.title,
+                            reply_to_message_id=callback_query.message.id,
+                            progress=self.helper.progress_for_pyrogram,
+                            progress_args=(status_msg, time.time(), "📤 Uploading audio", up_flow)
+                        ),
+                        lambda sent: self.app.copy_message(
+                            callback_query.message.chat.id, sent.chat.id, sent.id,
+                            reply_to_message_id=callback_query.message.id
+                        )
+                    )
+                async with trace.stage("dump_forward"):
+                    await download.deliver("dump", lambda: self.dump_upload(upload_msg))
+                await status_msg.delete()
+
+            except asyncio.CancelledError:
+                await status_msg.edit_text("Download cancelled!")
+                raise
+            except Exception as e:
+                await status_msg.edit_text(f"Error: {str(e)}")
+                logging.error(f"Error in download_audio_callback: {e}")
+            finally:
+                await flights.aclose()
+                if workspace:
+                    workspace.cleanup()
+                if ticket:
+                    ticket.release()
+                await self.save_trace(trace)
+                self.sessions.pop(callback_query.message.chat.id, callback_query.message.id, session.request_id)
                 if user_id in self.download_tasks:
                     del self.download_tasks[user_id]
 
+        @self.app.on_message(filters.command(["auth", "unauth"]) & filters.user(AUTH_USERS))
+        async def auth_command(_, message: Message):
+            if len(message.command) < 2 or not message.command[1].lstrip("-").isdigit():
+                await message.reply_text(f"Usage: /{message.command[0]} <user id or -group id>")
+                return
+            chat_id = int(message.command[1])
+            if message.command[0] == "auth":
+                await self.access.authorize(chat_id)
+                await message.reply_text(f"✅ {chat_id} authorized.")
+            else:
+                await self.access.unauthorize(chat_id)
+                await message.reply_text(f"🚫 {chat_id} is no longer authorized.")
+
+        @self.app.on_message(filters.command("stats") & filters.user(AUTH_USERS))
+        async def stats_command(_, message: Message):
+            since = time.time() - STATS_WINDOW_DAYS * 86400
+            stages = summarize(await self.db.get_stage_durations(since))
+            calls = f"\n<b>📡 Telegram calls</b>\n{scheduler.describe()}"
+            if self.prefetcher.enabled:
+                calls += f"\n<b>🔮 Prefetch</b>\n{self.prefetcher.describe()}"
+            calls += f"\n<b>🔗 Shared jobs</b>\n{self.downloads.describe()}\n{self.encodes.describe()}"
+            if not stages:
+                await message.reply_text(f"No jobs recorded in the last {STATS_WINDOW_DAYS} days.{calls}")
+                return
+
+            lines = [f"<b>📊 Stage times, last {STATS_WINDOW_DAYS} days</b>", "<code>stage          n     p50     p95</code>"]
+            for stage, (count, p50, p95) in sorted(stages.items(), key=lambda item: -item[1][2]):
+                lines.append(f"<code>{stage:<12} {count:>4} {p50:>6.1f}s {p95:>6.1f}s</code>")
+
+            lines.append("\n<b>🐢 Slowest jobs</b>")
+            for job_id, kind, user_id, seconds, status, job_stages in await self.db.get_slowest_jobs(since):
+                breakdown = ", ".join(
+                    f"{stage} {stage_seconds:.0f}s"
+                    + (f" @{fps:.0f}fps" if fps else "")
+                    + (f" ({retries} retries)" if retries else "")
+                    for stage, stage_seconds, _, fps, retries in job_stages
+                )
+                lines.append(f"<code>{job_id}</code> /{kind} by {user_id}: {seconds:.0f}s [{status}]\n  {breakdown}")
+            lines.append(calls)
+            await message.reply_text("\n".join(lines))
+
+        @self.app.on_message(filters.command("calibrate") & filters.user(AUTH_USERS))
+        async def calibrate_command(_, message: Message):
+            if message.command[1:] == ["show"]:
+                await self.tuner.load()
+                await message.reply_text(self.tuner.describe())
+                return
+            if self.tuner.running:
+                await message.reply_text("A calibration is already running.")
+                return
+
+            status_msg = await message.reply_text("🧪 Preparing calibration clips...")
+            encoders = message.command[1:] or None
+            workspace = Workspace("calibrate")
+            self.tuner.running = True
+
+            async def progress(done, total, label):
+                await background(status_msg.edit_text(f"🧪 Calibrating {done + 1}/{total}: {label}"))
+
+            # A task in self.tasks, so /cancel stops the matrix and the encode it is measuring
+            calibrate_task = asyncio.create_task(run_calibration(workspace.path, encoders, progress=progress))
+            self.tasks.append(calibrate_task)
+            try:
+                results = await calibrate_task
+                await self.tuner.save(results)
+                await status_msg.edit_text(f"✅ Calibrated {len(results)} runs.\n{self.tuner.describe()}")
+            except asyncio.CancelledError:
+                await status_msg.edit_text("🛑 Calibration cancelled, nothing was saved.")
+            except CalibrationError as e:
+                await status_msg.edit_text(f"❌ {e}")
+            except Exception as e:
+                await status_msg.edit_text(f"Error: {str(e)}")
+                logging.error(f"Error in calibrate_command: {e}")
+            finally:
+                if calibrate_task in self.tasks:
+                    self.tasks.remove(calibrate_task)
+                self.tuner.running = False
+                workspace.cleanup()
+
+        @self.app.on_message(
+            filters.command(["l", "lc", "ylc", "yl", "ya", "add", "ladder", "trim", "clip", "get", "set", "cancel", "restart"]) & ~self.access.filter
+        )
+        async def unauthorized_command(_, message: Message):
+            await message.reply_text("🚫 You are not authorized to use this bot.")
+
+        @self.app.on_callback_query(~self.access.filter)
+        async def unauthorized_callback(_, callback_query: CallbackQuery):
+            # Answer every button press, or the client keeps spinning until it times out
+            await callback_query.answer("🚫 You are not authorized to use this bot.", show_alert=True)
+
+    async def send_video(self, chat_id, video, **kwargs):
+        """Upload a video through the uploader pool when extra tokens are configured, else with the main bot."""
+        if self.upload_pool:
+            return await self.upload_pool.send_video(self.app, chat_id, video, **kwargs)
+        return await self.uploader.send_video(chat_id, video, **kwargs)
+
+    async def send_audio(self, chat_id, audio, **kwargs):
+        if self.upload_pool:
+            return await self.upload_pool.send_audio(self.app, chat_id, audio, **kwargs)
+        return await self.uploader.send_audio(chat_id, audio, **kwargs)
 
+    async def send_document(self, chat_id, document, **kwargs):
+        if self.upload_pool:
+            return await self.upload_pool.send_document(self.app, chat_id, document, **kwargs)
+        return await self.uploader.send_document(chat_id, document, **kwargs)
 
+    async def compress_and_stream(self, input_path, output_path, ffmpeg_code, status_msg, user_id):
+        """compress_video that uploads the output while it is being encoded, when PROGRESSIVE_UPLOAD is on.
+
+        Returns (success, file); pass `file` to send_video so only the message is left to send.
+        `file` is None when the output still needs a regular upload.
+        """
+        if not PROGRESSIVE_UPLOAD or self.upload_pool:
+            # Pool workers upload with their own sessions, so a file streamed by the main bot is of no use to them
+            return await compress_video(input_path, output_path, ffmpeg_code, status_msg, self), None
+
+        compress_task = asyncio.create_task(
+            compress_video(input_path, output_path, ffmpeg_code, status_msg, self, fragmented=True)
+        )
+        async with self.bandwidth.flow("up", user_id) as up_flow:
+            upload_task = asyncio.create_task(
+                self.uploader.upload_growing(partial_path(output_path), compress_task, output_path, up_flow)
+            )
+            try:
+                success = await compress_task
+            except BaseException:
+                upload_task.cancel()
+                raise
+            if not success:
+                upload_task.cancel()
+                return False, None
+            try:
+                return True, await upload_task
+            except Exception as e:
+                logging.error(f"Progressive upload failed, falling back to a regular upload: {e}")
+                return True, None
+
+    async def join_download(self, stack, session, format_id, filename, status_msg, user_id, format_spec=None,
+                            workspace=None):
+        """Attach the job to the yt-dlp download of this URL and format, starting it unless one is running.
+
+        The flight stays held on `stack`; `flight.result` is the downloaded path, or None on failure.
+        """
+        spec = format_spec or f"{format_id}+bestaudio/best"
+
+        async def work(flight):
+            path = flight.workspace.file(filename)
+            async with self.bandwidth.flow("down", user_id) as down_flow:
+                success = await download_video(session.url, format_id, path, flight.status, down_flow, format_spec=spec)
+            return path if success and os.path.exists(path) else None
+
+        return await self._join(
+            stack, self.downloads.join(("ytdlp", session.url, spec), work, status_msg, session.filesize(format_id),
+                                       workspace),
+            user_id
+        )
+
+    async def join_tg_download(self, stack, media_msg, filename, status_msg, user_id):
+        """join_download for a Telegram video/document, keyed by its file_unique_id."""
+        media = media_msg.video or media_msg.document
+
+        async def work(flight):
+            path = flight.workspace.file(filename)
+            async with self.bandwidth.flow("down", user_id) as down_flow:
+                await self.tg_downloader.download(
+                    media_msg, path,
+                    progress=self.helper.progress_for_pyrogram,
+                    progress_args=(flight.status, time.time(), "Downloading video", down_flow)
+                )
+            return path if os.path.exists(path) else None
+
+        return await self._join(
+            stack, self.downloads.join(("tg", media.file_unique_id), work, status_msg, media.file_size), user_id
+        )
+
+    async def join_encode(self, stack, input_key, input_path, ffmpeg_code, filename, status_msg, user_id):
+        """Attach the job to the encode of `input_key` with `ffmpeg_code`, starting it unless one is running.
+
+        `flight.result` is (output_path, streamed) as from compress_and_stream, or None on failure.
+        """
+        async def work(flight):
+            output_path = flight.workspace.file(filename)
+            success, streamed = await self.compress_and_stream(
+                input_path, output_path, ffmpeg_code, flight.status, user_id
+            )
+            return (output_path, streamed) if success and os.path.exists(output_path) else None
+
+        flight = self.encodes.join((input_key, ffmpeg_code), work, status_msg, os.path.getsize(input_path))
+        return await self._join(stack, flight, user_id, self.tasks)
+
+    async def _join(self, stack, flight, user_id, tasks=None):
+        # Joined in the user's cancellable task: /cancel takes this job off the flight,
+        # which only stops the work once no other job is waiting for it
+        join_task = asyncio.create_task(stack.enter_async_context(flight))
+        self.download_tasks[user_id] = join_task
+        if tasks is not None:
+            tasks.append(join_task)
+        return await join_task
+
+    async def dump_upload(self, upload_msg):
+        """Keep a copy of a finished upload in DUMP_CHANNEL; pool uploads already went through it."""
+        if self.upload_pool or upload_msg is None:
+            return None
+        return await self.app.forward_messages(
+            chat_id=DUMP_CHANNEL,
+            from_chat_id=upload_msg.chat.id,
+            message_ids=upload_msg.id
+        )
+
+    async def ffmpeg_code_for(self, user_id):
+        """The user's FFmpeg code with "-preset auto" resolved against this host's calibration."""
+        return await self.tuner.resolve(await self.db.get_ffmpeg_code(user_id))
+
+    async def save_trace(self, trace):
+        """Persist a job's stage spans and end its log tagging; tracing never fails the job itself."""
+        trace.close()
+        if not trace.spans:
+            return
+        try:
+            await self.db.save_job_trace(trace, trace.finish())
+        except Exception as e:
+            logging.error(f"Failed to save trace {trace.job_id}: {e}")
+
+    async def admit_job(self, status_msg, user_id, expected_bytes=0):
+        """Admission control for one job; shows the reason on `status_msg` and returns None when refused."""
+        try:
+            return self.access.admit(user_id, expected_bytes)
+        except QuotaExceeded as e:
+            await status_msg.edit_text(f"🚫 {e}")
+            return None
+
+    async def confirm_compression(self, status_msg, input_path, output_path, ffmpeg_code, user_id):
+        """Show a sample-encode estimate and wait for the user to accept or abort the full compression."""
+        if not PREFLIGHT_ENABLED or re.search(r"-(c:v|vcodec)\s+copy", ffmpeg_code):
+            return True
+        duration = await get_video_duration(input_path)
+        if not duration or duration < PREFLIGHT_MIN_DURATION:
+            return True
+
+        await status_msg.edit_text("🧪 Estimating encode time and size from samples...")
+        estimate = await estimate_compression(
+            input_path, output_path, ffmpeg_code, PREFLIGHT_SAMPLES, PREFLIGHT_SAMPLE_SECONDS, self
+        )
+        if estimate is None:
+            await status_msg.edit_text("⚠️ Could not estimate this encode, starting anyway...")
+            return True
+
+        token = self.sessions.new_request_id()
+        future = asyncio.get_running_loop().create_future()
+        self.confirmations[token] = (user_id, future)
+        keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ Compress", callback_data=f"pre_ok_{token}"),
+            InlineKeyboardButton("❌ Abort", callback_data=f"pre_no_{token}"),
+        ]])
+        await status_msg.edit_text(format_estimate(estimate) + "\n\nProceed?", reply_markup=keyboard)
+
+        try:
+            accepted = await asyncio.wait_for(future, PREFLIGHT_TIMEOUT)
+        except asyncio.TimeoutError:
+            accepted = False
+        finally:
+            self.confirmations.pop(token, None)
+
+        if not accepted:
+            await status_msg.edit_text(format_estimate(estimate) + "\n\n🛑 Compression aborted.")
+        return accepted
+
+    async def resolve_session(self, callback_query: CallbackQuery, prefix):
+        """Find the session behind a format button; answers the query and returns (None, None) if it is gone."""
+        request_id, _, format_id = callback_query.data[len(prefix):].partition("_")
+        message = callback_query.message
+        session = self.sessions.get(message.chat.id, message.id, request_id)
+
+        if session is None:
+            await callback_query.answer("Session expired. Please try again.", show_alert=True)
+            return None, None
+        if session.user_id != callback_query.from_user.id:
+            await callback_query.answer("These buttons belong to another request.", show_alert=True)
+            return None, None
+        return session, format_id
+
+    async def run_batch(self, message: Message, urls, max_height, compress):
+        """Expand playlists/URL lists and run every item with one format policy and one status message."""
+        max_height = max_height or BATCH_DEFAULT_HEIGHT
+        user_id = message.from_user.id
+        status_msg = await message.reply_text("📦 Expanding batch...")
+
+        entries = await expand_urls(urls, limit=BATCH_MAX_ITEMS)
+        if not entries:
+            await status_msg.edit_text("No videos found in the batch.")
+            return
+
+        ticket = await self.admit_job(status_msg, user_id)
+        if ticket is None:
+            return
+
+        items = [BatchItem(index, url, title) for index, (url, title) in enumerate(entries, start=1)]
+        ffmpeg_code = await self.ffmpeg_code_for(user_id) if compress else None
+
+        async def process(item, item_status):
+            return await self.process_batch_item(
+                item, item_status, message.chat.id, user_id, max_height, ffmpeg_code, ticket
+            )
+
+        runner = BatchRunner(
+            items, status_msg, process,
+            header=f"Batch{' + compress' if compress else ''}: best ≤{max_height}p"
+        )
+        batch_task = asyncio.create_task(runner.run())
+        self.tasks.append(batch_task)
+        try:
+            done = await batch_task
+            logging.info(f"Batch for user {user_id} finished: {done}/{len(items)} items")
+        except asyncio.CancelledError:
+            await status_msg.edit_text(runner.render() + "\n\nBatch cancelled!")
+        finally:
+            ticket.release()
+            if batch_task in self.tasks:
+                self.tasks.remove(batch_task)
+
+    async def process_batch_item(self, item, item_status, chat_id, user_id, max_height, ffmpeg_code=None,
+                                 ticket=None):
+        """Download one batch item, optionally compress it, and upload the result."""
+        trace = JobTrace("ylc-batch" if ffmpeg_code else "yl-batch", user_id)
+        workspace = Workspace(trace.job_id)
+        sanitized_title = re.sub(r'[^\w\-_\.]', '_', item.title).strip()
+        input_path = workspace.file(f"{item.index:03d}_{sanitized_title}.mp4")
+        output_path = workspace.file(f"{item.index:03d}_{sanitized_title}_Compressed.mp4") if ffmpeg_code else None
+
+        try:
+            if ticket:
+                ticket.ensure_quota()
+            async with trace.stage("download") as span, self.bandwidth.flow("down", user_id) as down_flow:
+                success = await download_video(
+                    item.url, None, input_path, item_status, down_flow, format_spec=policy_format(max_height)
+                )
+                span.bytes = os.path.getsize(input_path) if os.path.exists(input_path) else None
+            if not success or not os.path.exists(input_path):
+                return False
+            if ticket:
+                await ticket.charge(os.path.getsize(input_path))
+
+            upload_path = input_path
+            caption = f"{item.index}. {item.title}"
+            if ffmpeg_code:
+                duration = await get_video_duration(input_path)
+                thumb_image_path = await take_screenshot(input_path, f"{input_path}.jpg")
+                async with trace.stage("dump_upload", os.path.getsize(input_path)), \
+                        self.bandwidth.flow("up", user_id) as up_flow:
+                    await self.send_video(
+                        DUMP_CHANNEL,
+                        input_path,
+                        duration=duration,
+                        caption=f"{sanitized_title}\nDuration: {duration} seconds",
+                        thumb=thumb_image_path,
+                        progress=self.helper.progress_for_pyrogram,
+                        progress_args=(item_status, time.time(), "📤 Uploading to dump channel", up_flow)
+                    )
+                async with trace.stage("encode", os.path.getsize(input_path)):
+                    if not await compress_video(input_path, output_path, ffmpeg_code, item_status, self):
+                        return False
+                upload_path = output_path
+                caption = f"{item.index}. {item.title} (Smashed)"
+
+            duration = await get_video_duration(upload_path)
+            thumb_image_path = await take_screenshot(upload_path, f"{upload_path}.jpg")
+            async with trace.stage("upload", os.path.getsize(upload_path)), \
+                    self.bandwidth.flow("up", user_id) as up_flow:
+                upload_msg = await self.send_video(
+                    chat_id,
+                    upload_path,
+                    caption=f"{caption}\nDuration: {duration} seconds",
+                    duration=duration,
+                    thumb=thumb_image_path,
+                    progress=self.helper.progress_for_pyrogram,
+                    progress_args=(item_status, time.time(), "📤 Uploading", up_flow)
+                )
+            if not ffmpeg_code:
+                await self.dump_upload(upload_msg)
+            return True
+        finally:
+            await self.save_trace(trace)
+            workspace.cleanup()
+
+    async def compress_batch(self, message: Message, inputs):
+        """Fetch every input concurrently, encode them one at a time and send the results back as albums."""
+        user_id = message.from_user.id
+        if not inputs:
+            await message.reply_text("No video/document messages found to compress.")
+            return
+        status_msg = await message.reply_text(f"📦 Compressing {len(inputs)} files...")
+        ffmpeg_code = await self.ffmpeg_code_for(user_id)
+        encode_lock = asyncio.Lock()
+        results = {}
+
+        items = []
+        for index, msg in enumerate(inputs, start=1):
+            media = msg.video or msg.document
+            item = BatchItem(index, f"message {msg.id}", media.file_name or f"file_{msg.id}", source=msg)
+            items.append(item)
+
+        ticket = await self.admit_job(
+            status_msg, user_id, sum((msg.video or msg.document).file_size or 0 for msg in inputs)
+        )
+        if ticket is None:
+            return
+        # One workspace for the batch: outputs have to outlive their item until the albums are sent
+        workspace = Workspace(f"batch_{user_id}", sum((msg.video or msg.document).file_size or 0 for msg in inputs))
+
+        async def process(item, item_status):
+            sanitized_title = re.sub(r'[^\w\-_\.]', '_', item.title).strip()
+            input_path = workspace.file(f"{item.source.id}_{sanitized_title}.mp4")
+            output_path = workspace.file(f"{item.source.id}_{sanitized_title}_Smashed.mp4")
+            trace = JobTrace("add-batch", user_id)
+            try:
+                if not os.path.exists(input_path):
+                    media = item.source.video or item.source.document
+                    async with trace.stage("download", media.file_size), \
+                            self.bandwidth.flow("down", user_id) as down_flow:
+                        await self.tg_downloader.download(
+                            item.source, input_path,
+                            progress=self.helper.progress_for_pyrogram,
+                            progress_args=(item_status, time.time(), "Downloading video", down_flow)
+                        )
+                    await ticket.charge(os.path.getsize(input_path))
+
+                await item_status.edit_text("🕓 Waiting for encoder")
+                async with encode_lock, trace.stage("encode", os.path.getsize(input_path)):
+                    success = await compress_video(input_path, output_path, ffmpeg_code, item_status, self)
+                if success and os.path.exists(output_path):
+                    results[item.index] = output_path
+                    clean_files(input_path)
+                    return True
+                clean_files(output_path)
+                return False
+            except Exception:
+                clean_files(input_path, output_path)
+                raise
+            finally:
+                await self.save_trace(trace)
+
+        runner = BatchRunner(
+            items, status_msg, process,
+            header=f"Compressing {len(items)} files",
+            concurrency=len(items)
+        )
+        batch_task = asyncio.create_task(runner.run())
+        self.tasks.append(batch_task)
+        try:
+            await batch_task
+            await self.app.forward_messages(
+                chat_id=DUMP_CHANNEL,
+                from_chat_id=message.chat.id,
+                message_ids=[msg.id for msg in inputs]
+            )
+
+            outputs = [(item, results[item.index]) for item in items if item.index in results]
+            if not outputs:
+                await status_msg.edit_text(runner.render() + "\n\nNothing to upload.")
+                return
+
+            await status_msg.edit_text(runner.render() + f"\n\n📤 Uploading {len(outputs)} files as album...")
+            media = []
+            for item, output_path in outputs:
+                duration = await get_video_duration(output_path)
+                thumb_path = await take_screenshot(output_path, f"{output_path}.jpg")
+                media.append(InputMediaVideo(
+                    output_path,
+                    thumb=thumb_path,
+                    caption=f"📹 {item.title} (Smashed)\n⏱️ Duration: {duration} seconds",
+                    duration=duration or 0,
+                    supports_streaming=True
+                ))
+
+            # Telegram albums hold at most 10 items
+            for start in range(0, len(media), 10):
+                await self.app.send_media_group(
+                    message.chat.id,
+                    media[start:start + 10],
+                    reply_to_message_id=message.id
+                )
+            await status_msg.delete()
+        except asyncio.CancelledError:
+            await status_msg.edit_text(runner.render() + "\n\nBatch cancelled!")
+            raise
+        except Exception as e:
+            await status_msg.edit_text(f"Error: {str(e)}")
+            logging.error(f"Error in compress_batch: {e}")
+        finally:
+            ticket.release()
+            if batch_task in self.tasks:
+                self.tasks.remove(batch_task)
+            workspace.cleanup()
 
     async def run(self):
+        watchdog.start()
+        purge_workspaces()
+        await self.access.load()
         await self.app.start()
+        if self.upload_pool:
+            await self.upload_pool.start()
+        profiler.mark("client_started")
         logging.info("Bot is running...")
         await asyncio.Event().wait()
 
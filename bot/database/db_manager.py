@@ -5,10 +5,6 @@ from config import DB_NAME, DEFAULT_FFMPEG
 
 # Initialize logger
 LOGGER = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-)
 
 class Database:
     def __init__(self):
@@ -37,6 +33,55 @@ class Database:
                     ffmpeg_code TEXT
                 )
             ''')
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS daily_usage (
+                    user_id INTEGER,
+                    day TEXT,
+                    bytes INTEGER DEFAULT 0,
+                    PRIMARY KEY (user_id, day)
+                )
+            ''')
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS job_stages (
+                    job_id TEXT,
+                    kind TEXT,
+                    user_id INTEGER,
+                    stage TEXT,
+                    started REAL,
+                    ended REAL,
+                    bytes INTEGER,
+                    fps REAL,
+                    retries INTEGER DEFAULT 0,
+                    status TEXT
+                )
+            ''')
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_job_stages_stage_started ON job_stages (stage, started)"
+            )
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_job_stages_job ON job_stages (job_id)")
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS format_picks (
+                    user_id INTEGER,
+                    height INTEGER,
+                    picks INTEGER DEFAULT 0,
+                    PRIMARY KEY (user_id, height)
+                )
+            ''')
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS encoder_calibration (
+                    host TEXT,
+                    encoder TEXT,
+                    preset TEXT,
+                    threads INTEGER,
+                    clip TEXT,
+                    fps REAL,
+                    speed REAL,
+                    bitrate REAL,
+                    ssim REAL,
+                    measured_at REAL,
+                    PRIMARY KEY (host, encoder, preset, threads, clip)
+                )
+            ''')
             await conn.commit()
         LOGGER.info("Database tables created or verified.")
 
@@ -70,6 +115,12 @@ class Database:
             result = await cursor.fetchone()
             return result is not None
 
+    async def get_authorized_users(self):
+        """Return the ids of all authorized users."""
+        async with aiosqlite.connect(self.db_name) as conn:
+            cursor = await conn.execute("SELECT user_id FROM authorized_users")
+            return [row[0] for row in await cursor.fetchall()]
+
     async def add_authorized_group(self, group_id):
         """Add a group to the authorized_groups table."""
         async with aiosqlite.connect(self.db_name) as conn:
@@ -100,6 +151,139 @@ class Database:
             result = await cursor.fetchone()
             return result is not None
 
+    async def get_authorized_groups(self):
+        """Return the ids of all authorized groups."""
+        async with aiosqlite.connect(self.db_name) as conn:
+            cursor = await conn.execute("SELECT group_id FROM authorized_groups")
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def add_usage(self, user_id, day, num_bytes):
+        """Add transferred bytes to a user's usage for `day` (YYYY-MM-DD)."""
+        async with aiosqlite.connect(self.db_name) as conn:
+            await conn.execute(
+                '''
+                INSERT INTO daily_usage (user_id, day, bytes)
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id, day) DO UPDATE SET bytes = bytes + excluded.bytes
+                ''',
+                (user_id, day, num_bytes)
+            )
+            await conn.commit()
+
+    async def get_usage(self, day):
+        """Return {user_id: bytes} for `day` (YYYY-MM-DD)."""
+        async with aiosqlite.connect(self.db_name) as conn:
+            cursor = await conn.execute(
+                "SELECT user_id, bytes FROM daily_usage WHERE day = ?",
+                (day,)
+            )
+            return {user_id: num_bytes for user_id, num_bytes in await cursor.fetchall()}
+
+    async def add_format_pick(self, user_id, height):
+        """Count a format button press at `height` for prefetch predictions."""
+        async with aiosqlite.connect(self.db_name) as conn:
+            await conn.execute(
+                '''
+                INSERT INTO format_picks (user_id, height, picks)
+                VALUES (?, ?, 1)
+                ON CONFLICT(user_id, height) DO UPDATE SET picks = picks + 1
+                ''',
+                (user_id, height)
+            )
+            await conn.commit()
+
+    async def get_format_picks(self, user_id):
+        """Return {height: picks} for a user."""
+        async with aiosqlite.connect(self.db_name) as conn:
+            cursor = await conn.execute(
+                "SELECT height, picks FROM format_picks WHERE user_id = ?",
+                (user_id,)
+            )
+            return {height: picks for height, picks in await cursor.fetchall()}
+
+    async def save_calibration(self, host, results):
+        """Replace `host`'s calibration with `results`, dicts as produced by calibration.run_calibration."""
+        async with aiosqlite.connect(self.db_name) as conn:
+            await conn.execute("DELETE FROM encoder_calibration WHERE host = ?", (host,))
+            await conn.executemany(
+                '''
+                INSERT INTO encoder_calibration
+                (host, encoder, preset, threads, clip, fps, speed, bitrate, ssim, measured_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''',
+                [
+                    (host, r["encoder"], r["preset"], r["threads"], r["clip"], r["fps"], r["speed"],
+                     r["bitrate"], r["ssim"], r["measured_at"])
+                    for r in results
+                ]
+            )
+            await conn.commit()
+
+    async def get_calibration(self, host):
+        """Return `host`'s calibration rows as dicts (encoder, preset, threads, clip, fps, speed, bitrate, ssim)."""
+        async with aiosqlite.connect(self.db_name) as conn:
+            cursor = await conn.execute(
+                '''
+                SELECT encoder, preset, threads, clip, fps, speed, bitrate, ssim, measured_at
+                FROM encoder_calibration WHERE host = ?
+                ''',
+                (host,)
+            )
+            columns = ["encoder", "preset", "threads", "clip", "fps", "speed", "bitrate", "ssim", "measured_at"]
+            return [dict(zip(columns, row)) for row in await cursor.fetchall()]
+
+    async def save_job_trace(self, trace, spans):
+        """Store the spans of a finished JobTrace, one row per stage."""
+        async with aiosqlite.connect(self.db_name) as conn:
+            await conn.executemany(
+                '''
+                INSERT INTO job_stages (job_id, kind, user_id, stage, started, ended, bytes, fps, retries, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''',
+                [
+                    (trace.job_id, trace.kind, trace.user_id, span.name, span.started, span.ended,
+                     span.bytes, span.fps, span.retries, span.status)
+                    for span in spans
+                ]
+            )
+            await conn.commit()
+
+    async def get_stage_durations(self, since):
+        """Return [(stage, seconds)] for every stage started after `since` (unix time)."""
+        async with aiosqlite.connect(self.db_name) as conn:
+            cursor = await conn.execute(
+                "SELECT stage, ended - started FROM job_stages WHERE started >= ? AND ended IS NOT NULL",
+                (since,)
+            )
+            return await cursor.fetchall()
+
+    async def get_slowest_jobs(self, since, limit=5):
+        """Return the slowest jobs started after `since` with their stages.
+
+        Each entry is (job_id, kind, user_id, seconds, status, [(stage, seconds, bytes, fps, retries)]).
+        """
+        async with aiosqlite.connect(self.db_name) as conn:
+            cursor = await conn.execute(
+                '''
+                SELECT job_id, kind, user_id, ended - started, status FROM job_stages
+                WHERE stage = 'job' AND started >= ? AND ended IS NOT NULL
+                ORDER BY ended - started DESC LIMIT ?
+                ''',
+                (since, limit)
+            )
+            jobs = await cursor.fetchall()
+            result = []
+            for job_id, kind, user_id, seconds, status in jobs:
+                cursor = await conn.execute(
+                    '''
+                    SELECT stage, ended - started, bytes, fps, retries FROM job_stages
+                    WHERE job_id = ? AND stage != 'job' ORDER BY started
+                    ''',
+                    (job_id,)
+                )
+                result.append((job_id, kind, user_id, seconds, status, await cursor.fetchall()))
+            return result
+
     async def set_ffmpeg_code(self, user_id, ffmpeg_code):
         """Set or update the ffmpeg code for a specific user."""
         async with aiosqlite.connect(self.db_name) as conn:
@@ -123,7 +307,7 @@ class Database:
             )
             result = await cursor.fetchone()
             ffmpeg_code = result[0] if result else DEFAULT_FFMPEG
-        LOGGER.info(f"Retrieved FFmpeg code for user {user_id}: {ffmpeg_code}")
+        LOGGER.debug(f"Retrieved FFmpeg code for user {user_id}: {ffmpeg_code}")
         return ffmpeg_code
 
 
@@ -0,0 +1,154 @@
+import datetime
+import logging
+from pyrogram import filters
+from pyrogram.types import CallbackQuery
+from config import AUTH_USERS, MAX_JOBS_PER_USER, DAILY_BYTES_PER_USER, MAX_INPUT_SIZE
+
+LOGGER = logging.getLogger(__name__)
+
+
+class QuotaExceeded(Exception):
+    """A job was refused by admission control; the message is shown to the user."""
+
+
+def format_bytes(num_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if num_bytes < 1024:
+            return f"{num_bytes:.2f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.2f} TB"
+
+
+class JobTicket:
+    """One admitted job: holds a concurrency slot and a byte reservation until released."""
+
+    def __init__(self, access, user_id, reserved):
+        self.access = access
+        self.user_id = user_id
+        self.reserved = reserved
+        self.released = False
+
+    async def charge(self, num_bytes):
+        """Record bytes the job actually moved against the user's daily quota, releasing as much reservation."""
+        settled = min(num_bytes, self.reserved)
+        self.reserved -= settled
+        self.access.finish(self.user_id, settled, jobs=0)
+        await self.access.charge(self.user_id, num_bytes)
+
+    def ensure_quota(self):
+        """Raise QuotaExceeded if the user has already used up today's bytes (checked between batch items)."""
+        self.access.check_bytes(self.user_id, 0, self.reserved)
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.access.finish(self.user_id, self.reserved)
+
+
+class AccessControl:
+    """Authorization and per-user quotas served from memory.
+
+    Authorized users/groups and today's usage are loaded from `Database` once at startup and kept
+    in sync by the methods here, so the handler filter never touches SQLite.
+    """
+
+    def __init__(self, db, owners=AUTH_USERS, max_jobs=MAX_JOBS_PER_USER,
+                 daily_bytes=DAILY_BYTES_PER_USER, max_input=MAX_INPUT_SIZE):
+        self.db = db
+        self.owners = set(owners)
+        self.max_jobs = max_jobs
+        self.daily_bytes = daily_bytes
+        self.max_input = max_input
+        self.users = set()
+        self.groups = set()
+        self.active = {}
+        self.reserved = {}
+        self.day = datetime.date.today().isoformat()
+        self.usage = {}
+        self.filter = filters.create(self._filter, "AuthorizedFilter", access=self)
+
+    async def load(self):
+        self.users = set(await self.db.get_authorized_users())
+        self.groups = set(await self.db.get_authorized_groups())
+        self.day = datetime.date.today().isoformat()
+        self.usage = await self.db.get_usage(self.day)
+        LOGGER.info(f"Loaded {len(self.users)} authorized users and {len(self.groups)} groups")
+
+    @staticmethod
+    async def _filter(flt, _, update):
+        message = update.message if isinstance(update, CallbackQuery) else update
+        user = update.from_user
+        chat = message.chat if message else None
+        return flt.access.is_authorized(user.id if user else None, chat.id if chat else None)
+
+    def is_authorized(self, user_id, chat_id=None):
+        if user_id is not None and (user_id in self.owners or user_id in self.users):
+            return True
+        return chat_id is not None and chat_id in self.groups
+
+    async def authorize(self, chat_id):
+        """Authorize a user, or a group when `chat_id` is negative."""
+        if chat_id < 0:
+            await self.db.add_authorized_group(chat_id)
+            self.groups.add(chat_id)
+        else:
+            await self.db.add_authorized_user(chat_id)
+            self.users.add(chat_id)
+
+    async def unauthorize(self, chat_id):
+        if chat_id < 0:
+            await self.db.remove_authorized_group(chat_id)
+            self.groups.discard(chat_id)
+        else:
+            await self.db.remove_authorized_user(chat_id)
+            self.users.discard(chat_id)
+
+    def _roll_day(self):
+        today = datetime.date.today().isoformat()
+        if today != self.day:
+            self.day = today
+            self.usage = {}
+
+    def used_today(self, user_id):
+        self._roll_day()
+        return self.usage.get(user_id, 0)
+
+    def check_bytes(self, user_id, expected_bytes, own_reservation=0):
+        if user_id in self.owners or not self.daily_bytes:
+            return
+        committed = self.used_today(user_id) + self.reserved.get(user_id, 0) - own_reservation
+        if committed + expected_bytes > self.daily_bytes:
+            raise QuotaExceeded(
+                f"Daily quota exceeded: {format_bytes(committed)} used or reserved of "
+                f"{format_bytes(self.daily_bytes)}"
+                + (f", this job needs {format_bytes(expected_bytes)}" if expected_bytes else "")
+            )
+
+    def admit(self, user_id, expected_bytes=0) -> JobTicket:
+        """Admit a job expected to move `expected_bytes` (0 if unknown) or raise QuotaExceeded."""
+        if user_id not in self.owners:
+            if self.max_input and expected_bytes > self.max_input:
+                raise QuotaExceeded(
+                    f"File too large: {format_bytes(expected_bytes)} (limit {format_bytes(self.max_input)})"
+                )
+            if self.max_jobs and self.active.get(user_id, 0) >= self.max_jobs:
+                raise QuotaExceeded(f"You already have {self.max_jobs} jobs running, wait for one to finish")
+            self.check_bytes(user_id, expected_bytes)
+        self.active[user_id] = self.active.get(user_id, 0) + 1
+        self.reserved[user_id] = self.reserved.get(user_id, 0) + expected_bytes
+        return JobTicket(self, user_id, expected_bytes)
+
+    def finish(self, user_id, reserved, jobs=1):
+        self.active[user_id] = max(0, self.active.get(user_id, 0) - jobs)
+        self.reserved[user_id] = max(0, self.reserved.get(user_id, 0) - reserved)
+
+    async def charge(self, user_id, num_bytes):
+        if not num_bytes:
+            return
+        self._roll_day()
+        self.usage[user_id] = self.usage.get(user_id, 0) + num_bytes
+        try:
+            await self.db.add_usage(user_id, self.day, num_bytes)
+        except Exception as e:
+            LOGGER.error(f"Failed to record usage for {user_id}: {e}")
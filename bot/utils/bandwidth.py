@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import threading
+import time
+from config import BANDWIDTH_UP, BANDWIDTH_DOWN, BANDWIDTH_USER_WEIGHTS, BANDWIDTH_FINISH_BOOST, PREFETCH_BANDWIDTH
+
+LOGGER = logging.getLogger(__name__)
+
+# A transfer counts as "finishing" once this fraction of it is done
+FINISHING_THRESHOLD = 0.9
+
+
+class TokenBucket:
+    """Token bucket measured in bytes; a rate of 0 means unlimited."""
+
+    def __init__(self, rate: float = 0):
+        self.rate = rate
+        self.capacity = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def set_rate(self, rate: float):
+        """Change the refill rate, keeping at most one second of burst."""
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            self.capacity = rate
+            self.tokens = min(self.tokens, self.capacity)
+
+    def reserve(self, amount: int) -> float:
+        """Take `amount` tokens (going into debt if needed) and return the seconds to wait."""
+        with self._lock:
+            if self.rate <= 0:
+                return 0
+            self._refill()
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class BandwidthFlow:
+    """One transfer's share of a channel; closed when the transfer ends."""
+
+    def __init__(self, channel, user_id, weight: float):
+        self.channel = channel
+        self.user_id = user_id
+        self.weight = weight
+        self.bucket = TokenBucket()
+        self.finishing = False
+        self.transferred = 0
+        self.waited = 0.0
+        self.started = time.monotonic()
+        self._position = 0
+        self._closed = False
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    @property
+    def limited(self) -> bool:
+        return self.channel.rate > 0
+
+    def speed(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.transferred / elapsed if elapsed > 0 else 0
+
+    def _reserve(self, amount: int) -> float:
+        self.transferred += amount
+        self.channel.transferred += amount
+        delay = self.bucket.reserve(amount)
+        self.waited += delay
+        return delay
+
+    async def consume(self, amount: int):
+        """Account for `amount` bytes, sleeping until the flow's budget allows them."""
+        delay = self._reserve(amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def consume_threadsafe(self, amount: int):
+        """Blocking variant of consume() for transfers running in executor threads."""
+        delay = self._reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+    def set_progress(self, current, total):
+        """Mark the flow as finishing once it is close to done so it gets a bigger share."""
+        finishing = bool(total) and current / total >= FINISHING_THRESHOLD
+        if finishing != self.finishing:
+            self.finishing = finishing
+            self.channel.rebalance()
+
+    def _advance(self, position) -> int:
+        # Positions restart from zero when the same flow moves on to another file
+        delta = position - self._position if position >= self._position else position
+        self._position = position
+        return delta
+
+    async def advance(self, position, total=None):
+        """Consume the bytes between the last reported position and `position`."""
+        if total:
+            self.set_progress(position, total)
+        delta = self._advance(position)
+        if delta > 0:
+            await self.consume(delta)
+
+    def advance_threadsafe(self, position, total=None):
+        """Blocking variant of advance() for progress hooks called from threads."""
+        if total:
+            self.set_progress(position, total)
+        delta = self._advance(position)
+        if delta > 0:
+            self.consume_threadsafe(delta)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.channel.unregister(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class BandwidthChannel:
+    """A direction (up or down) whose budget is split across active flows by weight."""
+
+    def __init__(self, name: str, rate: float):
+        self.name = name
+        self.rate = rate
+        self.flows = []
+        self.transferred = 0
+        self._lock = threading.Lock()
+
+    def register(self, flow):
+        with self._lock:
+            self.flows.append(flow)
+            self._rebalance()
+
+    def unregister(self, flow):
+        with self._lock:
+            if flow in self.flows:
+                self.flows.remove(flow)
+            self._rebalance()
+
+    def rebalance(self):
+        with self._lock:
+            self._rebalance()
+
+    def _rebalance(self):
+        if self.rate <= 0 or not self.flows:
+            return
+        # A user's weight is split across their own flows, so ten parallel
+        # connections from one job get no more than a single connection would.
+        per_user = {}
+        for flow in self.flows:
+            per_user[flow.user_id] = per_user.get(flow.user_id, 0) + 1
+        shares = [
+            flow.weight / per_user[flow.user_id] * (BANDWIDTH_FINISH_BOOST if flow.finishing else 1)
+            for flow in self.flows
+        ]
+        total = sum(shares)
+        for flow, share in zip(self.flows, shares):
+            flow.bucket.set_rate(self.rate * share / total)
+
+    def stats(self) -> dict:
+        with self._lock:
+            flows = list(self.flows)
+        return {
+            "limit": self.rate,
+            "active": len(flows),
+            "users": len({flow.user_id for flow in flows}),
+            "throughput": sum(flow.speed() for flow in flows),
+            "transferred": self.transferred,
+            "waited": sum(flow.waited for flow in flows),
+        }
+
+
+class BandwidthManager:
+    """Shared up/down budgets that every transfer path draws from."""
+
+    def __init__(self, up_rate=BANDWIDTH_UP, down_rate=BANDWIDTH_DOWN, user_weights=None,
+                 prefetch_rate=PREFETCH_BANDWIDTH):
+        self.channels = {
+            "up": BandwidthChannel("up", up_rate),
+            "down": BandwidthChannel("down", down_rate),
+            # Speculative downloads share their own budget on top of drawing from "down"
+            "prefetch": BandwidthChannel("prefetch", prefetch_rate),
+        }
+        self.user_weights = BANDWIDTH_USER_WEIGHTS if user_weights is None else user_weights
+        LOGGER.info(f"Bandwidth limits: up={up_rate or 'unlimited'} B/s, down={down_rate or 'unlimited'} B/s")
+
+    def flow(self, direction: str, user_id, weight: float = None) -> BandwidthFlow:
+        """Open a flow in `direction` ("up", "down" or "prefetch"); close it or use it with `async with`."""
+        channel = self.channels[direction]
+        if weight is None:
+            weight = self.user_weights.get(user_id, 1.0)
+        flow = BandwidthFlow(channel, user_id, weight)
+        channel.register(flow)
+        return flow
+
+    def stats(self) -> dict:
+        return {name: channel.stats() for name, channel in self.channels.items()}
+
+
+def describe_flow(flow, format_size) -> str:
+    """One-line bandwidth summary for progress messages, empty when the channel is unlimited."""
+    if flow is None or not flow.limited:
+        return ""
+    stats = flow.channel.stats()
+    return (
+        f"\n🚦 Share: {format_size(flow.rate)}/s of {format_size(stats['limit'])}/s "
+        f"({stats['active']} active{', finishing' if flow.finishing else ''})"
+    )
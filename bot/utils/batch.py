@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import re
+import time
+from config import BATCH_CONCURRENCY, BATCH_RETRIES, BATCH_DEFAULT_HEIGHT
+from .tg_calls import background
+
+LOGGER = logging.getLogger(__name__)
+
+STATE_ICONS = {"queued": "🕓", "running": "⏳", "done": "✅", "failed": "❌"}
+
+
+def parse_batch_args(text):
+    """Split command arguments into URLs and an optional `-q <height>` format policy."""
+    tokens = text.split()
+    urls = []
+    max_height = None
+    i = 0
+    while i < len(tokens):
+        if tokens[i] == "-q" and i + 1 < len(tokens):
+            max_height = int(re.sub(r"\D", "", tokens[i + 1]) or BATCH_DEFAULT_HEIGHT)
+            i += 2
+            continue
+        urls.append(tokens[i])
+        i += 1
+    return urls, max_height
+
+
+def is_playlist_url(url):
+    return "list=" in url or "/playlist" in url
+
+
+def policy_format(max_height):
+    """Full yt-dlp selector for "best ≤ max_height", the progressive fallback capped as well."""
+    return f"bestvideo[height<={max_height}]+bestaudio/best[height<={max_height}]"
+
+
+class BatchItem:
+    def __init__(self, index, url, title, source=None):
+        self.index = index
+        self.url = url
+        self.title = title
+        self.source = source
+        self.state = "queued"
+        self.attempts = 0
+        self.line = ""
+        self.error = None
+
+
+class ItemStatus:
+    """Stands in for a status message so per-item progress lands in the batch summary."""
+
+    def __init__(self, item):
+        self.item = item
+        self.text = ""
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        lines = [line.strip() for line in re.sub(r"<[^>]+>", "", text).splitlines() if line.strip()]
+        if not lines:
+            return
+        summary = lines[0]
+        bar = next((line for line in lines[1:] if "%" in line), None)
+        self.item.line = f"{summary} {bar}" if bar else summary
+
+    async def delete(self):
+        pass
+
+
+class BatchRunner:
+    """Runs batch items with bounded concurrency, per-item retry and one aggregated status message."""
+
+    def __init__(self, items, status_msg, process, header, concurrency=BATCH_CONCURRENCY,
+                 retries=BATCH_RETRIES, update_interval=5):
+        self.items = items
+        self.status_msg = status_msg
+        self.process = process
+        self.header = header
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.retries = retries
+        self.update_interval = update_interval
+        self.start_time = time.time()
+
+    def render(self):
+        counts = {state: 0 for state in STATE_ICONS}
+        for item in self.items:
+            counts[item.state] += 1
+        lines = [
+            f"<b>📦 {self.header}</b>",
+            f"{counts['done']}/{len(self.items)} done, {counts['running']} running, "
+            f"{counts['failed']} failed",
+            "",
+        ]
+        # Completed items are only counted so long playlists stay under Telegram's message limit
+        shown = [item for item in self.items if item.state in ("running", "failed")]
+        shown += [item for item in self.items if item.state == "queued"][:3]
+        for item in sorted(shown, key=lambda item: item.index):
+            line = f"{STATE_ICONS[item.state]} {item.index}. {item.title[:40]}"
+            if item.state == "running" and item.line:
+                line += f"\n    {item.line}"
+            elif item.state == "failed" and item.error:
+                line += f" ({item.error[:60]})"
+            if item.attempts > 1:
+                line += f" [try {item.attempts}]"
+            lines.append(line)
+        return "\n".join(lines)
+
+    async def update_status(self):
+        try:
+            await background(self.status_msg.edit_text(self.render()))
+        except Exception as e:
+            LOGGER.error(f"Failed to update batch status: {e}")
+
+    async def _status_loop(self):
+        while True:
+            await asyncio.sleep(self.update_interval)
+            await self.update_status()
+
+    async def _run_item(self, item):
+        async with self.semaphore:
+            item.state = "running"
+            while True:
+                item.attempts += 1
+                try:
+                    if await self.process(item, ItemStatus(item)):
+                        item.state = "done"
+                        return
+                    item.error = item.line or "failed"
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    LOGGER.error(f"Batch item {item.index} ({item.url}) failed: {e}")
+                    item.error = str(e)
+                if item.attempts > self.retries:
+                    item.state = "failed"
+                    return
+                await asyncio.sleep(5 * item.attempts)
+
+    async def run(self):
+        """Process every item; returns the number of items that completed."""
+        status_task = asyncio.create_task(self._status_loop())
+        try:
+            await asyncio.gather(*(self._run_item(item) for item in self.items))
+        finally:
+            status_task.cancel()
+        done = sum(1 for item in self.items if item.state == "done")
+        await self.update_status()
+        return done
@@ -0,0 +1,241 @@
+import logging
+import os
+import re
+import socket
+import time
+from config import (
+    CALIBRATION_SECONDS, CALIBRATION_ENCODERS, CALIBRATION_PRESETS, CALIBRATION_THREADS, CALIBRATION_CRF,
+    PRESET_AUTO_TARGET, PRESET_AUTO_FALLBACK
+)
+from .subprocesses import run_process
+
+LOGGER = logging.getLogger(__name__)
+
+CLIP_SIZE = "1280x720"
+CLIP_RATE = 30
+# Synthetic sources every host can generate identically, so curves from different machines compare
+CLIPS = {
+    # Sharp moving graphics: cheap motion search, hard edges
+    "graphics": f"testsrc2=size={CLIP_SIZE}:rate={CLIP_RATE}",
+    # The same with temporal grain, which is what makes real footage expensive to encode
+    "grain": f"testsrc2=size={CLIP_SIZE}:rate={CLIP_RATE},noise=alls=25:allf=t+u",
+}
+AUTO_PRESET = re.compile(r"-preset\s+auto(?::(speed|ssim)=([\d.]+))?")
+VIDEO_ENCODER = re.compile(r"-(?:c:v|vcodec|codec:v)\s+(\S+)")
+SSIM_ALL = re.compile(r"SSIM .*All:([\d.]+)")
+
+
+class CalibrationError(Exception):
+    """A calibration encode failed; the message is shown to the owner."""
+
+
+def default_thread_counts():
+    """0 (the encoder decides) plus powers of two up to the CPU count."""
+    counts, threads = [0], 1
+    while threads <= (os.cpu_count() or 1):
+        counts.append(threads)
+        threads *= 2
+    return counts
+
+
+def thread_args(encoder, threads):
+    """Encoder arguments for a thread count; x265 sizes its own pools and ignores -threads."""
+    if not threads:
+        return []
+    if encoder == "libx265":
+        return ["-x265-params", f"pools={threads}"]
+    return ["-threads", str(threads)]
+
+
+async def run_ffmpeg(*args):
+    """Run ffmpeg with `args`; returns stdout + stderr, raises CalibrationError with the tail on failure."""
+    returncode, stdout, stderr = await run_process("ffmpeg", "-hide_banner", *args)
+    stderr = stderr.decode(errors="ignore")
+    if returncode != 0:
+        LOGGER.error(f"Calibration ffmpeg failed: {stderr[-500:]}")
+        raise CalibrationError(f"ffmpeg failed with exit code {returncode}")
+    return stdout.decode(errors="ignore") + stderr
+
+
+async def available_encoders(wanted):
+    listing = await run_ffmpeg("-encoders")
+    return [encoder for encoder in wanted if re.search(rf"\s{re.escape(encoder)}\s", listing)]
+
+
+async def make_clips(workdir, seconds=CALIBRATION_SECONDS):
+    """Render the synthetic clips losslessly, so measurements include decoding like a real job."""
+    paths = {}
+    for name, source in CLIPS.items():
+        path = os.path.join(workdir, f"{name}.mkv")
+        await run_ffmpeg(
+            "-y", "-v", "error", "-f", "lavfi", "-i", source, "-t", str(seconds),
+            "-c:v", "libx264", "-preset", "ultrafast", "-qp", "0", path
+        )
+        paths[name] = path
+    return paths
+
+
+async def measure(clip_path, seconds, encoder, preset, threads, crf, workdir):
+    """Encode one clip with one setting; returns frames per second, x realtime, bitrate and SSIM."""
+    output = os.path.join(workdir, f"out_{encoder}_{preset}_{threads}.mp4")
+    started = time.perf_counter()
+    await run_ffmpeg(
+        "-y", "-v", "error", "-i", clip_path, "-an", "-c:v", encoder, "-preset", preset,
+        "-crf", str(crf), *thread_args(encoder, threads), output
+    )
+    elapsed = time.perf_counter() - started
+    # Timebases differ between the MP4 and the MKV source, so align them before comparing frames
+    stderr = await run_ffmpeg(
+        "-i", output, "-i", clip_path,
+        "-lavfi", "[0:v]settb=AVTB[a];[1:v]settb=AVTB[b];[a][b]ssim", "-f", "null", "-"
+    )
+    match = SSIM_ALL.search(stderr)
+    size = os.path.getsize(output)
+    os.remove(output)
+    return {
+        "fps": seconds * CLIP_RATE / elapsed,
+        "speed": seconds / elapsed,
+        "bitrate": size * 8 / seconds,
+        "ssim": float(match.group(1)) if match else None,
+    }
+
+
+async def run_calibration(workdir, encoders=None, presets=None, threads=None, seconds=CALIBRATION_SECONDS,
+                          crf=CALIBRATION_CRF, progress=None):
+    """Measure every encoder x preset x thread count on every clip, one encode at a time.
+
+    `progress(done, total, label)` is awaited before each run. Returns one dict per run.
+    """
+    encoders = await available_encoders(encoders or CALIBRATION_ENCODERS)
+    if not encoders:
+        raise CalibrationError("None of the requested encoders is available in this FFmpeg build")
+    presets = presets or CALIBRATION_PRESETS
+    threads = threads or CALIBRATION_THREADS or default_thread_counts()
+    clips = await make_clips(workdir, seconds)
+
+    matrix = [(e, p, t, c) for e in encoders for p in presets for t in threads for c in clips]
+    results = []
+    for done, (encoder, preset, thread_count, clip) in enumerate(matrix):
+        if progress is not None:
+            await progress(done, len(matrix), f"{encoder} {preset} threads={thread_count or 'auto'} ({clip})")
+        result = await measure(clips[clip], seconds, encoder, preset, thread_count, crf, workdir)
+        result.update(encoder=encoder, preset=preset, threads=thread_count, clip=clip, measured_at=time.time())
+        results.append(result)
+    return results
+
+
+def curves(rows, encoder):
+    """Per (preset, threads) for `encoder`: the slowest clip's speed and the mean SSIM and bitrate."""
+    grouped = {}
+    for row in rows:
+        if row["encoder"] == encoder:
+            grouped.setdefault((row["preset"], row["threads"]), []).append(row)
+    result = []
+    for (preset, threads), runs in grouped.items():
+        scores = [run["ssim"] for run in runs if run["ssim"] is not None]
+        result.append({
+            "preset": preset,
+            "threads": threads,
+            "speed": min(run["speed"] for run in runs),
+            "ssim": sum(scores) / len(scores) if scores else 0.0,
+            "bitrate": sum(run["bitrate"] for run in runs) / len(runs),
+        })
+    return result
+
+
+def pareto(points):
+    """Points no other point beats on both speed and SSIM."""
+    return [
+        p for p in points
+        if not any(
+            q["speed"] >= p["speed"] and q["ssim"] >= p["ssim"] and (q["speed"], q["ssim"]) != (p["speed"], p["ssim"])
+            for q in points
+        )
+    ]
+
+
+def parse_target(text):
+    """("speed", 1.5) from "speed=1.5"; ("ssim", 0.97) from "ssim=0.97"."""
+    kind, _, value = text.partition("=")
+    if kind not in ("speed", "ssim") or not value:
+        raise ValueError(f"Bad preset target: {text}")
+    return kind, float(value)
+
+
+def choose(points, kind, value):
+    """The calibrated point for a target, or None without data.
+
+    A speed target gets the best quality that still encodes at least `value` x realtime; a
+    quality target gets the fastest setting reaching SSIM `value`. When nothing meets the
+    target, the closest point (fastest, or best quality) is returned.
+    """
+    if not points:
+        return None
+    if kind == "speed":
+        meeting = [p for p in points if p["speed"] >= value]
+        if not meeting:
+            return max(points, key=lambda p: p["speed"])
+        return max(meeting, key=lambda p: (round(p["ssim"], 3), p["speed"]))
+    meeting = [p for p in points if p["ssim"] >= value]
+    if not meeting:
+        return max(points, key=lambda p: p["ssim"])
+    return max(meeting, key=lambda p: p["speed"])
+
+
+class PresetTuner:
+    """Rewrites "-preset auto[:speed=X|:ssim=Y]" in FFmpeg codes with this host's calibrated choice."""
+
+    def __init__(self, db, host=None, target=PRESET_AUTO_TARGET, fallback=PRESET_AUTO_FALLBACK):
+        self.db = db
+        self.host = host or socket.gethostname()
+        self.target = parse_target(target)
+        self.fallback = fallback
+        self.rows = None
+        self.running = False
+
+    async def load(self):
+        self.rows = await self.db.get_calibration(self.host)
+        return self.rows
+
+    async def save(self, results):
+        await self.db.save_calibration(self.host, results)
+        self.rows = results
+
+    async def resolve(self, ffmpeg_code):
+        """`ffmpeg_code` with an auto preset replaced; codes without one are returned unchanged."""
+        match = AUTO_PRESET.search(ffmpeg_code or "")
+        if not match:
+            return ffmpeg_code
+        if self.rows is None:
+            await self.load()
+        kind, value = (match.group(1), float(match.group(2))) if match.group(1) else self.target
+        encoder_match = VIDEO_ENCODER.search(ffmpeg_code)
+        encoder = encoder_match.group(1) if encoder_match else "libx264"
+        point = choose(curves(self.rows, encoder), kind, value)
+        if point is None:
+            LOGGER.warning(f"No calibration for {encoder} on {self.host}, using -preset {self.fallback}")
+            return ffmpeg_code[:match.start()] + f"-preset {self.fallback}" + ffmpeg_code[match.end():]
+
+        replacement = f"-preset {point['preset']}"
+        # The user's own thread settings win over the calibrated count
+        if not re.search(r"-threads\s|-x265-params\s", ffmpeg_code):
+            replacement = " ".join([replacement, *thread_args(encoder, point["threads"])])
+        LOGGER.info(
+            f"Auto preset for {encoder} ({kind}>={value}): {point['preset']} threads={point['threads'] or 'auto'}, "
+            f"{point['speed']:.2f}x realtime, SSIM {point['ssim']:.4f}"
+        )
+        return ffmpeg_code[:match.start()] + replacement + ffmpeg_code[match.end():]
+
+    def describe(self):
+        """The calibrated trade-off curve per encoder, skipping settings beaten on both speed and SSIM."""
+        if not self.rows:
+            return "No calibration stored for this host yet. Run /calibrate."
+        lines = []
+        for encoder in sorted({row["encoder"] for row in self.rows}):
+            lines.append(f"<b>{encoder}</b> on {self.host}")
+            for point in sorted(pareto(curves(self.rows, encoder)), key=lambda p: -p["speed"]):
+                lines.append(
+                    f"  {point['preset']} t={point['threads'] or 'auto'}: {point['speed']:.2f}x, "
+                    f"SSIM {point['ssim']:.4f}, {point['bitrate'] / 1e6:.1f} Mb/s"
+                )
+        return "\n".join(lines)
@@ -5,12 +5,13 @@ import re
 import logging
 from datetime import timedelta
 import subprocess
+from config import LADDER_PRESET, AUDIO_BITRATE
+from .subprocesses import run_process
+from .tg_calls import background
+from .tracing import note_fps
+from .workspace import partial_path, commit_file
 
 LOGGER = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-)
 
 def format_time(seconds):
     return str(timedelta(seconds=int(seconds)))
@@ -20,7 +21,11 @@ def create_progress_bar(percentage, width=30):
     bar = '█' * filled + '░' * (width - filled)
     return f'[{bar}] {percentage:.1f}%'
 
-async def compress_video(input_path, output_path, ffmpeg_code, status_msg, self):
+# Fragmented MP4 with an empty moov up front: the file is only ever appended to, so it can be
+# uploaded while FFmpeg is still writing it. Placed after the user's options, so it wins over +faststart.
+FRAGMENTED_MP4_FLAGS = "-movflags +frag_keyframe+empty_moov+default_base_moof"
+
+async def compress_video(input_path, output_path, ffmpeg_code, status_msg, self, fragmented=False):
     if not os.path.exists(input_path):
         await status_msg.edit_text("❌ Input file does not exist.")
         return False
@@ -35,11 +40,15 @@ async def compress_video(input_path, output_path, ffmpeg_code, status_msg, self)
     with open(progress_file, 'w') as f:
         pass
 
+    # Encode next to the final name and rename on success, so a half-written output is never picked up
+    partial_output = partial_path(output_path)
+    if fragmented:
+        ffmpeg_code = f"{ffmpeg_code} {FRAGMENTED_MP4_FLAGS}"
     cmd = (
         f'ffmpeg -y -i "{input_path}" {ffmpeg_code} -progress {progress_file} '
-        f'-loglevel error "{output_path}"'
+        f'-loglevel error "{partial_output}"'
     )
-    LOGGER.info(f"Running FFmpeg command: {cmd}")
+    LOGGER.debug(f"Running FFmpeg command: {cmd}")
 
     try:
         process = await asyncio.create_subprocess_shell(
@@ -62,49 +71,10 @@ async def compress_video(input_path, output_path, ffmpeg_code, status_msg, self)
         if duration is None:
             await status_msg.edit_text("⚠️ Failed to determine video duration. Progress tracking may be inaccurate.")
 
-        is_done = False
-
-        while process.returncode is None:
-            await asyncio.sleep(10)
-
-            with open(progress_file, 'r', encoding='utf-8') as file:
-                text = file.read()
-                
-                time_in_us = re.findall("out_time_ms=(\\d+)", text)
-                progress_matches = re.findall("progress=(\\w+)", text)
-                
-                if time_in_us:
-                    elapsed_time = int(time_in_us[-1]) / 1_000_000
-                else:
-                    elapsed_time = 0
-                
-                if progress_matches and progress_matches[-1] == "end":
-                    LOGGER.info("Compression complete.")
-                    is_done = True
-                    break
-
-                if duration:
-                    progress = (elapsed_time / duration) * 100
-                    time_elapsed = time.time() - start_time
-                    eta = ((duration - elapsed_time) / elapsed_time) * time_elapsed if elapsed_time > 0 else 0
-                    
-                    progress_bar = create_progress_bar(progress)
-                    status_text = (
-                        f"<blockquote>"
-                        f"<b>🎥 Compressing Video...</b>\n\n"
-                        f"<code>{progress_bar}</code>\n"
-                        f"⏱️ Time: {format_time(time_elapsed)} / {format_time(duration)}\n"
-                        f"⏳ ETA: {format_time(eta)}\n"
-                        f"📊 Size: {input_size:.1f} MB"
-                        f"</blockquote>"
-                    )
-                    
-                    try:
-                        await status_msg.edit_text(status_text)
-                    except Exception as e:
-                        LOGGER.error(f"Failed to update status: {str(e)}")
-
+        await watch_progress(process, progress_file, duration, status_msg, start_time, f"{input_size:.1f} MB")
         await process.wait()
+        if process.returncode == 0 and os.path.exists(partial_output):
+            commit_file(partial_output, output_path)
         
         if process.returncode == 0 and os.path.exists(output_path):
             output_size = os.path.getsize(output_path) / (1024 * 1024)
@@ -136,8 +106,290 @@ async def compress_video(input_path, output_path, ffmpeg_code, status_msg, self)
     finally:
         if process in self.current_processes:
             self.current_processes.remove(process)
-        if os.path.exists(progress_file):
-            os.remove(progress_file)
+        for leftover in (progress_file, partial_output):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+async def watch_progress(process, progress_file, duration, status_msg, start_time, size_text, title="🎥 Compressing Video..."):
+    """Poll FFmpeg's -progress file and mirror it into the status message until the encode ends."""
+    while process.returncode is None:
+        try:
+            # Wake up as soon as FFmpeg exits instead of sleeping out the whole interval
+            await asyncio.wait_for(process.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            pass
+
+        with open(progress_file, 'r', encoding='utf-8') as file:
+            text = file.read()
+            
+            time_in_us = re.findall("out_time_ms=(\\d+)", text)
+            progress_matches = re.findall("progress=(\\w+)", text)
+            fps_matches = re.findall("fps=([\\d.]+)", text)
+            if fps_matches:
+                note_fps(float(fps_matches[-1]))
+            
+            if time_in_us:
+                elapsed_time = int(time_in_us[-1]) / 1_000_000
+            else:
+                elapsed_time = 0
+            
+            if progress_matches and progress_matches[-1] == "end":
+                LOGGER.info("Compression complete.")
+                break
+
+            if duration:
+                progress = (elapsed_time / duration) * 100
+                time_elapsed = time.time() - start_time
+                eta = ((duration - elapsed_time) / elapsed_time) * time_elapsed if elapsed_time > 0 else 0
+                
+                progress_bar = create_progress_bar(progress)
+                status_text = (
+                    f"<blockquote>"
+                    f"<b>{title}</b>\n\n"
+                    f"<code>{progress_bar}</code>\n"
+                    f"⏱️ Time: {format_time(time_elapsed)} / {format_time(duration)}\n"
+                    f"⏳ ETA: {format_time(eta)}\n"
+                    f"📊 Size: {size_text() if callable(size_text) else size_text}"
+                    f"</blockquote>"
+                )
+                
+                try:
+                    await background(status_msg.edit_text(status_text))
+                except Exception as e:
+                    LOGGER.error(f"Failed to update status: {str(e)}")
+
+async def compress_stream(feed, output_path, ffmpeg_code, status_msg, self, duration=None, input_size=None):
+    """Compress from FFmpeg's stdin while `feed(sink)` is still producing the input.
+
+    `feed` is called with an async `sink(data)` that writes to FFmpeg, so the encode overlaps
+    the download and the original never touches the disk. `input_size` is in bytes.
+    """
+    output_dir = os.path.dirname(output_path)
+    os.makedirs(output_dir, exist_ok=True)
+
+    progress_file = os.path.join(output_dir, f"progress_{int(time.time())}_{os.getpid()}_stream.txt")
+    with open(progress_file, 'w') as f:
+        pass
+
+    partial_output = partial_path(output_path)
+    cmd = (
+        f'ffmpeg -y -i pipe:0 {ffmpeg_code} -progress {progress_file} '
+        f'-loglevel error "{partial_output}"'
+    )
+    LOGGER.debug(f"Running streaming FFmpeg command: {cmd}")
+
+    try:
+        process = await asyncio.create_subprocess_shell(
+            cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        self.current_processes.append(process)
+    except Exception as e:
+        await status_msg.edit_text(f"❌ Failed to start FFmpeg: {str(e)}")
+        LOGGER.error(f"Failed to start FFmpeg process: {str(e)}")
+        return False
+
+    async def sink(data):
+        process.stdin.write(data)
+        await process.stdin.drain()
+
+    async def run_feed():
+        try:
+            await feed(sink)
+        except (BrokenPipeError, ConnectionResetError):
+            # FFmpeg exited early; its return code tells the real story
+            LOGGER.warning("FFmpeg closed its input before the download finished")
+        finally:
+            if not process.stdin.is_closing():
+                process.stdin.close()
+
+    start_time = time.time()
+    size_text = f"{input_size / (1024 * 1024):.1f} MB (streaming)" if input_size else "streaming"
+    feed_task = asyncio.create_task(run_feed())
+    stderr_task = asyncio.create_task(process.stderr.read())
+
+    try:
+        await watch_progress(process, progress_file, duration, status_msg, start_time, size_text,
+                             title="🎥 Downloading + Compressing...")
+        await feed_task
+        await process.wait()
+        stderr = await stderr_task
+        if process.returncode == 0 and os.path.exists(partial_output):
+            commit_file(partial_output, output_path)
+
+        if process.returncode == 0 and os.path.exists(output_path):
+            output_size = os.path.getsize(output_path) / (1024 * 1024)
+            await status_msg.edit_text(
+                f"✅ Compression Complete!\n\n"
+                f"📊 Final Size: {output_size:.1f} MB\n"
+                f"⏱️ Total Time: {format_time(time.time() - start_time)}"
+            )
+            return True
+        LOGGER.error(f"Streaming compression failed: {stderr.decode(errors='ignore')[-500:]}")
+        await status_msg.edit_text("❌ Compression failed.")
+        return False
+
+    except asyncio.CancelledError:
+        LOGGER.info("Streaming compression task was cancelled")
+        feed_task.cancel()
+        process.terminate()
+        await process.wait()
+        raise
+
+    except Exception as e:
+        LOGGER.error(f"Unexpected error during streaming compression: {str(e)}")
+        feed_task.cancel()
+        if process.returncode is None:
+            process.terminate()
+            await process.wait()
+        await status_msg.edit_text(f"❌ Unexpected error: {str(e)}")
+        return False
+
+    finally:
+        if process in self.current_processes:
+            self.current_processes.remove(process)
+        for leftover in (progress_file, partial_output):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+def ladder_command(input_path, renditions, progress_file, preset=LADDER_PRESET):
+    """FFmpeg argv that decodes `input_path` once and encodes every (height, kbps, output) rendition.
+
+    The decoded video is split in a filter graph and scaled per rendition (never upscaled);
+    audio is decoded once as well and encoded next to each output.
+    """
+    labels = [f"v{index}" for index in range(len(renditions))]
+    graph = f"[0:v]split={len(renditions)}" + "".join(f"[s{index}]" for index in range(len(renditions))) + ";"
+    graph += ";".join(
+        f"[s{index}]scale=-2:'min(ih,{height})',setsar=1[{label}]"
+        for index, ((height, _, _), label) in enumerate(zip(renditions, labels))
+    )
+    cmd = ["ffmpeg", "-y", "-i", input_path, "-filter_complex", graph]
+    for (height, rate, output), label in zip(renditions, labels):
+        cmd += [
+            "-map", f"[{label}]", "-map", "0:a:0?",
+            "-c:v", "libx264", "-preset", preset, "-b:v", f"{rate}k",
+            "-maxrate", f"{rate * 3 // 2}k", "-bufsize", f"{rate * 2}k",
+            "-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart", partial_path(output),
+        ]
+    return cmd + ["-progress", progress_file, "-loglevel", "error"]
+
+async def compress_ladder(input_path, renditions, status_msg, self):
+    """Encode several renditions of `input_path` from a single decode pass.
+
+    `renditions` is a list of (height, kbps, output_path). Returns the output paths that were
+    written, in the same order; empty when the encode failed.
+    """
+    if not os.path.exists(input_path):
+        await status_msg.edit_text("❌ Input file does not exist.")
+        return []
+
+    output_dir = os.path.dirname(renditions[0][2])
+    os.makedirs(output_dir, exist_ok=True)
+    progress_file = os.path.join(output_dir, f"progress_{int(time.time())}_ladder.txt")
+    with open(progress_file, 'w') as f:
+        pass
+
+    cmd = ladder_command(input_path, renditions, progress_file)
+    LOGGER.debug(f"Running FFmpeg ladder command: {' '.join(cmd)}")
+    partials = [partial_path(output) for _, _, output in renditions]
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        self.current_processes.append(process)
+    except Exception as e:
+        await status_msg.edit_text(f"❌ Failed to start FFmpeg: {str(e)}")
+        LOGGER.error(f"Failed to start FFmpeg process: {str(e)}")
+        return []
+
+    def sizes():
+        return " | ".join(
+            f"{height}p {os.path.getsize(partial) / (1024 * 1024):.1f} MB" if os.path.exists(partial) else f"{height}p -"
+            for (height, _, _), partial in zip(renditions, partials)
+        )
+
+    start_time = time.time()
+    stderr_task = asyncio.create_task(process.stderr.read())
+    try:
+        duration = extract_duration_from_ffmpeg(input_path)
+        await watch_progress(process, progress_file, duration, status_msg, start_time, sizes,
+                             title=f"🎥 Encoding {len(renditions)} renditions...")
+        await process.wait()
+        stderr = await stderr_task
+        if process.returncode != 0:
+            LOGGER.error(f"Ladder encode failed: {stderr.decode(errors='ignore')[-500:]}")
+            await status_msg.edit_text("❌ Compression failed.")
+            return []
+
+        outputs = [commit_file(partial, output) for partial, (_, _, output) in zip(partials, renditions)]
+        await status_msg.edit_text(
+            f"✅ Encoded {len(outputs)} renditions in {format_time(time.time() - start_time)}\n\n"
+            + "\n".join(
+                f"📊 {height}p: {os.path.getsize(output) / (1024 * 1024):.1f} MB"
+                for (height, _, _), output in zip(renditions, outputs)
+            )
+        )
+        return outputs
+
+    except asyncio.CancelledError:
+        LOGGER.info("Ladder compression task was cancelled")
+        process.terminate()
+        await process.wait()
+        raise
+
+    except Exception as e:
+        LOGGER.error(f"Unexpected error during ladder compression: {str(e)}")
+        if process.returncode is None:
+            process.terminate()
+            await process.wait()
+        await status_msg.edit_text(f"❌ Unexpected error: {str(e)}")
+        return []
+
+    finally:
+        if process in self.current_processes:
+            self.current_processes.remove(process)
+        for leftover in [progress_file] + partials:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+# Codecs Telegram's player takes as-is, with the container they are remuxed into
+AUDIO_COPY_CONTAINERS = {"mp4a": ".m4a", "mp3": ".mp3"}
+
+def audio_output_ext(acodec):
+    """Extension prepare_audio() writes for `acodec`: stream copy when Telegram plays it, else AAC in .m4a."""
+    return AUDIO_COPY_CONTAINERS.get((acodec or "").split(".")[0], ".m4a")
+
+async def prepare_audio(input_path, output_path, acodec, title=None):
+    """Remux a downloaded audio stream for send_audio, transcoding to AAC only when it must.
+
+    `output_path` should end in audio_output_ext(acodec). Returns True on success.
+    """
+    copy = (acodec or "").split(".")[0] in AUDIO_COPY_CONTAINERS
+    codec = ["-c:a", "copy"] if copy else ["-c:a", "aac", "-b:a", AUDIO_BITRATE]
+    metadata = ["-metadata", f"title={title}"] if title else []
+    movflags = ["-movflags", "+faststart"] if output_path.endswith(".m4a") else []
+    partial_output = partial_path(output_path)
+    cmd = [
+        "ffmpeg", "-y", "-v", "error", "-i", input_path, "-vn", "-sn", "-map", "0:a:0",
+        *codec, *metadata, *movflags, partial_output
+    ]
+    LOGGER.debug(f"Running FFmpeg audio command: {' '.join(cmd)}")
+    try:
+        returncode, _, stderr = await run_process(*cmd, stdout=asyncio.subprocess.DEVNULL)
+        if returncode != 0:
+            LOGGER.error(f"Audio {'remux' if copy else 'transcode'} failed: {stderr.decode(errors='ignore')[-500:]}")
+            return False
+        commit_file(partial_output, output_path)
+        return True
+    finally:
+        if os.path.exists(partial_output):
+            os.remove(partial_output)
 
 def extract_duration_from_ffmpeg(input_path):
     try:
@@ -154,3 +406,88 @@ def extract_duration_from_ffmpeg(input_path):
     except Exception as e:
         LOGGER.error(f"Failed to get duration: {e}")
     return None
+
+async def estimate_compression(input_path, output_path, ffmpeg_code, samples=3, sample_seconds=5, self=None):
+    """Encode a few evenly spaced samples with the user's arguments and extrapolate time and size.
+
+    Returns a dict with the measured speed (x realtime), bitrate and the projected totals,
+    or None when the input cannot be probed or no sample encodes successfully. With the bot as
+    `self`, sample encodes are registered in its current_processes like full encodes.
+    """
+    duration = await asyncio.to_thread(extract_duration_from_ffmpeg, input_path)
+    if not duration:
+        return None
+
+    sample_seconds = min(sample_seconds, duration / samples)
+    output_dir = os.path.dirname(output_path)
+    base, ext = os.path.splitext(os.path.basename(output_path))
+    encoded_seconds = 0
+    encoded_bytes = 0
+    wall_time = 0
+
+    for index in range(samples):
+        offset = max(0, duration * (index + 1) / (samples + 1) - sample_seconds / 2)
+        sample_path = os.path.join(output_dir, f"{base}_sample{index}{ext}")
+        cmd = (
+            f'ffmpeg -y -ss {offset:.2f} -t {sample_seconds:.2f} -i "{input_path}" {ffmpeg_code} '
+            f'-loglevel error "{sample_path}"'
+        )
+        process = None
+        try:
+            start = time.perf_counter()
+            process = await asyncio.create_subprocess_shell(
+                cmd,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            if self is not None:
+                self.current_processes.append(process)
+            _, stderr = await process.communicate()
+            elapsed = time.perf_counter() - start
+            if process.returncode == 0 and os.path.exists(sample_path):
+                encoded_seconds += sample_seconds
+                encoded_bytes += os.path.getsize(sample_path)
+                wall_time += elapsed
+            else:
+                LOGGER.warning(f"Sample encode {index} failed: {stderr.decode(errors='ignore')[-300:]}")
+        except asyncio.CancelledError:
+            # Aborted preflight, /cancel or /restart: do not leave the sample encode running
+            if process is not None and process.returncode is None:
+                process.terminate()
+                await process.wait()
+            raise
+        finally:
+            if self is not None and process in self.current_processes:
+                self.current_processes.remove(process)
+            if os.path.exists(sample_path):
+                os.remove(sample_path)
+
+    if not encoded_seconds or not wall_time:
+        return None
+
+    speed = encoded_seconds / wall_time
+    bitrate = encoded_bytes * 8 / encoded_seconds
+    return {
+        "duration": duration,
+        "samples": samples,
+        "sample_seconds": sample_seconds,
+        "speed": speed,
+        "bitrate": bitrate,
+        "estimated_time": duration / speed,
+        "estimated_size": bitrate * duration / 8,
+        "input_size": os.path.getsize(input_path),
+    }
+
+def format_estimate(estimate):
+    """Human readable preflight summary for the confirmation message."""
+    input_mb = estimate["input_size"] / (1024 * 1024)
+    output_mb = estimate["estimated_size"] / (1024 * 1024)
+    return (
+        f"<blockquote>"
+        f"<b>🧪 Preflight ({estimate['samples']} × {estimate['sample_seconds']:.0f}s samples)</b>\n\n"
+        f"⚡ Speed: {estimate['speed']:.2f}x realtime\n"
+        f"⏱️ Estimated time: {format_time(estimate['estimated_time'])}\n"
+        f"📦 Estimated size: {output_mb:.1f} MB (from {input_mb:.1f} MB)\n"
+        f"📶 Bitrate: {estimate['bitrate'] / 1000:.0f} kb/s"
+        f"</blockquote>"
+    )
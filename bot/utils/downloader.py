@@ -1,6 +1,5 @@
 import os
 import logging
-import yt_dlp
 import time
 import asyncio
 import json
@@ -8,11 +7,21 @@ from datetime import timedelta
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from pyrogram.types import Message
-from config import COOKIES_PATH
-# Initialize logging and executor
+from config import COOKIES_PATH, YTDLP_POOL_SIZE
+from .bandwidth import describe_flow
+from .tg_calls import background
+from .ytdlp_pool import get_ytdlp_pool
+# Initialize logging; yt_dlp, cookies and the executor are loaded on first use to keep startup fast
 LOGGER = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
-executor = ThreadPoolExecutor(max_workers=4)
+_executor = None
+_cookies = None
+
+def get_executor():
+    """Thread pool for yt-dlp work, created on first use."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=4)
+    return _executor
 
 def format_time(seconds):
     """Format seconds into HH:MM:SS."""
@@ -65,12 +74,18 @@ def load_cookies(cookie_path):
             LOGGER.error(f"Error decoding cookies: {e}")
     return cookies
 
-cookies_dict = load_cookies(COOKIES_PATH)
+def get_cookies():
+    """Cookies from COOKIES_PATH, read on first use."""
+    global _cookies
+    if _cookies is None:
+        _cookies = load_cookies(COOKIES_PATH)
+    return _cookies
 
 class ProgressHandler:
-    def __init__(self, status_msg, event_loop):
+    def __init__(self, status_msg, event_loop, flow=None):
         self.status_msg = status_msg
         self.event_loop = event_loop
+        self.flow = flow
         self.last_update_time = 0
         self._progress_lock = asyncio.Lock()
         self.update_interval = 5  # 10 seconds interval for progress update
@@ -78,13 +93,20 @@ class ProgressHandler:
     async def update_status(self, text):
         try:
             async with self._progress_lock:
-                await self.status_msg.edit_text(text)
+                await background(self.status_msg.edit_text(text))
         except Exception as e:
             LOGGER.error(f"Error updating status: {e}")
 
     def progress_hook(self, d):
         """Progress hook that handles both downloading and post-processing."""
         try:
+            # yt-dlp calls hooks after every block from its worker thread, so blocking here shapes the download
+            if self.flow is not None and d.get('status') == 'downloading':
+                self.flow.advance_threadsafe(
+                    d.get('downloaded_bytes', 0) or 0,
+                    d.get('total_bytes', 0) or d.get('total_bytes_estimate', 0) or 0
+                )
+
             current_time = time.time()
             
             # Only update progress every 10 seconds
@@ -112,6 +134,7 @@ class ProgressHandler:
                 f"Speed: {format_size(speed)}/s\n"
                 f"ETA: {format_time(eta)}\n"
                 f"Size: {format_size(downloaded)} / {format_size(total)}"
+                f"{describe_flow(self.flow, format_size)}"
                 f"</blockquote>"
             )
 
@@ -131,6 +154,22 @@ class ProgressHandler:
             LOGGER.error(f"Progress hook error: {e}")
 
 
+def extract_with_ytdlp(url, ydl_opts):
+    """Execute yt-dlp extraction in a separate thread."""
+    import yt_dlp
+
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        return ydl.extract_info(url, download=False)
+
+async def extract_info(url, ydl_opts):
+    """Extract info through the warm worker pool, or the thread executor when the pool is disabled."""
+    if YTDLP_POOL_SIZE > 0:
+        return await get_ytdlp_pool().extract_info(url, ydl_opts)
+    return await asyncio.get_event_loop().run_in_executor(
+        get_executor(),
+        partial(extract_with_ytdlp, url, ydl_opts)
+    )
+
 async def get_video_formats(url):
     """Extracts video formats from a URL using cookies."""
     try:
@@ -138,70 +177,130 @@ async def get_video_formats(url):
             'quiet': True,
             'no_warnings': True,
             'extract_flat': True,
-            'cookies': cookies_dict  # Added cookies here
+            'cookies': get_cookies()  # Added cookies here
         }
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = await asyncio.get_event_loop().run_in_executor(
-                executor, 
-                lambda: ydl.extract_info(url, download=False)
-            )
+        info = await extract_info(url, ydl_opts)
             
-            formats = [
-                {
-                    'format_id': f.get('format_id'),
-                    'ext': f.get('ext', 'unknown'),
-                    'resolution': f.get('height', 0),
-                    'fps': f.get('fps', 'N/A'),
-                }
-                for f in info.get('formats', [])
-                if (f.get('vcodec') != 'none' and 
-                    f.get('height', 0) >= 360 and 
-                    f.get('filesize', 0) is not None and 
-                    f.get('filesize', 0) > 0)
-            ]
-
-            title = info.get('title', 'No title available')
-            LOGGER.info("Formats extracted successfully")
-            return formats, title
+        formats = [
+            {
+                'format_id': f.get('format_id'),
+                'ext': f.get('ext', 'unknown'),
+                'resolution': f.get('height', 0),
+                'fps': f.get('fps', 'N/A'),
+                'filesize': f.get('filesize'),
+            }
+            for f in info.get('formats', [])
+            if (f.get('vcodec') != 'none' and 
+                (f.get('height') or 0) >= 360 and 
+                f.get('filesize', 0) is not None and 
+                f.get('filesize', 0) > 0)
+        ]
+
+        title = info.get('title', 'No title available')
+        LOGGER.info("Formats extracted successfully")
+        return formats, title
             
     except Exception as e:
         LOGGER.error(f"Error fetching video formats: {e}")
         return [], "Error"
 
-async def download_video(url, format_id, output_path, status_msg):
-    """Downloads video with progress reporting."""
+async def get_audio_formats(url):
+    """Extracts the audio-only formats of a URL, best bitrate first."""
     try:
-        if os.path.exists(output_path):
-            await status_msg.edit_text("✅ File already exists. Skipping download.")
-            return True
+        ydl_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'extract_flat': True,
+            'cookies': get_cookies()
+        }
 
+        info = await extract_info(url, ydl_opts)
+
+        formats = [
+            {
+                'format_id': f.get('format_id'),
+                'ext': f.get('ext', 'unknown'),
+                'acodec': f.get('acodec') or 'unknown',
+                'abr': f.get('abr') or 0,
+                'filesize': f.get('filesize') or f.get('filesize_approx'),
+            }
+            for f in info.get('formats', [])
+            if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')
+        ]
+        formats.sort(key=lambda f: f['abr'], reverse=True)
+
+        title = info.get('title', 'No title available')
+        LOGGER.info("Audio formats extracted successfully")
+        return formats, title
+
+    except Exception as e:
+        LOGGER.error(f"Error fetching audio formats: {e}")
+        return [], "Error"
+
+async def expand_urls(urls, limit=None):
+    """Expands playlist URLs into their entries, returning a list of (url, title) pairs."""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+        'cookies': get_cookies()
+    }
+    items = []
+    for url in urls:
+        try:
+            info = await extract_info(url, ydl_opts)
+        except Exception as e:
+            LOGGER.error(f"Error expanding {url}: {e}")
+            items.append((url, url))
+            continue
+
+        if info.get('_type') == 'playlist':
+            for entry in info.get('entries') or []:
+                if not entry:
+                    continue
+                entry_url = entry.get('url') or entry.get('webpage_url') or entry.get('id')
+                items.append((entry_url, entry.get('title') or entry_url))
+        else:
+            items.append((info.get('webpage_url') or url, info.get('title') or url))
+
+        if limit and len(items) >= limit:
+            break
+    return items[:limit] if limit else items
+
+async def download_video(url, format_id, output_path, status_msg, flow=None, format_spec=None):
+    """Downloads video with progress reporting; `format_spec` overrides "<format_id>+bestaudio/best"."""
+    try:
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         
         # Get the current event loop
         loop = asyncio.get_running_loop()
         
         # Initialize progress handler
-        progress_handler = ProgressHandler(status_msg, loop)
+        progress_handler = ProgressHandler(status_msg, loop, flow)
         
         # Configure yt-dlp options
         ydl_opts = {
-            'format': f"{format_id}+bestaudio/best",
+            'format': format_spec or f"{format_id}+bestaudio/best",
             'outtmpl': output_path,
             'progress_hooks': [progress_handler.progress_hook],
             'merge_output_format': 'mp4',
             'quiet': False,
             'no_warnings': True,
-            'cookies': cookies_dict  # Added cookies here
+            'cookies': get_cookies()  # Added cookies here
         }
 
         await status_msg.edit_text("🔍 Starting download...")
 
-        # Run the download in a thread pool
-        await loop.run_in_executor(
-            executor,
-            lambda: download_with_ytdlp(url, ydl_opts)
-        )
+        if YTDLP_POOL_SIZE > 0:
+            # Warm worker process; the hook is still called from a thread, as yt-dlp would
+            await get_ytdlp_pool().download(url, ydl_opts, progress_handler.progress_hook)
+        else:
+            # Run the download in a thread pool
+            await loop.run_in_executor(
+                get_executor(),
+                lambda: download_with_ytdlp(url, ydl_opts)
+            )
         
         # Check if download was successful
         if os.path.exists(output_path):
@@ -226,6 +325,8 @@ async def download_video(url, format_id, output_path, status_msg):
 
 def download_with_ytdlp(url, ydl_opts):
     """Execute yt-dlp download in a separate thread."""
+    import yt_dlp
+
     try:
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
             ydl.download([url])
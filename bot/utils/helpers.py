@@ -7,13 +7,11 @@ from datetime import timedelta
 import subprocess
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from config import DOWNLOADS_DIR
+from .bandwidth import describe_flow
+from .tg_calls import background
 
 # Initialize logger with custom format
 LOGGER = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-)
 
 # Progress bar constants
 FINISHED_PROGRESS_STR = "⬢"
@@ -49,12 +47,16 @@ class Helper:
         percentage = progress * 100
         return f"[{bar}] {percentage:.1f}%"
 
-    async def progress_for_pyrogram(self, current, total, status_msg, start_time, action="Processing"):
+    async def progress_for_pyrogram(self, current, total, status_msg, start_time, action="Processing", flow=None):
         """Enhanced progress display for Pyrogram file transfers with asyncio-based updates."""
         try:
             if total == 0:
                 return
 
+            # Pyrogram awaits this callback between file parts, so pacing here shapes the transfer
+            if flow is not None:
+                await flow.advance(current, total)
+
             now = time.time()
             
             # Use lock to prevent multiple simultaneous updates
@@ -83,12 +85,13 @@ class Helper:
                     f"🚀 Speed: {self.format_size(speed)}/s\n"
                     f"⏳ ETA: {self.format_time(eta)}\n"
                     f"📊 Size: {self.format_size(current)} / {self.format_size(total)}"
+                    f"{describe_flow(flow, self.format_size)}"
                     f"</blockquote>"
                 )
 
                 # Update the message if content has changed and enough time has passed
                 if status_msg is not None and (status_msg.text != status_text or now - self.last_update_time >= 5):
-                    await status_msg.edit_text(status_text)
+                    await background(status_msg.edit_text(status_text))
                     self.last_update_time = now
 
         except Exception as e:
@@ -120,6 +123,26 @@ def create_format_buttons(formats, prefix="dl_"):
 
     return InlineKeyboardMarkup(buttons)
 
+def create_audio_format_buttons(formats, prefix="dla_"):
+    """Creates an inline keyboard with audio-only format options in two-column layout."""
+    buttons = []
+    row = []
+    for format in formats:
+        size = f", {format['filesize'] / (1024 * 1024):.1f} MB" if format.get('filesize') else ""
+        codec = format['acodec'].split('.')[0]
+        bitrate = f"{format['abr']:.0f} kbps " if format.get('abr') else ""
+        button_label = f"{bitrate}{codec} ({format['ext']}{size})"
+        row.append(InlineKeyboardButton(button_label, callback_data=f"{prefix}{format['format_id']}"))
+
+        if len(row) == 2:
+            buttons.append(row)
+            row = []
+
+    if row:
+        buttons.append(row)
+
+    return InlineKeyboardMarkup(buttons)
+
 def clean_files(*files):
     """Remove specified files if they exist."""
     for file in files:
@@ -148,9 +171,9 @@ async def get_video_duration(video_path):
         LOGGER.error(f"Error fetching video duration: {e}")
         return None
 
-async def take_screenshot(path):
-    """Capture a screenshot from the video and save it as thumb.jpg in DOWNLOADS_DIR."""
-    thumb_path = os.path.join(DOWNLOADS_DIR, "thumb.jpg")
+async def take_screenshot(path, thumb_path=None):
+    """Capture a screenshot from the video and save it as thumb.jpg in DOWNLOADS_DIR (or thumb_path)."""
+    thumb_path = thumb_path or os.path.join(DOWNLOADS_DIR, "thumb.jpg")
     try:
         subprocess.call(["ffmpeg", "-i", path, "-ss", "00:00:01.000", "-vframes", "1", thumb_path])
         LOGGER.info(f"Screenshot taken and saved to {thumb_path}")
@@ -3,8 +3,38 @@ import os
 import time
 from datetime import timedelta
 from typing import Tuple
-import aiohttp
-from config import DOWNLOADS_DIR
+import logging
+import struct
+from config import DOWNLOADS_DIR, STREAM_BLOCK_SIZE
+from .bandwidth import describe_flow
+from .tg_calls import background
+from .tracing import note_retry
+from .workspace import partial_path, commit_file
+
+LOGGER = logging.getLogger(__name__)
+
+def is_pipe_friendly(head: bytes) -> bool:
+    """Whether a file can be decoded from a pipe, judging by its first bytes.
+
+    MP4/MOV files need the moov atom before mdat to be readable without seeking;
+    other containers (MKV, WebM, TS, ...) stream fine.
+    """
+    if head[4:8] != b"ftyp":
+        return True
+    offset = 0
+    while offset + 8 <= len(head):
+        size, box = struct.unpack(">I4s", head[offset:offset + 8])
+        if box == b"moov":
+            return True
+        if box == b"mdat":
+            return False
+        if size == 1 and offset + 16 <= len(head):
+            size = struct.unpack(">Q", head[offset + 8:offset + 16])[0]
+        if size < 8:
+            return False
+        offset += size
+    # moov lies beyond the sampled bytes; assume it trails the media data
+    return False
 
 class Helper:
     def format_time(self, seconds: float) -> str:
@@ -37,7 +67,10 @@ class HTTPDownloader:
         self.helper = Helper()
         self.download_dir = download_dir
 
-    async def download_part(self, url: str, start_byte: int, end_byte: int, file_path: str, progress_tracker: list):
+    async def download_part(self, url: str, start_byte: int, end_byte: int, file_path: str, progress_tracker: list,
+                            total_size: int = 0, flow=None):
+        import aiohttp
+
         headers = {"Range": f"bytes={start_byte}-{end_byte}"}
         
         async with aiohttp.ClientSession() as session:
@@ -47,8 +80,11 @@ class HTTPDownloader:
                     async for chunk in response.content.iter_chunked(1024 * 1024):
                         f.write(chunk)
                         progress_tracker[0] += len(chunk)  # Update the shared progress tracker
+                        if flow is not None:
+                            flow.set_progress(progress_tracker[0], total_size)
+                            await flow.consume(len(chunk))
 
-    async def update_progress(self, total_size: float, status_msg, progress_tracker: list):
+    async def update_progress(self, total_size: float, status_msg, progress_tracker: list, flow=None):
         start_time = time.time()
 
         while progress_tracker[0] < total_size:
@@ -69,17 +105,23 @@ class HTTPDownloader:
                 f"🚀 Speed: {self.helper.format_size(speed)}/s\n"
                 f"⏳ ETA: {self.helper.format_time(eta)}\n"
                 f"📊 Size: {self.helper.format_size(downloaded_size)} / {self.helper.format_size(total_size)}"
+                f"{describe_flow(flow, self.helper.format_size)}"
                 f"</blockquote>"
             )
 
             if status_msg is not None and status_msg.text != status_text:
-                await status_msg.edit_text(status_text)
+                await background(status_msg.edit_text(status_text))
 
             await asyncio.sleep(2)
 
-    async def download_file(self, url: str, output_name: str = None, status_msg=None, num_parts: int = 10) -> str:
+    async def download_file(self, url: str, output_name: str = None, status_msg=None, num_parts: int = 10,
+                            flow=None, download_dir: str = None) -> str:
+        import aiohttp
+
         file_name = output_name or url.split('/')[-1]
-        file_path = os.path.join(self.download_dir, file_name)
+        target_path = os.path.join(download_dir or self.download_dir, file_name)
+        # Parts land in a partial file that is renamed once every part is in
+        file_path = partial_path(target_path)
 
         # Get the file size
         async with aiohttp.ClientSession() as session:
@@ -97,7 +139,7 @@ class HTTPDownloader:
         progress_tracker = [0]
 
         # Start the progress update coroutine
-        progress_update_task = asyncio.create_task(self.update_progress(total_size, status_msg, progress_tracker))
+        progress_update_task = asyncio.create_task(self.update_progress(total_size, status_msg, progress_tracker, flow))
 
         # Download the file in multiple parts concurrently
         await asyncio.gather(
@@ -107,7 +149,9 @@ class HTTPDownloader:
                     part * part_size,
                     (part + 1) * part_size - 1 if part < num_parts - 1 else total_size - 1,
                     file_path,
-                    progress_tracker
+                    progress_tracker,
+                    total_size,
+                    flow
                 )
                 for part in range(num_parts)
             ]
@@ -116,4 +160,110 @@ class HTTPDownloader:
         # Wait for the progress update task to complete
         await progress_update_task
 
-        return file_path if os.path.exists(file_path) else None
+        return commit_file(file_path, target_path) if os.path.exists(file_path) else None
+
+    async def content_length(self, url: str) -> int:
+        """Size from a HEAD request, or 0 if the server does not say."""
+        import aiohttp
+
+        async with aiohttp.ClientSession() as session:
+            async with session.head(url, allow_redirects=True) as response:
+                return int(response.headers.get('content-length', 0))
+
+    async def probe(self, url: str, head_size: int = 256 * 1024) -> Tuple[int, bool, bytes]:
+        """Return (total size, whether ranges are supported, first bytes of the file)."""
+        import aiohttp
+
+        async with aiohttp.ClientSession() as session:
+            async with session.head(url, allow_redirects=True) as response:
+                total_size = int(response.headers.get('content-length', 0))
+                ranges = response.headers.get('accept-ranges', '').lower() == 'bytes'
+            async with session.get(url, headers={"Range": f"bytes=0-{head_size - 1}"}) as response:
+                ranges = ranges or response.status == 206
+                head = await response.content.read(head_size)
+        return total_size, ranges, head
+
+    async def stream_file(self, url: str, sink, num_parts: int = 4, block_size: int = STREAM_BLOCK_SIZE,
+                          flow=None, total_size: int = None, retries: int = 3):
+        """Download with parallel ranged requests and hand the bytes to `sink` strictly in order.
+
+        At most `2 * num_parts` blocks are held in memory, so a slow consumer throttles the download.
+        """
+        import aiohttp
+
+        if total_size is None:
+            total_size, ranges, _ = await self.probe(url, head_size=1)
+        else:
+            ranges = True
+
+        async with aiohttp.ClientSession() as session:
+            if not total_size or not ranges:
+                # No ranges: one sequential stream is the best we can do
+                async with session.get(url) as response:
+                    async for chunk in response.content.iter_chunked(1024 * 1024):
+                        if flow is not None:
+                            await flow.consume(len(chunk))
+                        await sink(chunk)
+                return
+
+            blocks = (total_size + block_size - 1) // block_size
+            slots = asyncio.Semaphore(num_parts * 2)
+            ready = {}
+            arrived = asyncio.Condition()
+            next_index = [0]
+            received = [0]
+
+            async def fetch_block(index):
+                start = index * block_size
+                end = min(start + block_size, total_size) - 1
+                for attempt in range(1, retries + 1):
+                    try:
+                        async with session.get(url, headers={"Range": f"bytes={start}-{end}"}) as response:
+                            response.raise_for_status()
+                            data = bytearray()
+                            async for chunk in response.content.iter_chunked(256 * 1024):
+                                data.extend(chunk)
+                                if flow is not None:
+                                    await flow.consume(len(chunk))
+                        if len(data) != end - start + 1:
+                            raise IOError(f"short read for bytes {start}-{end}: got {len(data)}")
+                        return bytes(data)
+                    except (aiohttp.ClientError, asyncio.TimeoutError, IOError) as e:
+                        if attempt == retries:
+                            raise
+                        LOGGER.warning(f"Block {index} failed ({e}), retrying")
+                        note_retry()
+                        await asyncio.sleep(attempt)
+
+            async def worker():
+                while True:
+                    # Take a slot before an index, so the lowest outstanding block always has one
+                    await slots.acquire()
+                    index = next_index[0]
+                    if index >= blocks:
+                        slots.release()
+                        return
+                    next_index[0] += 1
+                    data = await fetch_block(index)
+                    async with arrived:
+                        ready[index] = data
+                        arrived.notify_all()
+
+            async def writer():
+                for index in range(blocks):
+                    async with arrived:
+                        await arrived.wait_for(lambda: index in ready)
+                        data = ready.pop(index)
+                    await sink(data)
+                    received[0] += len(data)
+                    if flow is not None:
+                        flow.set_progress(received[0], total_size)
+                    slots.release()
+
+            tasks = [asyncio.create_task(worker()) for _ in range(num_parts)]
+            tasks.append(asyncio.create_task(writer()))
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
@@ -0,0 +1,525 @@
+"""End-to-end load generator: drives the real `Bot` handlers through a fake pyrogram client.
+
+Telegram is replaced by `FakeClient` (handler registration, filter evaluation, a pyrogram-sized
+worker pool and per-call round trip latency) plus fake uploader/downloader objects that move bytes
+at a configured bandwidth. Everything else is real: /l and /ylc fetch from a local HTTP server,
+encodes run FFmpeg on lavfi-generated media, admission control, tracing and workspaces run as in
+production. /ya fetches an audio-only sample. Run from the repository root:
+
+    python -m bot.utils.loadtest --users 50 --rate 5 --mix l=1,ylc=1,add=1,ya=1
+"""
+import argparse
+import asyncio
+import collections
+import http.server
+import inspect
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from pyrogram.types import CallbackQuery
+from .logs import setup_logging
+from .tracing import percentile
+
+LOGGER = logging.getLogger(__name__)
+
+_ids = itertools.count(1000)
+
+
+# --- Local media ---------------------------------------------------------------------------------
+
+def make_sample(path, seconds=20, size="1280x720", rate=25):
+    """Generate a test video with audio using FFmpeg's lavfi sources."""
+    subprocess.run(
+        [
+            "ffmpeg", "-y", "-v", "error",
+            "-f", "lavfi", "-i", f"testsrc2=size={size}:rate={rate}",
+            "-f", "lavfi", "-i", "sine=frequency=440",
+            "-t", str(seconds), "-c:v", "libx264", "-preset", "ultrafast", "-g", str(rate * 2),
+            "-c:a", "aac", "-shortest", "-movflags", "+faststart", path,
+        ],
+        check=True
+    )
+    return path
+
+
+def make_audio_sample(path, seconds=20):
+    """Generate an audio-only AAC file, what /ya picks from a site's audio formats."""
+    subprocess.run(
+        [
+            "ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "sine=frequency=440",
+            "-t", str(seconds), "-c:a", "aac", "-b:a", "128k", path,
+        ],
+        check=True
+    )
+    return path
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Static files with HEAD and single Range support, optionally throttled per connection."""
+
+    bytes_per_second = 0
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        header = self.headers.get("Range")
+        if header and header.startswith("bytes="):
+            first, _, last = header[6:].split(",")[0].partition("-")
+            start = int(first) if first else max(0, size - int(last))
+            end = min(int(last), size - 1) if first and last else end
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        handle = open(path, "rb")
+        handle.seek(start)
+        self._remaining = end - start + 1
+        return handle
+
+    def copyfile(self, source, outputfile):
+        chunk = 256 * 1024
+        while self._remaining > 0:
+            data = source.read(min(chunk, self._remaining))
+            if not data:
+                break
+            outputfile.write(data)
+            self._remaining -= len(data)
+            if self.bytes_per_second:
+                time.sleep(len(data) / self.bytes_per_second)
+
+
+def start_file_server(directory, bytes_per_second=0):
+    """Serve `directory` on an ephemeral localhost port from a daemon thread; returns (server, base_url)."""
+    handler = type("Handler", (RangeRequestHandler,), {"bytes_per_second": bytes_per_second})
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), lambda *args: handler(*args, directory=directory)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# --- Fake Telegram -------------------------------------------------------------------------------
+
+class FakeMedia:
+    def __init__(self, path, duration, width, height):
+        self.path = path
+        self.file_id = f"fake_{next(_ids)}"
+        self.file_unique_id = f"fake_unique_{next(_ids)}"
+        self.file_name = os.path.basename(path)
+        self.file_size = os.path.getsize(path)
+        self.mime_type = "video/mp4"
+        self.duration = duration
+        self.width = width
+        self.height = height
+
+
+class FakeMessage:
+    def __init__(self, client, chat_id, user_id, text=None, reply_to_message=None, video=None, document=None):
+        self._client = client
+        self.id = next(_ids)
+        self.chat = SimpleNamespace(id=chat_id)
+        self.from_user = SimpleNamespace(id=user_id, first_name=f"user{user_id}")
+        self.text = text
+        self.caption = None
+        self.command = None
+        self.reply_to_message = reply_to_message
+        self.reply_to_message_id = reply_to_message.id if reply_to_message else None
+        self.video = video
+        self.document = document
+        self.media_group_id = None
+        self.reply_markup = None
+        self.empty = False
+
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        await self._client.call("send_message")
+        return self._client.post(self.chat.id, text, reply_markup)
+
+    async def edit_text(self, text, reply_markup=None, **kwargs):
+        await self._client.call("edit_message")
+        self.text = text
+        self.reply_markup = reply_markup
+        return self
+
+    async def delete(self):
+        await self._client.call("delete_message")
+
+    async def forward(self, chat_id, **kwargs):
+        await self._client.call("forward_messages")
+        return self._client.post(chat_id, self.text)
+
+
+class FakeCallbackQuery(CallbackQuery):
+    """Passes the isinstance checks handlers and filters make on real callback queries."""
+
+    def __init__(self, client, message, user_id, data):
+        self._client = client
+        self.id = str(next(_ids))
+        self.message = message
+        self.from_user = SimpleNamespace(id=user_id, first_name=f"user{user_id}")
+        self.data = data
+
+    async def answer(self, text=None, show_alert=None, **kwargs):
+        await self._client.call("answer_callback_query")
+
+
+class FakeClient:
+    """Stands in for the bot's pyrogram Client: collects handlers and dispatches fake updates to them.
+
+    Like pyrogram, only the first matching handler runs, and at most `workers` handlers run at
+    once (pyrogram's dispatcher worker count), so long jobs queue updates behind them.
+    Every API call costs `rtt` seconds.
+    """
+
+    def __init__(self, *args, rtt=0.05, workers=None, **kwargs):
+        self.name = "loadtest_bot"
+        self.rtt = rtt
+        self.me = SimpleNamespace(id=1, username="loadtest_bot", usernames=None)
+        self.executor = None
+        self.handlers = []
+        self.calls = collections.Counter()
+        self.chats = collections.defaultdict(list)
+        self.workers = asyncio.Semaphore(workers or min(32, (os.cpu_count() or 0) + 4))
+
+    @property
+    def loop(self):
+        return asyncio.get_running_loop()
+
+    def on_message(self, filters=None, group=0):
+        return self._register("message", filters)
+
+    def on_callback_query(self, filters=None, group=0):
+        return self._register("callback", filters)
+
+    def on_raw_update(self, group=0):
+        return lambda func: func
+
+    def _register(self, kind, filters):
+        def decorator(func):
+            self.handlers.append((kind, filters, func))
+            return func
+        return decorator
+
+    async def call(self, method):
+        self.calls[method] += 1
+        await asyncio.sleep(self.rtt)
+
+    def post(self, chat_id, text, reply_markup=None):
+        message = FakeMessage(self, chat_id, self.me.id, text)
+        message.reply_markup = reply_markup
+        self.chats[chat_id].append(message)
+        return message
+
+    async def dispatch(self, update):
+        """Run the first handler whose filter accepts `update`; returns the seconds spent queued."""
+        kind = "callback" if isinstance(update, CallbackQuery) else "message"
+        queued = time.monotonic()
+        async with self.workers:
+            waited = time.monotonic() - queued
+            for handler_kind, filters, func in self.handlers:
+                if handler_kind != kind:
+                    continue
+                accepted = filters(self, update) if filters else True
+                if inspect.isawaitable(accepted):
+                    accepted = await accepted
+                if accepted:
+                    await func(self, update)
+                    break
+        return waited
+
+    async def forward_messages(self, chat_id, from_chat_id, message_ids, **kwargs):
+        await self.call("forward_messages")
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await self.call("copy_message")
+        # A copy of a delivered upload (coalesced jobs, upload pool) is a delivery too
+        message = self.post(chat_id, kwargs.get("caption"))
+        message.delivered = True
+        return message
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        await self.call("send_media_group")
+        return [self.post(chat_id, None) for _ in media]
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class FakeTransfer:
+    """Replaces ParallelUploader/ParallelDownloader: moves bytes at `bytes_per_second`, reporting progress."""
+
+    def __init__(self, client, bytes_per_second):
+        self.client = client
+        self.bytes_per_second = bytes_per_second
+        self.bytes = 0
+
+    async def _move(self, size, progress, progress_args):
+        done = 0
+        step = max(1, self.bytes_per_second // 4)
+        while done < size:
+            chunk = min(step, size - done)
+            await asyncio.sleep(chunk / self.bytes_per_second)
+            done += chunk
+            if progress:
+                await progress(done, size, *progress_args)
+        self.bytes += size
+
+    async def download(self, message, file_name, progress=None, progress_args=()):
+        media = message.video or message.document
+        await self._move(media.file_size, progress, progress_args)
+        await asyncio.to_thread(shutil.copyfile, media.path, file_name)
+        return file_name
+
+    async def _send(self, chat_id, path, caption, progress, progress_args):
+        await self._move(os.path.getsize(path), progress, progress_args)
+        await self.client.call("send_media")
+        message = self.client.post(chat_id, caption)
+        message.delivered = True
+        return message
+
+    async def send_video(self, chat_id, video, caption="", progress=None, progress_args=(), **kwargs):
+        return await self._send(chat_id, video, caption, progress, progress_args)
+
+    async def send_document(self, chat_id, document, caption="", progress=None, progress_args=(), **kwargs):
+        return await self._send(chat_id, document, caption, progress, progress_args)
+
+    async def send_audio(self, chat_id, audio, caption="", progress=None, progress_args=(), **kwargs):
+        return await self._send(chat_id, audio, caption, progress, progress_args)
+
+
+# --- Load scenario -------------------------------------------------------------------------------
+
+def build_bot(args, sample):
+    """A real `Bot` whose Telegram client and transfers are fakes; preflight prompts are turned off."""
+    import bot.client as bot_client
+
+    real_client = bot_client.ScheduledClient
+    bot_client.ScheduledClient = lambda *_, **__: FakeClient(rtt=args.rtt, workers=args.workers)
+    try:
+        bot = bot_client.Bot()
+    finally:
+        bot_client.ScheduledClient = real_client
+    # Nobody is there to press "Compress" on the estimate
+    bot_client.PREFLIGHT_ENABLED = False
+    bot_client.get_video_formats = local_formats(sample)
+    bot_client.get_audio_formats = local_audio_formats
+    bot.uploader = FakeTransfer(bot.app, int(args.up_mbps * 125_000))
+    bot.tg_downloader = FakeTransfer(bot.app, int(args.down_mbps * 125_000))
+    bot.upload_pool = None
+    return bot
+
+
+def local_formats(sample):
+    """get_video_formats for the local server: extraction still runs through yt-dlp, but a bare file
+    carries no height or size, which the real format filter requires, so those come from the sample."""
+    from .downloader import extract_info
+
+    async def get_video_formats(url):
+        info = await extract_info(url, {"quiet": True, "no_warnings": True})
+        formats = [
+            {"format_id": f["format_id"], "ext": f.get("ext", "mp4"), "resolution": sample.height,
+             "fps": 25, "filesize": sample.file_size}
+            for f in info.get("formats", [])
+        ]
+        return formats, info.get("title", "sample")
+    return get_video_formats
+
+
+async def local_audio_formats(url):
+    """get_audio_formats for the local server: a bare file is not tagged audio-only, so it is described
+    as the AAC stream make_audio_sample wrote."""
+    from .downloader import extract_info
+
+    info = await extract_info(url, {"quiet": True, "no_warnings": True})
+    formats = [
+        {"format_id": f["format_id"], "ext": f.get("ext", "m4a"), "acodec": "mp4a.40.2", "abr": 128,
+         "filesize": f.get("filesize")}
+        for f in info.get("formats", [])
+    ]
+    return formats, info.get("title", "sample")
+
+
+class Job:
+    def __init__(self, user_id, command):
+        self.user_id = user_id
+        self.command = command
+        self.latency = None
+        self.queued = 0.0
+        self.ok = False
+        self.error = None
+
+
+async def run_user(bot, job, base_url, sample):
+    """One user issuing one command, pressing the first format button when asked, until the handler ends."""
+    client = bot.app
+    chat_id = job.user_id
+    started = time.monotonic()
+    try:
+        if job.command == "add":
+            upload = FakeMessage(client, chat_id, job.user_id, video=sample)
+            message = FakeMessage(client, chat_id, job.user_id, "/add", reply_to_message=upload)
+        else:
+            sample_file = "sample.m4a" if job.command == "ya" else "sample.mp4"
+            message = FakeMessage(client, chat_id, job.user_id, f"/{job.command} {base_url}/{sample_file}")
+        job.queued += await client.dispatch(message)
+
+        if job.command in ("ylc", "yl", "ya"):
+            prompt = next((m for m in reversed(client.chats[chat_id]) if m.reply_markup), None)
+            if prompt is None:
+                raise RuntimeError(f"no format buttons: {client.chats[chat_id][-1].text if client.chats[chat_id] else ''}")
+            button = prompt.reply_markup.inline_keyboard[0][0]
+            job.queued += await client.dispatch(FakeCallbackQuery(client, prompt, job.user_id, button.callback_data))
+
+        job.ok = any(getattr(m, "delivered", False) for m in client.chats[chat_id])
+        if not job.ok:
+            job.error = client.chats[chat_id][-1].text if client.chats[chat_id] else "no reply"
+    except Exception as e:
+        job.error = repr(e)
+    finally:
+        job.latency = time.monotonic() - started
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        command, _, weight = part.partition("=")
+        mix[command.strip()] = float(weight or 1)
+    return mix
+
+
+async def run_load(args):
+    from .watchdog import watchdog
+
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        sample_path = make_sample(os.path.join(workdir, "sample.mp4"), args.seconds, args.size)
+        make_audio_sample(os.path.join(workdir, "sample.m4a"), args.seconds)
+        width, height = map(int, args.size.split("x"))
+        sample = FakeMedia(sample_path, args.seconds, width, height)
+        server, base_url = start_file_server(workdir, int(args.http_mbps * 125_000))
+
+        bot = build_bot(args, sample)
+        setup_logging(level="INFO" if args.verbose else "WARNING", fmt="text")
+        await bot.db.initialize()
+        user_ids = list(range(10_000, 10_000 + args.users))
+        bot.access.users = set(user_ids)
+        if args.ffmpeg:
+            for user_id in user_ids:
+                await bot.db.set_ffmpeg_code(user_id, args.ffmpeg)
+        watchdog.start()
+
+        mix = parse_mix(args.mix)
+        rng = random.Random(args.seed)
+        jobs = [Job(user_id, rng.choices(list(mix), weights=list(mix.values()))[0]) for user_id in user_ids]
+        started = time.monotonic()
+        tasks = []
+        for job in jobs:
+            tasks.append(asyncio.create_task(run_user(bot, job, base_url, sample)))
+            await asyncio.sleep(rng.expovariate(args.rate))
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - started
+        server.shutdown()
+        return report(jobs, elapsed, bot.app.calls, watchdog.report())
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def report(jobs, elapsed, calls, loop):
+    def latencies(selected):
+        values = [job.latency for job in selected if job.ok]
+        if not values:
+            return {}
+        return {f"p{int(pct * 100)}": percentile(values, pct) for pct in (0.5, 0.95, 0.99)} | {"max": max(values)}
+
+    by_command = collections.defaultdict(list)
+    for job in jobs:
+        by_command[job.command].append(job)
+    completed = [job for job in jobs if job.ok]
+    errors = collections.Counter(job.error[:80] for job in jobs if not job.ok and job.error)
+    return {
+        "users": len(jobs),
+        "elapsed_s": elapsed,
+        "completed": len(completed),
+        "failed": len(jobs) - len(completed),
+        "throughput_jobs_per_min": len(completed) / elapsed * 60 if elapsed else 0,
+        "latency_s": latencies(jobs),
+        "queue_wait_p95_s": percentile([job.queued for job in jobs], 0.95) if jobs else 0,
+        "commands": {
+            command: {"jobs": len(selected), "completed": sum(job.ok for job in selected), "latency_s": latencies(selected)}
+            for command, selected in by_command.items()
+        },
+        "telegram_calls": dict(calls),
+        # ru_maxrss is in KiB on Linux; children covers FFmpeg and the yt-dlp workers
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "loop_lag_ms": loop["lag_ms"],
+        "loop_stalls": loop["stalls"],
+        "top_errors": dict(errors.most_common(5)),
+    }
+
+
+def print_report(result):
+    print(f"{result['users']} users in {result['elapsed_s']:.1f}s: {result['completed']} completed, "
+          f"{result['failed']} failed, {result['throughput_jobs_per_min']:.1f} jobs/min")
+    for command, stats in result["commands"].items():
+        latency = " ".join(f"{name}={value:.1f}s" for name, value in stats["latency_s"].items())
+        print(f"  /{command:<4} {stats['completed']:>3}/{stats['jobs']:<3} {latency}")
+    print(f"Queue wait p95: {result['queue_wait_p95_s']:.1f}s")
+    print(f"Telegram calls: {', '.join(f'{name}={count}' for name, count in result['telegram_calls'].items())}")
+    print(f"Peak RSS: {result['peak_rss_mb']:.0f} MB (largest child {result['peak_child_rss_mb']:.0f} MB)")
+    lag = result["loop_lag_ms"]
+    print(f"Loop lag: p50={lag['p50']:.0f}ms p99={lag['p99']:.0f}ms max={lag['max']:.0f}ms, {result['loop_stalls']} stalls")
+    for error, count in result["top_errors"].items():
+        print(f"  {count}x {error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive the bot's handlers with simulated concurrent users")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=5.0, help="user arrivals per second (Poisson)")
+    parser.add_argument("--mix", default="l=1,ylc=1,add=1", help="command weights, e.g. l=2,lc=1,ylc=1,yl=1,ya=1,add=1")
+    parser.add_argument("--seconds", type=int, default=20, help="sample video length")
+    parser.add_argument("--size", default="1280x720", help="sample video size")
+    parser.add_argument("--ffmpeg", default="", help="FFmpeg arguments for every user (default: the bot's)")
+    parser.add_argument("--rtt", type=float, default=0.05, help="seconds per Telegram API call")
+    parser.add_argument("--workers", type=int, default=None, help="concurrent handlers (default: pyrogram's)")
+    parser.add_argument("--up-mbps", type=float, default=50.0, help="simulated Telegram upload bandwidth")
+    parser.add_argument("--down-mbps", type=float, default=100.0, help="simulated Telegram download bandwidth")
+    parser.add_argument("--http-mbps", type=float, default=0, help="per-connection cap of the file server (0: none)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logs")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_load(args))
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+    sys.exit(0 if result["failed"] == 0 else 1)
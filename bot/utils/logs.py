@@ -0,0 +1,202 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+import traceback
+from config import LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE, LOG_SAMPLE
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Job and user of the code that is logging; asyncio tasks and to_thread inherit them
+job_id_var = contextvars.ContextVar("log_job_id", default=None)
+user_id_var = contextvars.ContextVar("log_user_id", default=None)
+
+
+def bind(job_id=None, user_id=None):
+    """Tag log records from this context with `job_id`/`user_id`; pass the result to unbind()."""
+    return job_id_var.set(job_id), user_id_var.set(user_id)
+
+
+def unbind(tokens):
+    for var, token in zip((job_id_var, user_id_var), tokens):
+        try:
+            var.reset(token)
+        except ValueError:
+            # Bound in another context (a task copied from ours); ours was never changed
+            pass
+
+
+def parse_sample_rates(text):
+    """{"bot.database.db_manager": 20} from "bot.database.db_manager=20,..."; keeps 1 in N records."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        name, _, every = item.partition("=")
+        rates[name.strip()] = max(1, int(every))
+    return rates
+
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the job and user they belong to, on the calling thread."""
+
+    def filter(self, record):
+        record.job_id = job_id_var.get()
+        record.user_id = user_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps 1 in N INFO/DEBUG records per configured logger; warnings and errors always pass."""
+
+    def __init__(self, rates, stats):
+        super().__init__()
+        self.rates = rates
+        self.stats = stats
+        self.counters = {}
+
+    def filter(self, record):
+        record.sampled = 1
+        if record.levelno >= logging.WARNING:
+            return True
+        every = self.rates.get(record.name)
+        if every is None:
+            return True
+        seen = self.counters.get(record.name, 0)
+        self.counters[record.name] = seen + 1
+        if seen % every:
+            self.stats["sampled_out"] += 1
+            return False
+        # Each kept record stands for `every` calls
+        record.sampled = every
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the job/user tags and, for errors, the traceback."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in ("job_id", "user_id"):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if getattr(record, "sampled", 1) > 1:
+            entry["sampled"] = record.sampled
+        if record.exc_text:
+            entry["exc"] = record.exc_text.rstrip()
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TimedQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks the caller and measures what each log call costs it."""
+
+    def __init__(self, log_queue, stats):
+        super().__init__(log_queue)
+        self.stats = stats
+
+    def handle(self, record):
+        started = time.perf_counter_ns()
+        try:
+            return super().handle(record)
+        finally:
+            self.stats["calls"] += 1
+            self.stats["caller_ns"] += time.perf_counter_ns() - started
+
+    def prepare(self, record):
+        # Only merge args and render the traceback here; formatting is left to the writer thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info))
+            record.exc_info = None
+        record.stack_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+
+class TimedStreamHandler(logging.StreamHandler):
+    """The writer thread's handler; counts the time spent formatting and writing."""
+
+    def __init__(self, stats):
+        super().__init__()
+        self.stats = stats
+
+    def emit(self, record):
+        started = time.perf_counter_ns()
+        super().emit(record)
+        self.stats["written"] += 1
+        self.stats["writer_ns"] += time.perf_counter_ns() - started
+
+
+class LogPipeline:
+    """Root logging through a bounded queue drained by one background writer thread."""
+
+    def __init__(self):
+        self.queue = None
+        self.listener = None
+        self.stats = {"calls": 0, "caller_ns": 0, "written": 0, "writer_ns": 0, "sampled_out": 0, "dropped": 0}
+        self._lock = threading.Lock()
+
+    def setup(self, level=LOG_LEVEL, fmt=LOG_FORMAT, queue_size=LOG_QUEUE_SIZE, sample=LOG_SAMPLE):
+        """Install the pipeline on the root logger, replacing its handlers; safe to call again."""
+        with self._lock:
+            if self.listener is not None:
+                self.listener.stop()
+            self.queue = queue.Queue(queue_size)
+            writer = TimedStreamHandler(self.stats)
+            writer.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+            handler = TimedQueueHandler(self.queue, self.stats)
+            handler.addFilter(SamplingFilter(parse_sample_rates(sample), self.stats))
+            handler.addFilter(ContextFilter())
+
+            root = logging.getLogger()
+            for old in list(root.handlers):
+                root.removeHandler(old)
+            root.addHandler(handler)
+            root.setLevel(level)
+
+            self.listener = logging.handlers.QueueListener(self.queue, writer, respect_handler_level=True)
+            self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Flush what is queued and stop the writer thread."""
+        with self._lock:
+            if self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+
+    def report(self) -> dict:
+        stats = self.stats
+        return {
+            "calls": stats["calls"],
+            "caller_us_per_call": stats["caller_ns"] / stats["calls"] / 1000 if stats["calls"] else 0,
+            "written": stats["written"],
+            "writer_us_per_record": stats["writer_ns"] / stats["written"] / 1000 if stats["written"] else 0,
+            "sampled_out": stats["sampled_out"],
+            "dropped": stats["dropped"],
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+        }
+
+
+pipeline = LogPipeline()
+
+
+def setup_logging(**kwargs):
+    pipeline.setup(**kwargs)
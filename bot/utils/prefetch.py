@@ -0,0 +1,196 @@
+import asyncio
+import glob
+import logging
+import os
+import re
+import threading
+from config import (
+    PREFETCH_ENABLED, PREFETCH_MAX_ACTIVE, PREFETCH_DISK_BUDGET, PREFETCH_TTL
+)
+from .downloader import download_with_ytdlp, get_cookies, get_executor
+from .workspace import Workspace
+
+LOGGER = logging.getLogger(__name__)
+
+# Every button downloads "<format>+bestaudio/best", so the audio track is needed whatever is picked
+AUDIO_FORMAT = "bestaudio"
+# Prefetches yield to real downloads in the shared "down" channel
+PREFETCH_WEIGHT = 0.25
+
+
+class PrefetchStopped(Exception):
+    """Raised from the progress hook to abort a prefetch at the next block."""
+
+
+def input_stem(title):
+    """File name stem of a /yl or /ylc download; prefetch writes its parts under the same stem."""
+    return re.sub(r'[^\w\-_\.]', '_', title).strip()
+
+
+class Prefetch:
+    """One speculative download running while a format keyboard is shown."""
+
+    def __init__(self, session, predicted, workspace):
+        self.session = session
+        self.predicted = predicted
+        self.workspace = workspace
+        self.stem = input_stem(session.title)
+        self.stop = threading.Event()
+        self.bytes = {}
+        self.task = None
+        self.timer = None
+
+    @property
+    def on_disk(self):
+        return sum(self.bytes.values())
+
+    def part_template(self):
+        # The names yt-dlp gives the parts of "<stem>.mp4" when merging "<format>+bestaudio",
+        # so the real download finds them finished (skipped) or as .part files (resumed)
+        return self.workspace.file(f"{self.stem}.f%(format_id)s.%(ext)s")
+
+
+class Prefetcher:
+    """Starts the likely download while the user is still choosing, under global bandwidth and disk budgets.
+
+    The audio track is always fetched; the video format is guessed from the user's past picks.
+    A pick hands the prefetch workspace to the job, whose yt-dlp run then skips or resumes the
+    prefetched parts. A wrong video guess is stopped at its next block and its part deleted.
+    """
+
+    def __init__(self, db, bandwidth, enabled=PREFETCH_ENABLED, max_active=PREFETCH_MAX_ACTIVE,
+                 disk_budget=PREFETCH_DISK_BUDGET, ttl=PREFETCH_TTL):
+        self.db = db
+        self.bandwidth = bandwidth
+        self.enabled = enabled
+        self.max_active = max_active
+        self.disk_budget = disk_budget
+        self.ttl = ttl
+        self.active = {}
+        self.stats = {"started": 0, "hits": 0, "misses": 0, "expired": 0, "promoted": 0, "wasted": 0}
+
+    def used(self):
+        return sum(prefetch.on_disk for prefetch in self.active.values())
+
+    async def predict(self, session):
+        """The format the user most often picks by height, or None without history."""
+        try:
+            picks = await self.db.get_format_picks(session.user_id)
+        except Exception as e:
+            LOGGER.error(f"Failed to load format picks: {e}")
+            return None
+        best = None
+        for f in session.formats:
+            count = picks.get(f.get('resolution') or 0, 0)
+            if count and (best is None or count > best[0]):
+                best = (count, str(f['format_id']))
+        return best[1] if best else None
+
+    async def start(self, session):
+        """Begin prefetching for a freshly shown keyboard, if enabled and within budget."""
+        if not self.enabled or session.request_id in self.active or len(self.active) >= self.max_active:
+            return
+        if self.used() >= self.disk_budget:
+            return
+        predicted = await self.predict(session)
+        if predicted and self.used() + session.filesize(predicted) > self.disk_budget:
+            predicted = None
+
+        prefetch = Prefetch(session, predicted, Workspace("prefetch", session.filesize(predicted) if predicted else 0))
+        self.active[session.request_id] = prefetch
+        self.stats["started"] += 1
+        prefetch.task = asyncio.create_task(self._run(prefetch))
+        prefetch.timer = asyncio.get_running_loop().call_later(self.ttl, self._expire, session.request_id)
+        LOGGER.info(f"Prefetching {AUDIO_FORMAT}{f' + {predicted}' if predicted else ''} for {session.request_id}")
+
+    async def _run(self, prefetch):
+        loop = asyncio.get_running_loop()
+        user_id = prefetch.session.user_id
+        async with self.bandwidth.flow("prefetch", user_id) as budget_flow, \
+                self.bandwidth.flow("down", user_id, weight=PREFETCH_WEIGHT) as down_flow:
+
+            def hook(d):
+                if prefetch.stop.is_set():
+                    raise PrefetchStopped("stopped")
+                if d.get('status') != 'downloading':
+                    return
+                downloaded = d.get('downloaded_bytes', 0) or 0
+                prefetch.bytes[d.get('filename')] = downloaded
+                if self.used() > self.disk_budget:
+                    raise PrefetchStopped("disk budget exhausted")
+                total = d.get('total_bytes', 0) or d.get('total_bytes_estimate', 0) or 0
+                budget_flow.advance_threadsafe(downloaded, total)
+                down_flow.advance_threadsafe(downloaded, total)
+
+            for spec in [AUDIO_FORMAT] + ([prefetch.predicted] if prefetch.predicted else []):
+                if prefetch.stop.is_set():
+                    break
+                opts = {
+                    'format': spec,
+                    'outtmpl': prefetch.part_template(),
+                    'progress_hooks': [hook],
+                    'quiet': True,
+                    'noprogress': True,
+                    'no_warnings': True,
+                    'cookies': get_cookies(),
+                }
+                try:
+                    await loop.run_in_executor(get_executor(), download_with_ytdlp, prefetch.session.url, opts)
+                except Exception as e:
+                    # Stopped on purpose, or a format the site will not serve alone; the job copes either way
+                    LOGGER.info(f"Prefetch of {spec} for {prefetch.session.request_id} ended early: {e}")
+
+    async def _halt(self, prefetch):
+        prefetch.stop.set()
+        if prefetch.timer:
+            prefetch.timer.cancel()
+        if prefetch.task:
+            await asyncio.gather(prefetch.task, return_exceptions=True)
+
+    async def claim(self, session, format_id):
+        """Hand the prefetch workspace for `session` to the job downloading `format_id`, or None."""
+        prefetch = self.active.pop(session.request_id, None)
+        if prefetch is None:
+            return None
+        await self._halt(prefetch)
+        if prefetch.predicted and prefetch.predicted != format_id:
+            self.stats["misses"] += 1
+            for path in glob.glob(glob.escape(prefetch.workspace.file(f"{prefetch.stem}.f{prefetch.predicted}.")) + "*"):
+                self.stats["wasted"] += os.path.getsize(path)
+                os.remove(path)
+        elif prefetch.predicted:
+            self.stats["hits"] += 1
+        self.stats["promoted"] += sum(
+            os.path.getsize(os.path.join(prefetch.workspace.path, name)) for name in os.listdir(prefetch.workspace.path)
+        )
+        return prefetch.workspace
+
+    def _expire(self, request_id):
+        prefetch = self.active.pop(request_id, None)
+        if prefetch is None:
+            return
+        self.stats["expired"] += 1
+        self.stats["wasted"] += prefetch.on_disk
+        asyncio.ensure_future(self._discard(prefetch))
+
+    async def _discard(self, prefetch):
+        await self._halt(prefetch)
+        prefetch.workspace.cleanup()
+
+    async def record_pick(self, session, format_id):
+        """Remember the height the user picked, for the next prediction."""
+        height = next((f.get('resolution') for f in session.formats if str(f['format_id']) == format_id), None)
+        if not height:
+            return
+        try:
+            await self.db.add_format_pick(session.user_id, height)
+        except Exception as e:
+            LOGGER.error(f"Failed to record format pick: {e}")
+
+    def describe(self):
+        stats = self.stats
+        return (
+            f"{stats['started']} prefetches, {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['expired']} expired, {stats['promoted'] / (1024 * 1024):.0f} MB promoted, "
+            f"{stats['wasted'] / (1024 * 1024):.0f} MB wasted"
+        )
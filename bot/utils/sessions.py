@@ -0,0 +1,78 @@
+import logging
+import secrets
+import time
+from collections import OrderedDict
+from config import SESSION_MAX_SIZE, SESSION_TTL
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Session:
+    """State behind one format keyboard: the URL plus the info already extracted for it."""
+
+    def __init__(self, request_id, user_id, url, formats=None, title=None, **extra):
+        self.request_id = request_id
+        self.user_id = user_id
+        self.url = url
+        self.formats = formats or []
+        self.title = title
+        self.extra = extra
+        self.created = time.monotonic()
+        self.last_access = self.created
+
+    def filesize(self, format_id) -> int:
+        """Size yt-dlp reported for `format_id`, or 0 if unknown."""
+        for f in self.formats:
+            if str(f.get('format_id')) == format_id:
+                return f.get('filesize') or 0
+        return 0
+
+
+class SessionStore:
+    """Callback sessions keyed by (chat id, status message id, request id) with TTL and LRU eviction."""
+
+    def __init__(self, max_size: int = SESSION_MAX_SIZE, ttl: float = SESSION_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @staticmethod
+    def new_request_id() -> str:
+        """Short random id that fits into callback data next to the format id."""
+        return secrets.token_hex(4)
+
+    def put(self, chat_id, message_id, session: Session):
+        key = (chat_id, message_id, session.request_id)
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        self._evict()
+
+    def get(self, chat_id, message_id, request_id):
+        """Return the live session for a button press, or None if it expired or was evicted."""
+        key = (chat_id, message_id, request_id)
+        session = self._sessions.get(key)
+        if session is None:
+            return None
+        now = time.monotonic()
+        if now - session.last_access > self.ttl:
+            del self._sessions[key]
+            return None
+        session.last_access = now
+        self._sessions.move_to_end(key)
+        return session
+
+    def pop(self, chat_id, message_id, request_id):
+        return self._sessions.pop((chat_id, message_id, request_id), None)
+
+    def _evict(self):
+        now = time.monotonic()
+        # Oldest entries sit at the front, so expired ones can be dropped until a live one shows up
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if now - session.last_access <= self.ttl and len(self._sessions) <= self.max_size:
+                break
+            del self._sessions[key]
+            LOGGER.info(f"Evicted callback session {key}")
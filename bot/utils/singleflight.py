@@ -0,0 +1,150 @@
+import asyncio
+import contextlib
+import logging
+from .workspace import Workspace
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SharedStatus:
+    """Stands in for a status message and mirrors every edit to all jobs attached to a flight."""
+
+    def __init__(self):
+        self.messages = []
+        # Progress callbacks compare against the current text to skip redundant edits
+        self.text = ""
+
+    def attach(self, message):
+        self.messages.append(message)
+
+    def detach(self, message):
+        if message in self.messages:
+            self.messages.remove(message)
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        results = await asyncio.gather(
+            *(message.edit_text(text, **kwargs) for message in list(self.messages)), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                LOGGER.debug(f"Shared status edit failed: {result}")
+
+
+class Flight:
+    """One piece of work shared by every job that asked for the same key.
+
+    The leader's `work(flight)` writes into `flight.workspace` and reports through `flight.status`.
+    The workspace lives until the last attached job lets go, so followers can still upload from it.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.status = SharedStatus()
+        self.workspace = None
+        self.task = None
+        self.refs = 0
+        self.sent = {}
+        self._send_locks = {}
+
+    @property
+    def result(self):
+        return self.task.result()
+
+    async def deliver(self, name, send, copy=None):
+        """Run `send()` once per flight for `name`; later callers get `copy(message)` of the first result.
+
+        With `copy=None` later callers just get the first message (e.g. a dump-channel copy that is
+        needed once). If the copy fails, the caller falls back to its own `send()`.
+        """
+        async with self._send_locks.setdefault(name, asyncio.Lock()):
+            if name not in self.sent or self.sent[name] is None:
+                self.sent[name] = await send()
+                return self.sent[name]
+        message = self.sent[name]
+        if copy is None:
+            return message
+        try:
+            return await copy(message)
+        except Exception as e:
+            LOGGER.warning(f"Copying the shared {name} of {self.key} failed ({e}), sending it again")
+            return await send()
+
+
+class SingleFlight:
+    """Coalesces identical in-flight work (downloads, encodes) so it runs once.
+
+    Jobs `join()` a key with a status message. The first one starts the work; the others attach
+    their status messages to its progress and await the same result. A job that is cancelled only
+    leaves; the work is cancelled when nobody is waiting for it anymore. A failed flight is
+    forgotten at once so a retry starts fresh.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.flights = {}
+        self.stats = {"started": 0, "joined": 0}
+
+    @contextlib.asynccontextmanager
+    async def join(self, key, work, status_msg, size_hint=0, workspace=None):
+        """Attach to the flight for `key`, starting `work(flight)` if there is none; yields the flight.
+
+        Inside the block the work has finished; `flight.result` is its return value. A new flight
+        works in `workspace` when given (e.g. a prefetch); joining an existing one cleans it up.
+        """
+        flight = self.flights.get(key)
+        if flight is None or (flight.task.done() and not self._succeeded(flight)):
+            flight = Flight(key)
+            flight.workspace = workspace or Workspace(f"{self.name}_flight", size_hint)
+            flight.task = asyncio.create_task(work(flight))
+            flight.task.add_done_callback(lambda task, f=flight: self._finished(f))
+            self.flights[key] = flight
+            self.stats["started"] += 1
+            joined = False
+        else:
+            self.stats["joined"] += 1
+            LOGGER.info(f"Joined in-flight {self.name} {key} ({flight.refs} already waiting)")
+            joined = True
+            if workspace is not None:
+                workspace.cleanup()
+
+        flight.refs += 1
+        flight.status.attach(status_msg)
+        try:
+            if joined and not flight.task.done():
+                await status_msg.edit_text("🔗 An identical job is already running, following its progress...")
+            # Shielded: one job cancelling must not cancel the work others are waiting for
+            await asyncio.shield(flight.task)
+            yield flight
+        finally:
+            flight.status.detach(status_msg)
+            flight.refs -= 1
+            if flight.refs == 0:
+                self._release(flight)
+
+    def running(self, key):
+        """Whether work for `key` is under way or finished and still held by someone."""
+        flight = self.flights.get(key)
+        return flight is not None and (not flight.task.done() or self._succeeded(flight))
+
+    @staticmethod
+    def _succeeded(flight):
+        return not flight.task.cancelled() and flight.task.exception() is None and bool(flight.task.result())
+
+    def _finished(self, flight):
+        # Keep a good result for late joiners while it is in use; drop failures right away
+        if not self._succeeded(flight) and self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    def _release(self, flight):
+        if not flight.task.done():
+            LOGGER.info(f"Nobody is waiting for {self.name} {flight.key} anymore, cancelling it")
+            flight.task.cancel()
+            flight.task.add_done_callback(lambda _: flight.workspace.cleanup())
+        else:
+            flight.workspace.cleanup()
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    def describe(self):
+        return f"{self.name}: {self.stats['started']} run, {self.stats['joined']} joined, {len(self.flights)} active"
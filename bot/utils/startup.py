@@ -0,0 +1,196 @@
+import argparse
+import importlib.abc
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# Kept free of config/pyrogram imports: this module is loaded first so it can time everything else
+STARTUP_PROFILE_PATH = os.getenv('STARTUP_PROFILE_PATH', 'startup_profile.jsonl')
+TOP_IMPORTS = 15
+
+
+class _TimedLoader(importlib.abc.Loader):
+    """Wraps a module's loader just long enough to time its execution."""
+
+    def __init__(self, loader, finder):
+        self.loader = loader
+        self.finder = finder
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        # Restore the real loader so nothing outlives the profile holding on to the wrapper
+        module.__loader__ = self.loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self.loader
+        state = self.finder.state()
+        state.depth += 1
+        start = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - start
+            state.depth -= 1
+            if state.depth == 0:
+                self.finder.profiler.record_import(module.__name__, elapsed)
+
+
+class _ImportTimer(importlib.abc.MetaPathFinder):
+    """Meta path hook recording inclusive load time of every outermost import.
+
+    Nesting is tracked per thread: the hook stays installed while the health server and
+    executor threads import too, and one thread's nested import must not hide another's.
+    """
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self._local = threading.local()
+
+    def state(self):
+        """This thread's import depth and the names it is currently resolving."""
+        local = self._local
+        if not hasattr(local, "depth"):
+            local.depth = 0
+            local.finding = set()
+        return local
+
+    def find_spec(self, name, path, target=None):
+        finding = self.state().finding
+        if name in finding:
+            return None
+        finding.add(name)
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, "find_spec"):
+                    continue
+                spec = finder.find_spec(name, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            finding.discard(name)
+        if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+            spec.loader = _TimedLoader(spec.loader, self)
+        return spec
+
+
+class StartupProfiler:
+    """Import times and phase marks from process start to the first Telegram update."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.imports = {}
+        self.marks = {}
+        self._timer = None
+        self.finished = False
+
+    def install(self):
+        if self._timer is None:
+            self._timer = _ImportTimer(self)
+            sys.meta_path.insert(0, self._timer)
+
+    def uninstall(self):
+        if self._timer in sys.meta_path:
+            sys.meta_path.remove(self._timer)
+        self._timer = None
+
+    def record_import(self, name, elapsed):
+        self.imports[name] = self.imports.get(name, 0) + elapsed
+
+    def mark(self, phase):
+        """Record the time since process start at which `phase` was reached."""
+        self.marks[phase] = time.perf_counter() - self.start
+
+    def first_update(self):
+        """Called on the first update the bot receives; closes and saves the profile."""
+        if self.finished:
+            return
+        self.finished = True
+        self.mark("first_update")
+        self.uninstall()
+        record = self.report()
+        top = ", ".join(f"{name}={ms:.0f}ms" for name, ms in list(record["imports_ms"].items())[:5])
+        LOGGER.info(
+            f"Startup profile: first update after {record['marks_ms']['first_update']:.0f}ms, "
+            f"imports {record['imports_total_ms']:.0f}ms ({top})"
+        )
+        self.save(record)
+
+    def report(self) -> dict:
+        imports = sorted(self.imports.items(), key=lambda item: item[1], reverse=True)
+        return {
+            "time": time.time(),
+            "python": sys.version.split()[0],
+            "imports_total_ms": sum(self.imports.values()) * 1000,
+            "imports_ms": {name: elapsed * 1000 for name, elapsed in imports[:TOP_IMPORTS]},
+            "marks_ms": {phase: elapsed * 1000 for phase, elapsed in self.marks.items()},
+        }
+
+    def save(self, record, path=STARTUP_PROFILE_PATH):
+        try:
+            with open(path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            LOGGER.error(f"Failed to save startup profile: {e}")
+
+
+profiler = StartupProfiler()
+
+
+def load_history(path=STARTUP_PROFILE_PATH):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def check_regression(history, metric="first_update", window=5, max_regression=0.2):
+    """Compare the latest run against the median of the previous `window`; returns (latest, baseline, ok)."""
+    values = [
+        run["marks_ms"].get(metric) if metric in run["marks_ms"] else run.get(f"{metric}_ms")
+        for run in history
+    ]
+    values = [value for value in values if value is not None]
+    if len(values) < 2:
+        return (values[-1] if values else None), None, True
+    latest = values[-1]
+    baseline = statistics.median(values[-window - 1:-1])
+    return latest, baseline, latest <= baseline * (1 + max_regression)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show startup profiles and flag regressions")
+    parser.add_argument("--path", default=STARTUP_PROFILE_PATH)
+    parser.add_argument("--metric", default="first_update", help="a phase mark or 'imports_total'")
+    parser.add_argument("--window", type=int, default=5)
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    history = load_history(args.path)
+    if not history:
+        print(f"No startup profiles in {args.path}")
+        sys.exit(0)
+
+    latest_run = history[-1]
+    print("Phases (ms since start):")
+    for phase, ms in latest_run["marks_ms"].items():
+        print(f"  {phase:<16} {ms:8.0f}")
+    print(f"Imports ({latest_run['imports_total_ms']:.0f}ms total):")
+    for name, ms in latest_run["imports_ms"].items():
+        print(f"  {name:<32} {ms:8.0f}")
+
+    latest, baseline, ok = check_regression(history, args.metric, args.window, args.max_regression)
+    if baseline is not None:
+        print(f"{args.metric}: {latest:.0f}ms vs baseline {baseline:.0f}ms -> {'ok' if ok else 'REGRESSION'}")
+    sys.exit(0 if ok else 1)
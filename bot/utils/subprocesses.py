@@ -0,0 +1,22 @@
+import asyncio
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+async def run_process(*args, stdout=asyncio.subprocess.PIPE):
+    """Run `args` to completion and return (returncode, stdout, stderr) as bytes.
+
+    If the awaiting task is cancelled the process is terminated and reaped before the
+    cancellation propagates, so /cancel never leaves an encode running in the background.
+    """
+    process = await asyncio.create_subprocess_exec(*args, stdout=stdout, stderr=asyncio.subprocess.PIPE)
+    try:
+        out, err = await process.communicate()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            LOGGER.info(f"Stopping cancelled {args[0]} (pid {process.pid})")
+            process.terminate()
+            await process.wait()
+        raise
+    return process.returncode, out, err
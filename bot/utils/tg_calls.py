@@ -0,0 +1,175 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import time
+from pyrogram import Client
+from pyrogram.errors import FloodWait, InternalServerError, ServiceUnavailable
+from pyrogram.session import Session
+from config import TG_CALL_CONCURRENCY, TG_CALL_RETRIES
+from .tracing import note_retry
+
+LOGGER = logging.getLogger(__name__)
+
+URGENT = 0
+NORMAL = 1
+BACKGROUND = 2
+
+# Final deliveries jump the queue; everything else is NORMAL unless the caller says otherwise
+URGENT_QUERIES = {"SendMedia", "SendMultiMedia", "ForwardMessages", "UploadMedia"}
+# Only these can be repeated after an ambiguous failure without side effects
+IDEMPOTENT_PREFIXES = ("Get", "Edit", "Save", "Resolve", "Read", "Check")
+TRANSIENT_ERRORS = (asyncio.TimeoutError, OSError, InternalServerError, ServiceUnavailable)
+
+_priority = contextvars.ContextVar("tg_call_priority", default=None)
+
+
+class CallDropped(Exception):
+    """A background call was skipped because its method is in FloodWait; a later call supersedes it."""
+
+
+class PrioritySlots:
+    """A semaphore that wakes waiters by (priority, arrival)."""
+
+    def __init__(self, size):
+        self.free = size
+        self.waiters = []
+        self.counter = itertools.count()
+
+    async def acquire(self, priority):
+        if self.free > 0 and not self.waiters:
+            self.free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancel landed
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+
+class TelegramScheduler:
+    """Runs Telegram calls with FloodWait handling, retries with jitter and priority queueing."""
+
+    def __init__(self, concurrency=TG_CALL_CONCURRENCY, retries=TG_CALL_RETRIES):
+        self.slots = None
+        self.concurrency = concurrency
+        self.retries = retries
+        self.flood_until = {}
+        self.stats = {
+            "calls": 0, "flood_waits": 0, "flood_seconds": 0.0,
+            "queue_seconds": 0.0, "retries": 0, "dropped": 0,
+        }
+
+    def priority_for(self, name):
+        override = _priority.get()
+        if override is not None:
+            return override
+        return URGENT if name in URGENT_QUERIES else NORMAL
+
+    async def _wait_flood(self, name, priority):
+        while True:
+            remaining = self.flood_until.get(name, 0) - time.monotonic()
+            if remaining <= 0:
+                return
+            if priority == BACKGROUND:
+                self.stats["dropped"] += 1
+                raise CallDropped(f"{name} is in FloodWait for {remaining:.0f}s")
+            self.stats["flood_seconds"] += remaining
+            await asyncio.sleep(remaining)
+
+    async def run(self, name, call):
+        """Run `call()` (one Telegram request named `name`) under the scheduling rules."""
+        if self.slots is None:
+            self.slots = PrioritySlots(self.concurrency)
+        priority = self.priority_for(name)
+        idempotent = name.startswith(IDEMPOTENT_PREFIXES)
+        attempt = 0
+        while True:
+            await self._wait_flood(name, priority)
+            queued = time.monotonic()
+            await self.slots.acquire(priority)
+            self.stats["queue_seconds"] += time.monotonic() - queued
+            delay = 0
+            try:
+                self.stats["calls"] += 1
+                return await call()
+            except FloodWait as e:
+                # Nothing was executed, so retrying is safe for every method
+                self.stats["flood_waits"] += 1
+                self.flood_until[name] = max(self.flood_until.get(name, 0), time.monotonic() + e.value)
+                LOGGER.warning(f"FloodWait of {e.value}s on {name}")
+            except TRANSIENT_ERRORS as e:
+                attempt += 1
+                if not idempotent or attempt > self.retries:
+                    raise
+                self.stats["retries"] += 1
+                note_retry()
+                delay = min(30, 2 ** attempt) * random.uniform(0.5, 1.5)
+                LOGGER.warning(f"{name} failed ({e!r}), retry {attempt}/{self.retries} in {delay:.1f}s")
+            finally:
+                self.slots.release()
+            # Back off outside the slot so other calls keep flowing
+            await asyncio.sleep(delay)
+
+    def describe(self):
+        stats = self.stats
+        return (
+            f"{stats['calls']} calls, {stats['flood_waits']} FloodWaits ({stats['flood_seconds']:.0f}s waited), "
+            f"{stats['queue_seconds']:.0f}s queued, {stats['retries']} retries, {stats['dropped']} progress edits dropped"
+        )
+
+
+scheduler = TelegramScheduler()
+
+
+class ScheduledClient(Client):
+    """pyrogram Client whose every request goes through the scheduler.
+
+    Built with sleep_threshold=0, so every FloodWait reaches the scheduler instead of being slept
+    inside the session where nobody can see or prioritize it.
+    """
+
+    def __init__(self, *args, scheduler=scheduler, **kwargs):
+        kwargs.setdefault("sleep_threshold", 0)
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    async def invoke(self, query, retries=Session.MAX_RETRIES, timeout=Session.WAIT_TIMEOUT, sleep_threshold=None):
+        return await self.scheduler.run(
+            type(query).__name__,
+            lambda: super(ScheduledClient, self).invoke(query, retries, timeout, sleep_threshold)
+        )
+
+
+async def background(coro):
+    """Await a non-urgent call (progress edit) behind urgent ones; returns None if it was dropped."""
+    token = _priority.set(BACKGROUND)
+    try:
+        return await coro
+    except CallDropped:
+        return None
+    finally:
+        _priority.reset(token)
+
+
+async def urgent(coro):
+    """Await a call that should jump ahead of queued progress edits."""
+    token = _priority.set(URGENT)
+    try:
+        return await coro
+    finally:
+        _priority.reset(token)
@@ -0,0 +1,501 @@
+import asyncio
+import inspect
+import logging
+import math
+import os
+from pyrogram import StopTransmission, raw, types, utils
+from pyrogram.errors import FilePartMissing, FloodWait
+from pyrogram.file_id import FileId, FileType
+from pyrogram.session import Auth, Session
+from .tracing import note_retry
+from config import (
+    UPLOAD_SESSIONS, UPLOAD_WORKERS_PER_SESSION, TRANSFER_PART_RETRIES,
+    DOWNLOAD_SESSIONS, DOWNLOAD_WORKERS_PER_SESSION, PROGRESSIVE_POLL_INTERVAL
+)
+
+LOGGER = logging.getLogger(__name__)
+
+PART_SIZE = 512 * 1024
+# Telegram only accepts SaveBigFilePart above this size
+BIG_FILE_SIZE = 10 * 1024 * 1024
+# upload.GetFile limit; offsets stay 1 MB aligned so no request crosses a 1 MB boundary
+CHUNK_SIZE = 1024 * 1024
+
+# Authorized keys for DCs other than the client's own, keyed by (client name, dc id)
+_dc_auth_keys = {}
+_dc_auth_lock = asyncio.Lock()
+
+
+async def get_dc_auth_key(client, dc_id):
+    """An auth key for a foreign DC, created and authorized once per process like pyrogram's get_file does."""
+    key = (client.name, dc_id)
+    async with _dc_auth_lock:
+        if key not in _dc_auth_keys:
+            test_mode = await client.storage.test_mode()
+            auth_key = await Auth(client, dc_id, test_mode).create()
+            session = Session(client, dc_id, auth_key, test_mode, is_media=True)
+            await session.start()
+            try:
+                exported = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+                await session.invoke(
+                    raw.functions.auth.ImportAuthorization(id=exported.id, bytes=exported.bytes)
+                )
+            finally:
+                await session.stop()
+            _dc_auth_keys[key] = auth_key
+        return _dc_auth_keys[key]
+
+
+async def default_session_factory(client, dc_id=None):
+    """A media session on `dc_id` (the client's own DC by default), like pyrogram's save_file uses."""
+    own_dc = await client.storage.dc_id()
+    dc_id = dc_id or own_dc
+    auth_key = await client.storage.auth_key() if dc_id == own_dc else await get_dc_auth_key(client, dc_id)
+    return Session(client, dc_id, auth_key, await client.storage.test_mode(), is_media=True)
+
+
+class MediaSessionPool:
+    """Several started media sessions for one transfer; use with `async with`."""
+
+    def __init__(self, client, count, session_factory=None, dc_id=None):
+        self.client = client
+        self.count = count
+        self.session_factory = session_factory or default_session_factory
+        self.dc_id = dc_id
+        self.sessions = []
+
+    async def __aenter__(self):
+        for _ in range(self.count):
+            session = await self.session_factory(self.client, self.dc_id)
+            await session.start()
+            self.sessions.append(session)
+        return self.sessions
+
+    async def __aexit__(self, exc_type, exc, tb):
+        for session in self.sessions:
+            try:
+                await session.stop()
+            except Exception as e:
+                LOGGER.error(f"Failed to stop media session: {e}")
+        self.sessions = []
+
+
+async def invoke_with_retry(session, query, retries=TRANSFER_PART_RETRIES, what="part", sleep_on_flood=True):
+    """Invoke on `session`, sleeping through FloodWait (or re-raising it) and retrying other errors with backoff."""
+    attempt = 0
+    while True:
+        try:
+            return await session.invoke(query)
+        except FloodWait as e:
+            LOGGER.warning(f"FloodWait of {e.value}s on {what}")
+            if not sleep_on_flood:
+                raise
+            await asyncio.sleep(e.value)
+        except (StopTransmission, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            LOGGER.warning(f"{what} failed ({e}), retry {attempt}/{retries}")
+            note_retry()
+            await asyncio.sleep(attempt)
+
+
+async def call_progress(progress, current, total, progress_args):
+    """Invoke a pyrogram-style progress callback with the same contract as Client.save_file."""
+    if inspect.iscoroutinefunction(progress):
+        await progress(current, total, *progress_args)
+    else:
+        await asyncio.to_thread(progress, current, total, *progress_args)
+
+
+class ParallelUploader:
+    """Uploads big files with SaveBigFilePart spread over several media sessions.
+
+    Files up to 10 MB and every non-upload step still go through the regular client.
+    `session_factory(client, dc_id)` can be swapped for tests to avoid real connections.
+    With `sleep_on_flood=False` a FloodWait is raised to the caller instead of slept through.
+    """
+
+    def __init__(self, client, sessions=UPLOAD_SESSIONS, workers_per_session=UPLOAD_WORKERS_PER_SESSION,
+                 retries=TRANSFER_PART_RETRIES, session_factory=None, sleep_on_flood=True):
+        self.client = client
+        self.session_count = sessions
+        self.workers_per_session = workers_per_session
+        self.retries = retries
+        self.session_factory = session_factory
+        self.sleep_on_flood = sleep_on_flood
+
+    async def upload(self, path, progress=None, progress_args=(), file_id=None, parts=None):
+        """Upload `path` and return the raw InputFile(Big) to attach to a message.
+
+        `file_id`/`parts` re-send only the given part numbers of an earlier upload (FilePartMissing).
+        """
+        file_size = os.path.getsize(path)
+        if file_size == 0:
+            raise ValueError("File size equals to 0 B")
+        if file_size <= BIG_FILE_SIZE:
+            return await self.client.save_file(path, progress=progress, progress_args=progress_args)
+
+        total_parts = math.ceil(file_size / PART_SIZE)
+        file_id = file_id or self.client.rnd_id()
+        queue = asyncio.Queue()
+        for part in (parts if parts is not None else range(total_parts)):
+            queue.put_nowait(part)
+
+        done = [0]
+        progress_lock = asyncio.Lock()
+        fd = os.open(path, os.O_RDONLY)
+
+        async def worker(session):
+            while True:
+                try:
+                    part = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                chunk = await asyncio.to_thread(os.pread, fd, PART_SIZE, part * PART_SIZE)
+                await invoke_with_retry(
+                    session,
+                    raw.functions.upload.SaveBigFilePart(
+                        file_id=file_id,
+                        file_part=part,
+                        file_total_parts=total_parts,
+                        bytes=chunk
+                    ),
+                    self.retries,
+                    what=f"upload part {part}/{total_parts}",
+                    sleep_on_flood=self.sleep_on_flood
+                )
+                if progress:
+                    # Serialised like pyrogram's loop, so a pacing callback slows every worker
+                    async with progress_lock:
+                        done[0] += len(chunk)
+                        await call_progress(progress, done[0], file_size, progress_args)
+
+        try:
+            async with MediaSessionPool(self.client, self.session_count, self.session_factory) as sessions:
+                workers = [
+                    asyncio.create_task(worker(session))
+                    for session in sessions
+                    for _ in range(self.workers_per_session)
+                ]
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    for task in workers:
+                        task.cancel()
+        finally:
+            os.close(fd)
+
+        return raw.types.InputFileBig(id=file_id, parts=total_parts, name=os.path.basename(path))
+
+    async def upload_growing(self, path, writer, final_path=None, flow=None, poll=PROGRESSIVE_POLL_INTERVAL):
+        """Upload `path` while `writer` (a task) is still appending to it; returns the InputFileBig or None.
+
+        Only for append-only output such as fragmented MP4: a part is sent once the file has grown
+        past its end, with file_total_parts=-1 since the total is not known yet. After `writer`
+        finishes, the remaining parts follow and the last one carries the real part count.
+        `final_path` is where the writer renames `path` on success. Returns None when the result is
+        too small for SaveBigFilePart, so the caller uploads it the usual way.
+        """
+        file_id = self.client.rnd_id()
+        queue = asyncio.Queue()
+        fd = None
+        queued = 0
+
+        async def worker(session):
+            while True:
+                part, total_parts = await queue.get()
+                try:
+                    chunk = await asyncio.to_thread(os.pread, fd, PART_SIZE, part * PART_SIZE)
+                    if flow is not None:
+                        await flow.consume(len(chunk))
+                    await invoke_with_retry(
+                        session,
+                        raw.functions.upload.SaveBigFilePart(
+                            file_id=file_id,
+                            file_part=part,
+                            file_total_parts=total_parts,
+                            bytes=chunk
+                        ),
+                        self.retries,
+                        what=f"streamed part {part}",
+                        sleep_on_flood=self.sleep_on_flood
+                    )
+                finally:
+                    queue.task_done()
+
+        def open_output():
+            for candidate in (path, final_path):
+                if candidate and os.path.exists(candidate):
+                    return os.open(candidate, os.O_RDONLY)
+            return None
+
+        def size():
+            return os.fstat(fd).st_size
+
+        try:
+            async with MediaSessionPool(self.client, self.session_count, self.session_factory) as sessions:
+                workers = [
+                    asyncio.create_task(worker(session))
+                    for session in sessions
+                    for _ in range(self.workers_per_session)
+                ]
+                try:
+                    # Stream while the writer runs; nothing is sent until the file is surely a big one
+                    while not writer.done():
+                        await asyncio.wait([writer], timeout=poll)
+                        if fd is None:
+                            fd = open_output()
+                        if fd is None or size() <= BIG_FILE_SIZE:
+                            continue
+                        while (queued + 1) * PART_SIZE <= size():
+                            queue.put_nowait((queued, -1))
+                            queued += 1
+                    if writer.cancelled() or writer.exception() or not writer.result():
+                        return None
+
+                    if fd is None:
+                        fd = open_output()
+                    if fd is None or size() <= BIG_FILE_SIZE:
+                        return None
+                    file_size = size()
+                    total_parts = math.ceil(file_size / PART_SIZE)
+                    for part in range(queued, total_parts - 1):
+                        queue.put_nowait((part, total_parts))
+                    # The part that carries the total goes last, once every other part is stored
+                    await self._drain(queue, workers)
+                    queue.put_nowait((total_parts - 1, total_parts))
+                    await self._drain(queue, workers)
+                finally:
+                    for task in workers:
+                        task.cancel()
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+        LOGGER.info(f"Streamed {file_size} bytes of {os.path.basename(final_path or path)}, {queued} parts during the encode")
+        return raw.types.InputFileBig(id=file_id, parts=total_parts, name=os.path.basename(final_path or path))
+
+    @staticmethod
+    async def _drain(queue, workers):
+        """Wait for `queue` to empty, surfacing the first worker failure instead of hanging."""
+        join = asyncio.ensure_future(queue.join())
+        try:
+            done, _ = await asyncio.wait([join, *workers], return_when=asyncio.FIRST_COMPLETED)
+            for task in workers:
+                if task in done:
+                    task.result()
+        finally:
+            join.cancel()
+
+    async def _send_media(self, chat_id, path, media, caption, reply_to_message_id):
+        peer = await self.client.resolve_peer(chat_id)
+        reply_to = await utils.get_reply_to(
+            client=self.client, chat_id=chat_id, reply_to_message_id=reply_to_message_id
+        )
+        while True:
+            try:
+                r = await self.client.invoke(
+                    raw.functions.messages.SendMedia(
+                        peer=peer,
+                        media=media,
+                        reply_to=reply_to,
+                        random_id=self.client.rnd_id(),
+                        **await utils.parse_text_entities(self.client, caption, None, None)
+                    )
+                )
+            except FilePartMissing as e:
+                LOGGER.warning(f"Part {e.value} of {path} missing, re-uploading it")
+                await self.upload(path, file_id=media.file.id, parts=[e.value])
+                continue
+            for update in r.updates:
+                if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                    return await types.Message._parse(
+                        self.client, update.message,
+                        {user.id: user for user in r.users},
+                        {chat.id: chat for chat in r.chats}
+                    )
+            return None
+
+    async def send_video(self, chat_id, video, caption="", duration=0, width=0, height=0, thumb=None,
+                         reply_to_message_id=None, progress=None, progress_args=(), supports_streaming=True,
+                         file=None):
+        """Drop-in for Client.send_video with a local file path; `file` reuses an upload_growing() result."""
+        if file is None and os.path.getsize(video) <= BIG_FILE_SIZE:
+            return await self.client.send_video(
+                chat_id, video, caption=caption, duration=duration or 0, width=width, height=height,
+                thumb=thumb, reply_to_message_id=reply_to_message_id, supports_streaming=supports_streaming,
+                progress=progress, progress_args=progress_args
+            )
+        file = file or await self.upload(video, progress, progress_args)
+        media = raw.types.InputMediaUploadedDocument(
+            mime_type=self.client.guess_mime_type(video) or "video/mp4",
+            file=file,
+            thumb=await self.client.save_file(thumb) if thumb and os.path.exists(thumb) else None,
+            attributes=[
+                raw.types.DocumentAttributeVideo(
+                    supports_streaming=supports_streaming or None,
+                    duration=duration or 0,
+                    w=width,
+                    h=height
+                ),
+                raw.types.DocumentAttributeFilename(file_name=os.path.basename(video))
+            ]
+        )
+        return await self._send_media(chat_id, video, media, caption, reply_to_message_id)
+
+    async def send_audio(self, chat_id, audio, caption="", duration=0, title=None, performer=None, thumb=None,
+                         reply_to_message_id=None, progress=None, progress_args=()):
+        """Drop-in for Client.send_audio with a local file path."""
+        if os.path.getsize(audio) <= BIG_FILE_SIZE:
+            return await self.client.send_audio(
+                chat_id, audio, caption=caption, duration=duration or 0, title=title, performer=performer,
+                thumb=thumb, reply_to_message_id=reply_to_message_id, progress=progress, progress_args=progress_args
+            )
+        file = await self.upload(audio, progress, progress_args)
+        media = raw.types.InputMediaUploadedDocument(
+            mime_type=self.client.guess_mime_type(audio) or "audio/mpeg",
+            file=file,
+            thumb=await self.client.save_file(thumb) if thumb and os.path.exists(thumb) else None,
+            attributes=[
+                raw.types.DocumentAttributeAudio(duration=duration or 0, title=title, performer=performer),
+                raw.types.DocumentAttributeFilename(file_name=os.path.basename(audio))
+            ]
+        )
+        return await self._send_media(chat_id, audio, media, caption, reply_to_message_id)
+
+    async def send_document(self, chat_id, document, caption="", thumb=None, reply_to_message_id=None,
+                            progress=None, progress_args=()):
+        """Drop-in for Client.send_document with a local file path."""
+        if os.path.getsize(document) <= BIG_FILE_SIZE:
+            return await self.client.send_document(
+                chat_id, document, caption=caption, thumb=thumb, reply_to_message_id=reply_to_message_id,
+                progress=progress, progress_args=progress_args
+            )
+        file = await self.upload(document, progress, progress_args)
+        media = raw.types.InputMediaUploadedDocument(
+            mime_type=self.client.guess_mime_type(document) or "application/zip",
+            file=file,
+            force_file=True,
+            thumb=await self.client.save_file(thumb) if thumb and os.path.exists(thumb) else None,
+            attributes=[raw.types.DocumentAttributeFilename(file_name=os.path.basename(document))]
+        )
+        return await self._send_media(chat_id, document, media, caption, reply_to_message_id)
+
+
+class CdnRedirect(Exception):
+    """Telegram serves the file from a CDN DC, which the ranged downloader does not speak."""
+
+
+def file_location(file_id: FileId):
+    """The raw location for a decoded document/video/photo file id."""
+    if file_id.file_type == FileType.PHOTO:
+        return raw.types.InputPhotoFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size
+        )
+    return raw.types.InputDocumentFileLocation(
+        id=file_id.media_id,
+        access_hash=file_id.access_hash,
+        file_reference=file_id.file_reference,
+        thumb_size=file_id.thumbnail_size
+    )
+
+
+class ParallelDownloader:
+    """Downloads message media by fetching disjoint 1 MB ranges over several media sessions.
+
+    Chunks are written in place with pwrite into a pre-sized temp file that is renamed on success.
+    Small files and CDN-hosted files go through the regular Message.download.
+    """
+
+    def __init__(self, client, sessions=DOWNLOAD_SESSIONS, workers_per_session=DOWNLOAD_WORKERS_PER_SESSION,
+                 retries=TRANSFER_PART_RETRIES, session_factory=None):
+        self.client = client
+        self.session_count = sessions
+        self.workers_per_session = workers_per_session
+        self.retries = retries
+        self.session_factory = session_factory
+
+    async def download(self, message, file_name, progress=None, progress_args=()):
+        """Drop-in for Message.download(file_name=...); returns the path written."""
+        media = message.video or message.document or message.audio or message.animation
+        file_size = media.file_size if media else 0
+        if not media or file_size <= BIG_FILE_SIZE:
+            return await message.download(file_name=file_name, progress=progress, progress_args=progress_args)
+        try:
+            return await self._download(FileId.decode(media.file_id), file_size, file_name, progress, progress_args)
+        except CdnRedirect:
+            LOGGER.info(f"{file_name} is served from a CDN, falling back to a serial download")
+            return await message.download(file_name=file_name, progress=progress, progress_args=progress_args)
+
+    async def _download(self, file_id, file_size, file_name, progress, progress_args):
+        location = file_location(file_id)
+        total_chunks = math.ceil(file_size / CHUNK_SIZE)
+        queue = asyncio.Queue()
+        for chunk in range(total_chunks):
+            queue.put_nowait(chunk)
+
+        done = [0]
+        progress_lock = asyncio.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+        temp_path = f"{file_name}.temp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+        async def worker(session):
+            while True:
+                try:
+                    chunk = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                offset = chunk * CHUNK_SIZE
+                expected = min(CHUNK_SIZE, file_size - offset)
+                what = f"download chunk {chunk}/{total_chunks}"
+                for attempt in range(self.retries + 1):
+                    r = await invoke_with_retry(
+                        session,
+                        raw.functions.upload.GetFile(location=location, offset=offset, limit=CHUNK_SIZE),
+                        self.retries,
+                        what=what
+                    )
+                    if isinstance(r, raw.types.upload.FileCdnRedirect):
+                        raise CdnRedirect()
+                    if len(r.bytes) == expected:
+                        break
+                    LOGGER.warning(f"{what} returned {len(r.bytes)} of {expected} bytes, retrying")
+                    note_retry()
+                else:
+                    raise IOError(f"{what} kept returning short reads")
+                await asyncio.to_thread(os.pwrite, fd, r.bytes, offset)
+                if progress:
+                    async with progress_lock:
+                        done[0] += expected
+                        await call_progress(progress, done[0], file_size, progress_args)
+
+        try:
+            os.ftruncate(fd, file_size)
+            async with MediaSessionPool(
+                self.client, self.session_count, self.session_factory, file_id.dc_id
+            ) as sessions:
+                workers = [
+                    asyncio.create_task(worker(session))
+                    for session in sessions
+                    for _ in range(self.workers_per_session)
+                ]
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    for task in workers:
+                        task.cancel()
+        except BaseException:
+            os.close(fd)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        os.close(fd)
+        os.replace(temp_path, file_name)
+        return file_name
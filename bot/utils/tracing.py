@@ -0,0 +1,106 @@
+import contextlib
+import contextvars
+import logging
+import secrets
+import statistics
+import time
+from .logs import bind, unbind
+
+LOGGER = logging.getLogger(__name__)
+
+# The span of the stage currently running in this task; asyncio tasks and to_thread inherit it
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, started=None, ended=None, bytes=None, fps=None, retries=0, status="ok"):
+        self.name = name
+        self.started = started or time.time()
+        self.ended = ended
+        self.bytes = bytes
+        self.fps = fps
+        self.retries = retries
+        self.status = status
+
+    @property
+    def duration(self):
+        return (self.ended or time.time()) - self.started
+
+
+class JobTrace:
+    """Stage spans of one job (extract, download, probe, dump upload, encode, upload...)."""
+
+    def __init__(self, kind, user_id):
+        self.job_id = secrets.token_hex(6)
+        self.kind = kind
+        self.user_id = user_id
+        self.job = Span("job")
+        self.spans = []
+        # Log records from the job's task (and tasks it starts) carry its job and user id
+        self._log_tokens = bind(self.job_id, user_id)
+
+    def close(self):
+        """Stop tagging log records with this job; call once from the task that created it."""
+        if self._log_tokens is not None:
+            unbind(self._log_tokens)
+            self._log_tokens = None
+
+    def add(self, name, started, ended, **attrs):
+        """Record a stage that was timed elsewhere, e.g. extraction done before the job started."""
+        self.spans.append(Span(name, started, ended, **attrs))
+
+    @contextlib.asynccontextmanager
+    async def stage(self, name, bytes=None):
+        span = Span(name, bytes=bytes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "error" if isinstance(e, Exception) else "cancelled"
+            raise
+        finally:
+            span.ended = time.time()
+            _current_span.reset(token)
+            self.spans.append(span)
+
+    def finish(self, status=None):
+        """Close the job span; its status defaults to the first failed stage's, else "ok"."""
+        self.job.ended = time.time()
+        # Stages timed before the job object existed (extraction) still count towards it
+        self.job.started = min([self.job.started] + [span.started for span in self.spans])
+        self.job.status = status or next((span.status for span in self.spans if span.status != "ok"), "ok")
+        self.job.retries = sum(span.retries for span in self.spans)
+        return [self.job] + self.spans
+
+
+def current_span():
+    return _current_span.get()
+
+
+def note_retry():
+    """Count a retry against the running stage, if any."""
+    span = _current_span.get()
+    if span is not None:
+        span.retries += 1
+
+
+def note_fps(fps):
+    span = _current_span.get()
+    if span is not None and fps:
+        span.fps = fps
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def summarize(durations):
+    """Turn [(stage, seconds)] into {stage: (count, p50, p95)}."""
+    by_stage = {}
+    for stage, seconds in durations:
+        by_stage.setdefault(stage, []).append(seconds)
+    return {
+        stage: (len(values), statistics.median(values), percentile(values, 0.95))
+        for stage, values in by_stage.items()
+    }
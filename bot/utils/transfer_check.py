@@ -0,0 +1,370 @@
+"""Self-check of the Telegram transfer engines against in-memory fake media sessions.
+
+The engines take a `session_factory`, so their part bookkeeping can run without a network:
+`FakeTelegram` stores uploaded parts, serves ranged reads and answers SendMedia the way the
+server would (FILE_PART_X_MISSING for a part it never stored). Sessions answer after a random
+delay, so parts complete out of order as they do over real connections. UploadPool is checked
+with stub clients and uploaders through its `uploader_factory`. Run from the repository root:
+
+    python -m bot.utils.transfer_check
+"""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from pyrogram import raw
+from pyrogram.errors import FilePartMissing, FloodWait
+from pyrogram.file_id import FileId, FileType
+from .logs import setup_logging
+from .tg_transfer import BIG_FILE_SIZE, CHUNK_SIZE, PART_SIZE, ParallelDownloader, ParallelUploader
+from .upload_pool import UploadPool
+
+LOGGER = logging.getLogger(__name__)
+
+
+# --- Fake Telegram -------------------------------------------------------------------------------
+
+class FakeTelegram:
+    """The server side: uploaded parts per file id, every SaveBigFilePart in arrival order, and one
+    stored file (`blob`) served to GetFile."""
+
+    def __init__(self, rng, max_delay=0.003):
+        self.rng = rng
+        self.max_delay = max_delay
+        self.parts = {}
+        self.calls = []
+        # Parts acknowledged but not stored the first time, to provoke FILE_PART_X_MISSING
+        self.lose = set()
+        self.send_attempts = 0
+        self.sessions_started = 0
+        self.blob = b""
+        self.reads = []
+        # Offsets answered with a truncated chunk the first time, as a flaky DC sometimes does
+        self.short_reads = set()
+
+    async def session_factory(self, client, dc_id=None):
+        return FakeMediaSession(self)
+
+    async def handle(self, query):
+        await asyncio.sleep(self.rng.uniform(0, self.max_delay))
+        if isinstance(query, raw.functions.upload.SaveBigFilePart):
+            self.calls.append((query.file_id, query.file_part, query.file_total_parts))
+            if query.file_part in self.lose:
+                self.lose.discard(query.file_part)
+            else:
+                self.parts.setdefault(query.file_id, {})[query.file_part] = query.bytes
+            return True
+        if isinstance(query, raw.functions.upload.GetFile):
+            self.reads.append((query.offset, query.limit))
+            data = self.blob[query.offset:query.offset + query.limit]
+            if query.offset in self.short_reads:
+                self.short_reads.discard(query.offset)
+                data = data[:len(data) // 2]
+            return raw.types.upload.File(type=raw.types.storage.FileUnknown(), mtime=0, bytes=data)
+        raise NotImplementedError(type(query).__name__)
+
+    def send_media(self, query):
+        self.send_attempts += 1
+        file = query.media.file
+        stored = self.parts.get(file.id, {})
+        for part in range(file.parts):
+            if part not in stored:
+                raise FilePartMissing(value=part)
+        return raw.types.Updates(updates=[], users=[], chats=[], date=int(time.time()), seq=0)
+
+    def assemble(self, file_id, total_parts):
+        stored = self.parts.get(file_id, {})
+        missing = [part for part in range(total_parts) if part not in stored]
+        if missing:
+            raise AssertionError(f"parts {missing[:5]} never stored")
+        return b"".join(stored[part] for part in range(total_parts))
+
+
+class FakeMediaSession:
+    def __init__(self, server):
+        self.server = server
+
+    async def start(self):
+        self.server.sessions_started += 1
+
+    async def stop(self):
+        pass
+
+    async def invoke(self, query):
+        return await self.server.handle(query)
+
+
+class FakeParser:
+    async def parse(self, text, mode=None):
+        return {"message": text or "", "entities": None}
+
+
+class FakeClient:
+    """The few Client methods the engines call besides their media sessions."""
+
+    def __init__(self, server, rng, name="transfer_check"):
+        self.server = server
+        self.rng = rng
+        self.name = name
+        self.parser = FakeParser()
+
+    def rnd_id(self):
+        return self.rng.getrandbits(63)
+
+    def guess_mime_type(self, path):
+        return None
+
+    async def resolve_peer(self, chat_id):
+        return raw.types.InputPeerSelf()
+
+    async def invoke(self, query):
+        if isinstance(query, raw.functions.messages.SendMedia):
+            return self.server.send_media(query)
+        raise NotImplementedError(type(query).__name__)
+
+
+_message_ids = iter(range(1, 1 << 31))
+
+
+def next_message_id():
+    return next(_message_ids)
+
+
+class StubUploader:
+    """A pool worker's uploader: takes `delay` per upload and raises the FloodWaits queued in `floods`."""
+
+    def __init__(self, client, delay=0.05):
+        self.client = client
+        self.delay = delay
+        self.floods = []
+        self.sent = []
+
+    async def send_video(self, chat_id, video, caption="", **kwargs):
+        await asyncio.sleep(self.delay)
+        if self.floods:
+            raise FloodWait(value=self.floods.pop(0))
+        self.sent.append(video)
+        return SimpleNamespace(id=next_message_id(), chat=SimpleNamespace(id=chat_id))
+
+
+class StubMainClient:
+    def __init__(self):
+        self.copies = []
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        self.copies.append((chat_id, from_chat_id, message_id))
+        return SimpleNamespace(id=next_message_id(), chat=SimpleNamespace(id=chat_id))
+
+
+# --- Checks --------------------------------------------------------------------------------------
+
+def random_file(path, size, rng):
+    data = rng.randbytes(size)
+    with open(path, "wb") as f:
+        f.write(data)
+    return data
+
+
+async def check_upload(workdir, rng):
+    """Every part lands once under its own number, whatever order the sessions finish in."""
+    server = FakeTelegram(rng)
+    uploader = ParallelUploader(FakeClient(server, rng), sessions=2, workers_per_session=3,
+                                session_factory=server.session_factory)
+    data = random_file(os.path.join(workdir, "upload.bin"), BIG_FILE_SIZE + 3 * PART_SIZE + 1234, rng)
+    reported = []
+
+    async def progress(current, total):
+        reported.append((current, total))
+
+    file = await uploader.upload(os.path.join(workdir, "upload.bin"), progress)
+    total_parts = math.ceil(len(data) / PART_SIZE)
+    assert file.parts == total_parts, f"InputFileBig says {file.parts} parts, expected {total_parts}"
+    assert server.assemble(file.id, total_parts) == data, "reassembled upload differs from the file"
+    assert len(server.calls) == total_parts, f"{len(server.calls)} SaveBigFilePart calls for {total_parts} parts"
+    assert {total for _, _, total in server.calls} == {total_parts}, "a part carried the wrong total"
+    assert [part for _, part, _ in server.calls] != list(range(total_parts)), "parts never completed out of order"
+    assert reported[-1] == (len(data), len(data)), f"progress ended at {reported[-1]}"
+    assert all(a[0] < b[0] for a, b in zip(reported, reported[1:])), "progress went backwards"
+
+
+async def check_part_missing(workdir, rng):
+    """A part the server lost is re-uploaded alone and SendMedia is retried."""
+    server = FakeTelegram(rng)
+    uploader = ParallelUploader(FakeClient(server, rng), sessions=2, workers_per_session=2,
+                                session_factory=server.session_factory)
+    path = os.path.join(workdir, "missing.mp4")
+    data = random_file(path, BIG_FILE_SIZE + 5 * PART_SIZE, rng)
+    total_parts = math.ceil(len(data) / PART_SIZE)
+    server.lose = {7}
+
+    await uploader.send_video("me", path)
+    file_id = server.calls[0][0]
+    sent = [part for _, part, _ in server.calls]
+    assert server.send_attempts == 2, f"SendMedia tried {server.send_attempts} times, expected 2"
+    assert sent.count(7) == 2, f"lost part sent {sent.count(7)} times"
+    assert len(sent) == total_parts + 1, f"{len(sent) - total_parts} extra parts re-sent, expected only the lost one"
+    assert server.assemble(file_id, total_parts) == data, "file differs after the re-upload"
+
+
+async def check_growing(workdir, rng):
+    """Parts go out with total -1 while the file grows; the part carrying the total is sent last."""
+    server = FakeTelegram(rng)
+    uploader = ParallelUploader(FakeClient(server, rng), sessions=2, workers_per_session=2,
+                                session_factory=server.session_factory)
+    partial = os.path.join(workdir, "grow.partial.mp4")
+    final = os.path.join(workdir, "grow.mp4")
+    data = rng.randbytes(BIG_FILE_SIZE + 6 * PART_SIZE + 777)
+
+    async def writer():
+        # Appends in odd-sized blocks like an encoder, then renames into place like commit_file
+        with open(partial, "wb") as f:
+            for offset in range(0, len(data), 300 * 1024):
+                f.write(data[offset:offset + 300 * 1024])
+                f.flush()
+                await asyncio.sleep(0.005)
+        os.replace(partial, final)
+        return True
+
+    writer_task = asyncio.create_task(writer())
+    file = await uploader.upload_growing(partial, writer_task, final, poll=0.02)
+    total_parts = math.ceil(len(data) / PART_SIZE)
+    assert file is not None, "upload_growing gave up on a big file"
+    assert file.parts == total_parts, f"InputFileBig says {file.parts} parts, expected {total_parts}"
+    assert server.assemble(file.id, total_parts) == data, "reassembled stream differs from the output"
+    streamed = [part for _, part, total in server.calls if total == -1]
+    assert streamed, "nothing was sent while the writer was running"
+    assert server.calls[-1][1:] == (total_parts - 1, total_parts), f"last call was {server.calls[-1][1:]}"
+    assert all(total in (-1, total_parts) for _, _, total in server.calls), "a part carried a wrong total"
+    assert [total for _, _, total in server.calls].count(total_parts) == total_parts - len(streamed), \
+        "parts re-sent after streaming"
+
+    # A result that stays under the big-file threshold is left to a regular upload
+    small = os.path.join(workdir, "small.partial.mp4")
+
+    async def small_writer():
+        with open(small, "wb") as f:
+            f.write(rng.randbytes(PART_SIZE * 3))
+        return True
+
+    assert await uploader.upload_growing(small, asyncio.create_task(small_writer()), poll=0.01) is None, \
+        "a small output was streamed"
+
+
+async def check_download(workdir, rng):
+    """Ranged chunks fetched out of order reassemble into the stored file, short reads retried."""
+    server = FakeTelegram(rng)
+    server.blob = rng.randbytes(BIG_FILE_SIZE + 2 * CHUNK_SIZE + 4321)
+    server.short_reads = {3 * CHUNK_SIZE}
+    downloader = ParallelDownloader(FakeClient(server, rng), sessions=2, workers_per_session=3,
+                                    session_factory=server.session_factory)
+    file_id = FileId(file_type=FileType.DOCUMENT, dc_id=2, media_id=1, access_hash=2, file_reference=b"")
+    media = SimpleNamespace(file_id=file_id.encode(), file_size=len(server.blob))
+    message = SimpleNamespace(video=None, document=media, audio=None, animation=None)
+    reported = []
+
+    async def progress(current, total):
+        reported.append(current)
+
+    path = await downloader.download(message, os.path.join(workdir, "out", "download.mp4"), progress)
+    total_chunks = math.ceil(len(server.blob) / CHUNK_SIZE)
+    with open(path, "rb") as f:
+        assert f.read() == server.blob, "reassembled download differs from the stored file"
+    assert not os.path.exists(f"{path}.temp"), "temp file left behind"
+    offsets = [offset for offset, _ in server.reads]
+    assert sorted(set(offsets)) == [chunk * CHUNK_SIZE for chunk in range(total_chunks)], "a chunk was skipped"
+    assert all(limit == CHUNK_SIZE and offset % CHUNK_SIZE == 0 for offset, limit in server.reads), \
+        "a request was not 1 MB aligned"
+    assert offsets.count(3 * CHUNK_SIZE) == 2, "the short read was not retried"
+    assert len(offsets) == total_chunks + 1, "chunks were fetched more than needed"
+    assert reported[-1] == len(server.blob), f"progress ended at {reported[-1]}"
+
+
+async def check_pool(workdir, rng):
+    """Uploads spread over the least-loaded workers; a worker in FloodWait is benched for its duration."""
+    dump = -100
+    main = StubMainClient()
+    pool = UploadPool([SimpleNamespace(name=f"up{index}") for index in range(3)], StubUploader, dump_channel=dump)
+    by_name = {worker.name: worker for worker in pool.workers}
+
+    # Three at once land on three different workers, and the copies reach the user's chat
+    results = await asyncio.gather(*(pool.send_video(main, 42, f"v{index}") for index in range(3)))
+    assert all(len(worker.uploader.sent) == 1 for worker in pool.workers), \
+        f"concurrent uploads not spread: {[len(w.uploader.sent) for w in pool.workers]}"
+    assert [copy[:2] for copy in main.copies] == [(42, dump)] * 3, f"copies went to {main.copies}"
+    assert all(result.chat.id == 42 for result in results), "a result is not the copy in the user's chat"
+    assert all(worker.active == 0 for worker in pool.workers), "a worker was never released"
+
+    # A busy worker is skipped even though it has uploaded the least
+    by_name["up0"].uploads = by_name["up1"].uploads = 5
+    by_name["up2"].active = 1
+    worker = await pool.acquire()
+    pool.release(worker)
+    by_name["up2"].active = 0
+    assert worker.name in ("up0", "up1"), f"picked {worker.name}, which was busy"
+    by_name["up0"].uploads = by_name["up1"].uploads = 1
+
+    # FloodWait benches the worker and moves the upload; the bench holds until it expires
+    by_name["up0"].uploader.floods = [1]
+    started = time.monotonic()
+    await pool.send_video(main, 42, "flooded")
+    assert pool.stats["floods"] == 1, f"{pool.stats['floods']} floods recorded"
+    assert "flooded" not in by_name["up0"].uploader.sent, "the flooded worker kept the upload"
+    assert sum("flooded" in worker.uploader.sent for worker in pool.workers) == 1, "upload not sent exactly once"
+    assert not by_name["up0"].available, "the flooded worker is not benched"
+    await asyncio.gather(*(pool.send_video(main, 42, f"b{index}") for index in range(4)))
+    assert not any(name.startswith("b") for name in by_name["up0"].uploader.sent), "a benched worker got work"
+
+    # With every worker benched, the pool waits for the first one to come back
+    for worker in pool.workers:
+        worker.flood_until = time.monotonic() + (0.3 if worker.name == "up1" else 60)
+    waited = time.monotonic()
+    await pool.send_video(main, 42, "after_bench")
+    assert "after_bench" in by_name["up1"].uploader.sent, "the upload did not wait for the first worker back"
+    assert 0.25 <= time.monotonic() - waited < 5, f"waited {time.monotonic() - waited:.2f}s for a 0.3s bench"
+    assert time.monotonic() - started < 10, "the pool slept through a FloodWait instead of moving on"
+
+
+CHECKS = {
+    "upload": check_upload,
+    "part_missing": check_part_missing,
+    "growing": check_growing,
+    "download": check_download,
+    "pool": check_pool,
+}
+
+
+async def run_checks(names, seed):
+    failed = 0
+    for name in names:
+        workdir = tempfile.mkdtemp(prefix="transfer_check_")
+        started = time.monotonic()
+        try:
+            await CHECKS[name](workdir, random.Random(seed))
+            print(f"ok    {name} ({time.monotonic() - started:.1f}s)")
+        except Exception as e:
+            failed += 1
+            print(f"FAIL  {name}: {e!r}")
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the transfer engines against fake media sessions")
+    parser.add_argument("checks", nargs="*", help=f"checks to run (default: all of {', '.join(CHECKS)})")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="keep the engines' INFO logs")
+    args = parser.parse_args()
+    unknown = set(args.checks) - set(CHECKS)
+    if unknown:
+        parser.error(f"unknown checks: {', '.join(sorted(unknown))}")
+
+    setup_logging(level="INFO" if args.verbose else "ERROR", fmt="text")
+    sys.exit(1 if asyncio.run(run_checks(args.checks or list(CHECKS), args.seed)) else 0)
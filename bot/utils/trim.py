@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+import re
+from config import TRIM_MAX_RANGES, TRIM_PRESET, TRIM_CRF
+from .subprocesses import run_process
+from .tg_calls import background
+from .workspace import partial_path, commit_file
+
+LOGGER = logging.getLogger(__name__)
+
+# Encoders able to produce boundary segments that splice cleanly into a copied stream of the same codec
+BOUNDARY_ENCODERS = {"h264": "libx264", "hevc": "libx265"}
+H264_PROFILES = {"baseline", "main", "high"}
+# Partial GOPs shorter than this (about a frame) are not worth an encode
+MIN_SEGMENT = 0.01
+# Nudge past the probed keyframe time so a copy seek cannot round down into the previous GOP
+SEEK_NUDGE = 0.0005
+# Intermediate container: MPEG-TS carries parameter sets in-band, so re-encoded and copied GOPs can be spliced
+SEGMENT_FORMAT, SEGMENT_EXT = "mpegts", ".ts"
+
+
+class TrimError(Exception):
+    """A cut could not be made; the message is shown to the user."""
+
+
+def parse_timestamp(text):
+    """Seconds from "90", "1:30" or "1:02:03.5"."""
+    parts = text.strip().split(":")
+    if not 1 <= len(parts) <= 3:
+        raise ValueError(f"Bad timestamp: {text}")
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + float(part)
+    if seconds < 0:
+        raise ValueError(f"Bad timestamp: {text}")
+    return seconds
+
+
+def parse_ranges(text, duration=None):
+    """Parse "1:00-3:00 10:00-12:30" (spaces or commas) into [(start, end)] in seconds.
+
+    Ends past `duration` are clamped to it; raises ValueError on malformed or empty ranges.
+    """
+    ranges = []
+    for token in filter(None, re.split(r"[\s,]+", text.strip())):
+        start, sep, end = token.partition("-")
+        if not sep:
+            raise ValueError(f"Expected start-end, got: {token}")
+        start, end = parse_timestamp(start), parse_timestamp(end)
+        if duration:
+            if start >= duration:
+                raise ValueError(f"{token} starts after the end of the video")
+            end = min(end, duration)
+        if end <= start:
+            raise ValueError(f"{token} is empty")
+        ranges.append((start, end))
+    if not ranges:
+        raise ValueError("No time ranges given")
+    if len(ranges) > TRIM_MAX_RANGES:
+        raise ValueError(f"At most {TRIM_MAX_RANGES} ranges per command")
+    return ranges
+
+
+def format_timestamp(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours}:{minutes:02d}:{seconds:04.1f}" if hours else f"{minutes}:{seconds:04.1f}"
+
+
+async def run_tool(*args):
+    """Run ffmpeg/ffprobe with `args`; returns stdout, raises TrimError with the stderr tail on failure."""
+    returncode, stdout, stderr = await run_process(*args)
+    if returncode != 0:
+        LOGGER.error(f"{args[0]} failed: {stderr.decode(errors='ignore')[-500:]}")
+        raise TrimError(f"{args[0]} failed with exit code {returncode}")
+    return stdout.decode(errors="ignore")
+
+
+async def probe_media(path):
+    """Container start/duration and the first video stream's codec parameters."""
+    output = await run_tool(
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=start_time,duration:stream=codec_type,codec_name,profile,pix_fmt,width,height",
+        "-of", "json", path
+    )
+    info = json.loads(output)
+    video = next((s for s in info.get("streams", []) if s.get("codec_type") == "video"), None)
+    if video is None:
+        raise TrimError("No video stream found")
+    fmt = info.get("format", {})
+    return {
+        "start_time": float(fmt.get("start_time") or 0),
+        "duration": float(fmt.get("duration") or 0),
+        "codec": video.get("codec_name"),
+        "profile": (video.get("profile") or "").lower(),
+        "pix_fmt": video.get("pix_fmt"),
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "has_audio": any(s.get("codec_type") == "audio" for s in info.get("streams", [])),
+    }
+
+
+async def probe_keyframes(path, ranges, start_time=0.0):
+    """Keyframe times (seconds from the start of the file) inside `ranges`.
+
+    Reads packet headers only, and only around the requested ranges, so a clip from a long file
+    does not scan the whole thing.
+    """
+    intervals = ",".join(f"{start + start_time:.3f}%{end + start_time + 1:.3f}" for start, end in ranges)
+    output = await run_tool(
+        "ffprobe", "-v", "error", "-select_streams", "v:0", "-read_intervals", intervals,
+        "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path
+    )
+    keyframes = set()
+    for line in output.splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags and pts not in ("", "N/A"):
+            keyframes.add(round(float(pts) - start_time, 6))
+    return sorted(keyframes)
+
+
+def plan_cut(start, end, keyframes, can_copy=True):
+    """Split [start, end) into ("copy"|"encode", from, to) segments.
+
+    Whole GOPs between the first and last keyframe inside the range are stream-copied; only the
+    partial GOPs before the first and after the last keyframe are re-encoded.
+    """
+    inside = [k for k in keyframes if start <= k <= end]
+    if not can_copy or not inside:
+        return [("encode", start, end)]
+    first, last = inside[0], inside[-1]
+    segments = []
+    if first - start > MIN_SEGMENT:
+        segments.append(("encode", start, first))
+    if last > first:
+        segments.append(("copy", first, last))
+    if end - last > MIN_SEGMENT:
+        segments.append(("encode", last, end))
+    return segments
+
+
+def encoder_args(media, can_copy):
+    """Video encoder arguments for boundary segments, matched to the source so they splice with copied GOPs."""
+    encoder = BOUNDARY_ENCODERS.get(media["codec"]) if can_copy else None
+    args = ["-c:v", encoder or "libx264", "-preset", TRIM_PRESET, "-crf", str(TRIM_CRF)]
+    if media["pix_fmt"]:
+        args += ["-pix_fmt", media["pix_fmt"] if encoder else "yuv420p"]
+    if encoder == "libx264" and media["profile"] in H264_PROFILES:
+        args += ["-profile:v", media["profile"]]
+    return args
+
+
+async def cut_range(input_path, start, end, keyframes, media, workdir, index):
+    """Cut one range into an intermediate clip (video smart cut + AAC audio); returns (path, copied, encoded)."""
+    can_copy = media["codec"] in BOUNDARY_ENCODERS
+    segments = plan_cut(start, end, keyframes, can_copy)
+    video_args = encoder_args(media, can_copy)
+    list_path = os.path.join(workdir, f"clip{index}.txt")
+    copied = encoded = 0.0
+
+    with open(list_path, "w") as listing:
+        for number, (mode, seg_start, seg_end) in enumerate(segments):
+            seg_path = os.path.join(workdir, f"clip{index}_{number}{SEGMENT_EXT}")
+            if mode == "copy":
+                # Stop just short of the closing keyframe, which starts the tail segment
+                seek, length, codec = seg_start + SEEK_NUDGE, seg_end - seg_start - 2 * SEEK_NUDGE, ["-c:v", "copy"]
+                copied += seg_end - seg_start
+            else:
+                seek, length, codec = seg_start, seg_end - seg_start, video_args
+                encoded += seg_end - seg_start
+            await run_tool(
+                "ffmpeg", "-y", "-v", "error", "-ss", f"{seek:.6f}", "-i", input_path,
+                "-t", f"{length:.6f}", "-map", "0:v:0", "-an", "-sn", *codec,
+                "-f", SEGMENT_FORMAT, seg_path
+            )
+            listing.write(f"file '{seg_path}'\n")
+
+    clip_path = os.path.join(workdir, f"clip{index}{SEGMENT_EXT}")
+    audio = (
+        ["-ss", f"{start:.6f}", "-t", f"{end - start:.6f}", "-i", input_path,
+         "-map", "1:a:0", "-c:a", "aac", "-b:a", "192k"]
+        if media["has_audio"] else []
+    )
+    await run_tool(
+        "ffmpeg", "-y", "-v", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+        *audio, "-map", "0:v:0", "-c:v", "copy", "-f", SEGMENT_FORMAT, clip_path
+    )
+    return clip_path, copied, encoded
+
+
+async def join_clips(clips, output_path, media, workdir, name="join"):
+    """Concatenate intermediate clips into a faststart MP4 at `output_path` without re-encoding."""
+    list_path = os.path.join(workdir, f"{name}.txt")
+    with open(list_path, "w") as listing:
+        listing.writelines(f"file '{clip}'\n" for clip in clips)
+    tag = ["-tag:v", "hvc1"] if media["codec"] == "hevc" else []
+    partial_output = partial_path(output_path)
+    try:
+        await run_tool(
+            "ffmpeg", "-y", "-v", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+            "-map", "0", "-c", "copy", *tag, "-movflags", "+faststart", partial_output
+        )
+        return commit_file(partial_output, output_path)
+    finally:
+        if os.path.exists(partial_output):
+            os.remove(partial_output)
+
+
+async def smart_trim(input_path, ranges, output_paths, workdir, media=None, status_msg=None):
+    """Cut `ranges` out of `input_path` with keyframe-aware stream copy.
+
+    `output_paths` holds one path to join every range into a single video (/trim), or one path per
+    range (/clip). Returns a summary dict with the seconds copied and re-encoded.
+    """
+    media = media or await probe_media(input_path)
+    keyframes = await probe_keyframes(input_path, ranges, media["start_time"])
+    clips = []
+    copied = encoded = 0.0
+    for index, (start, end) in enumerate(ranges):
+        if status_msg is not None:
+            await background(status_msg.edit_text(
+                f"✂️ Cutting {format_timestamp(start)}-{format_timestamp(end)} ({index + 1}/{len(ranges)})..."
+            ))
+        clip, clip_copied, clip_encoded = await cut_range(input_path, start, end, keyframes, media, workdir, index)
+        clips.append(clip)
+        copied += clip_copied
+        encoded += clip_encoded
+
+    if len(output_paths) == 1:
+        await join_clips(clips, output_paths[0], media, workdir)
+    else:
+        for index, (clip, output_path) in enumerate(zip(clips, output_paths)):
+            await join_clips([clip], output_path, media, workdir, name=f"join{index}")
+    return {"copied": copied, "encoded": encoded, "keyframes": len(keyframes), "media": media}
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+from pyrogram.errors import FloodWait
+from config import API_ID, API_HASH, DUMP_CHANNEL, UPLOADER_TOKENS
+from .tg_transfer import ParallelUploader
+
+LOGGER = logging.getLogger(__name__)
+
+
+class UploadWorker:
+    """One extra bot account that only uploads into DUMP_CHANNEL."""
+
+    def __init__(self, name, client, uploader):
+        self.name = name
+        self.client = client
+        self.uploader = uploader
+        self.active = 0
+        self.flood_until = 0.0
+        self.uploads = 0
+
+    @property
+    def available(self):
+        return time.monotonic() >= self.flood_until
+
+
+class UploadPool:
+    """Spreads uploads over extra bot tokens; the main bot re-sends the result by file reference.
+
+    A worker uploads the file into DUMP_CHANNEL, then the main client copies that message to
+    the user's chat. Work goes to the least-loaded worker that is not in FloodWait; a worker that
+    hits FloodWait is benched for its duration and the upload moves to another one.
+    `uploader_factory(client)` can be swapped for tests, together with stub clients.
+    """
+
+    def __init__(self, clients, uploader_factory=None, dump_channel=DUMP_CHANNEL):
+        uploader_factory = uploader_factory or (lambda client: ParallelUploader(client, sleep_on_flood=False))
+        self.workers = [
+            UploadWorker(getattr(client, "name", f"uploader_{index}"), client, uploader_factory(client))
+            for index, client in enumerate(clients)
+        ]
+        self.dump_channel = dump_channel
+        self.stats = {"uploads": 0, "floods": 0, "flood_seconds": 0}
+
+    @classmethod
+    def from_tokens(cls, tokens=UPLOADER_TOKENS):
+        """Build a pool of pyrogram clients for `tokens`, or None when no extra tokens are configured."""
+        if not tokens:
+            return None
+        from pyrogram import Client
+
+        clients = [
+            Client(
+                f"uploader_{token.split(':')[0]}",
+                api_id=API_ID,
+                api_hash=API_HASH,
+                bot_token=token,
+                no_updates=True,
+                # FloodWait must reach the pool so it can move the upload, not be slept through
+                sleep_threshold=0
+            )
+            for token in tokens
+        ]
+        return cls(clients)
+
+    async def start(self):
+        for worker in self.workers:
+            await worker.client.start()
+        LOGGER.info(f"Started {len(self.workers)} upload workers")
+
+    async def stop(self):
+        for worker in self.workers:
+            try:
+                await worker.client.stop()
+            except Exception as e:
+                LOGGER.error(f"Failed to stop upload worker {worker.name}: {e}")
+
+    async def acquire(self):
+        """The least-loaded worker not in FloodWait; waits for the first one to come back if all are benched."""
+        while True:
+            available = [worker for worker in self.workers if worker.available]
+            if available:
+                worker = min(available, key=lambda w: (w.active, w.uploads))
+                worker.active += 1
+                return worker
+            wait = min(worker.flood_until for worker in self.workers) - time.monotonic()
+            LOGGER.warning(f"All upload workers are in FloodWait, waiting {wait:.0f}s")
+            await asyncio.sleep(max(wait, 0))
+
+    def release(self, worker):
+        worker.active -= 1
+
+    async def _upload(self, send):
+        """Run `send(worker)` on the best worker, moving to another one on FloodWait."""
+        while True:
+            worker = await self.acquire()
+            try:
+                message = await send(worker)
+            except FloodWait as e:
+                worker.flood_until = time.monotonic() + e.value
+                self.stats["floods"] += 1
+                self.stats["flood_seconds"] += e.value
+                LOGGER.warning(f"Upload worker {worker.name} in FloodWait for {e.value}s, benched")
+                continue
+            finally:
+                self.release(worker)
+            worker.uploads += 1
+            self.stats["uploads"] += 1
+            return message
+
+    async def _deliver(self, main_client, chat_id, dump_message, caption, reply_to_message_id):
+        if chat_id == self.dump_channel or dump_message is None:
+            return dump_message
+        return await main_client.copy_message(
+            chat_id,
+            self.dump_channel,
+            dump_message.id,
+            caption=caption,
+            reply_to_message_id=reply_to_message_id
+        )
+
+    async def send_video(self, main_client, chat_id, video, caption="", reply_to_message_id=None, **kwargs):
+        """Like ParallelUploader.send_video; the upload lands in DUMP_CHANNEL and is copied to `chat_id`."""
+        dump_message = await self._upload(
+            lambda worker: worker.uploader.send_video(self.dump_channel, video, caption=caption, **kwargs)
+        )
+        return await self._deliver(main_client, chat_id, dump_message, caption, reply_to_message_id)
+
+    async def send_audio(self, main_client, chat_id, audio, caption="", reply_to_message_id=None, **kwargs):
+        dump_message = await self._upload(
+            lambda worker: worker.uploader.send_audio(self.dump_channel, audio, caption=caption, **kwargs)
+        )
+        return await self._deliver(main_client, chat_id, dump_message, caption, reply_to_message_id)
+
+    async def send_document(self, main_client, chat_id, document, caption="", reply_to_message_id=None, **kwargs):
+        dump_message = await self._upload(
+            lambda worker: worker.uploader.send_document(self.dump_channel, document, caption=caption, **kwargs)
+        )
+        return await self._deliver(main_client, chat_id, dump_message, caption, reply_to_message_id)
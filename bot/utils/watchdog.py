@@ -0,0 +1,136 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from config import LOOP_WATCHDOG_INTERVAL, LOOP_STALL_THRESHOLD
+from .tracing import percentile
+
+LOGGER = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+TOP_OFFENDERS = 5
+STACK_DEPTH = 8
+
+
+class LoopWatchdog:
+    """Measures event loop lag and names whatever blocks the loop.
+
+    A heartbeat task sleeps `interval` and records how late it wakes up. A daemon thread checks the
+    heartbeat and, once it is `threshold` overdue, samples the loop thread's stack while the stall
+    is still in progress. When the loop recovers, the stall is charged to the innermost frame of
+    our own code in that stack, so the worst offenders can be listed.
+    """
+
+    def __init__(self, interval=LOOP_WATCHDOG_INTERVAL, threshold=LOOP_STALL_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = collections.deque(maxlen=3000)
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.last_stall = None
+        self.offenders = {}
+        self.last_beat = None
+        self._loop_thread = None
+        self._pending = None
+        self._task = None
+        self._stop = threading.Event()
+        # report() runs on the health server thread while _record() mutates the stats on the loop
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start watching the running loop; call from inside it."""
+        if self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        LOGGER.info(f"Loop watchdog started (stall threshold {self.threshold * 1000:.0f}ms)")
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_beat = now
+            self._record(max(0.0, now - before - self.interval))
+
+    def _record(self, lag):
+        pending, self._pending = self._pending, None
+        with self._lock:
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag < self.threshold:
+                return
+            self.stalls += 1
+            self.last_stall = time.time()
+            where, stack = pending or ("unsampled (ended before the watchdog looked)", [])
+            entry = self.offenders.setdefault(where, {"count": 0, "total": 0.0, "worst": 0.0, "stack": stack})
+            entry["count"] += 1
+            entry["total"] += lag
+            if lag >= entry["worst"]:
+                entry["worst"] = lag
+                entry["stack"] = stack or entry["stack"]
+        LOGGER.warning(f"Event loop blocked for {lag * 1000:.0f}ms in {where}\n{''.join(stack)}")
+
+    def _watch(self):
+        while not self._stop.wait(min(self.interval, self.threshold) / 2):
+            overdue = time.monotonic() - self.last_beat - self.interval
+            if self._pending is None and overdue >= self.threshold:
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    self._pending = self.describe(frame)
+
+    @staticmethod
+    def describe(frame):
+        """(where, formatted stack) for a frame; `where` is the innermost frame in this project."""
+        stack = traceback.extract_stack(frame)
+        own = [
+            entry for entry in stack
+            if entry.filename.startswith(PROJECT_ROOT) and "site-packages" not in entry.filename
+        ]
+        culprit = (own or stack)[-1]
+        where = f"{os.path.relpath(culprit.filename, PROJECT_ROOT)}:{culprit.lineno} in {culprit.name}"
+        if stack[-1] is not culprit:
+            where += f" -> {os.path.basename(stack[-1].filename)}:{stack[-1].lineno} in {stack[-1].name}"
+        return where, traceback.format_list(stack[-STACK_DEPTH:])
+
+    def report(self) -> dict:
+        with self._lock:
+            lags = list(self.lags)
+            offenders = [(where, dict(entry)) for where, entry in self.offenders.items()]
+            max_lag, stalls, last_stall = self.max_lag, self.stalls, self.last_stall
+        worst = sorted(offenders, key=lambda item: item[1]["total"], reverse=True)[:TOP_OFFENDERS]
+        return {
+            "lag_ms": {
+                "p50": percentile(lags, 0.5) * 1000 if lags else 0,
+                "p99": percentile(lags, 0.99) * 1000 if lags else 0,
+                "max": max_lag * 1000,
+            },
+            "threshold_ms": self.threshold * 1000,
+            "stalls": stalls,
+            "last_stall": last_stall,
+            "offenders": [
+                {
+                    "where": where,
+                    "count": entry["count"],
+                    "total_ms": entry["total"] * 1000,
+                    "worst_ms": entry["worst"] * 1000,
+                    "stack": [line.strip() for line in entry["stack"]],
+                }
+                for where, entry in worst
+            ],
+        }
+
+
+watchdog = LoopWatchdog()
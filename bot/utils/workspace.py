@@ -0,0 +1,80 @@
+import logging
+import os
+import shutil
+import tempfile
+from config import DOWNLOADS_DIR, WORKSPACE_TMPFS_DIR, WORKSPACE_TMPFS_MAX_JOB
+
+LOGGER = logging.getLogger(__name__)
+
+WORKSPACES_DIR = os.path.join(DOWNLOADS_DIR, "jobs")
+TMPFS_WORKSPACES_DIR = os.path.join(WORKSPACE_TMPFS_DIR, "video_bot_jobs") if WORKSPACE_TMPFS_DIR else None
+# Room left for the encode output and thumbnails next to the input when sizing tmpfs jobs
+TMPFS_HEADROOM = 2.2
+
+
+class Workspace:
+    """A private scratch directory for one job, removed on completion or cancel.
+
+    Jobs whose expected size fits WORKSPACE_TMPFS_MAX_JOB (and the free space left on the tmpfs
+    after other live tmpfs workspaces) keep their intermediate files in RAM.
+    """
+
+    # Bytes promised to live tmpfs workspaces, so concurrent jobs do not overcommit it
+    tmpfs_reserved = 0
+
+    def __init__(self, prefix="job", size_hint=0):
+        self.reserved = 0
+        base = WORKSPACES_DIR
+        if self._fits_tmpfs(size_hint):
+            base = TMPFS_WORKSPACES_DIR
+            self.reserved = int(size_hint * TMPFS_HEADROOM)
+            Workspace.tmpfs_reserved += self.reserved
+        os.makedirs(base, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=f"{prefix}_", dir=base)
+        self.in_memory = base == TMPFS_WORKSPACES_DIR
+        LOGGER.info(f"Workspace {self.path} ({'tmpfs' if self.in_memory else 'disk'})")
+
+    @staticmethod
+    def _fits_tmpfs(size_hint):
+        if not WORKSPACE_TMPFS_DIR or not size_hint or size_hint > WORKSPACE_TMPFS_MAX_JOB:
+            return False
+        try:
+            free = shutil.disk_usage(WORKSPACE_TMPFS_DIR).free
+        except OSError:
+            return False
+        return size_hint * TMPFS_HEADROOM <= free - Workspace.tmpfs_reserved
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        if self.reserved:
+            Workspace.tmpfs_reserved -= self.reserved
+            self.reserved = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cleanup()
+
+
+def purge_workspaces():
+    """Remove workspaces left behind by a previous process (crash or kill); call before taking jobs."""
+    for base in (WORKSPACES_DIR, TMPFS_WORKSPACES_DIR):
+        if base and os.path.isdir(base):
+            for name in os.listdir(base):
+                shutil.rmtree(os.path.join(base, name), ignore_errors=True)
+
+
+def partial_path(path):
+    """Sibling path to write to before moving into place; keeps the extension so tools infer the format."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.partial{ext}"
+
+
+def commit_file(partial, path):
+    """Atomically move a finished file into place (same directory, so a rename)."""
+    os.replace(partial, path)
+    return path
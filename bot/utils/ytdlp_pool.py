@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import YTDLP_POOL_SIZE, YTDLP_WORKER_MAX_JOBS
+
+LOGGER = logging.getLogger(__name__)
+
+# Only these progress fields cross the process boundary
+PROGRESS_KEYS = (
+    'status', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate',
+    'speed', 'elapsed', 'eta', 'filename',
+)
+WARM_OPTS = {'quiet': True, 'no_warnings': True}
+
+
+class WorkerCrashed(Exception):
+    """The worker process died while running a job."""
+
+
+class YtdlpError(Exception):
+    """yt-dlp raised inside the worker; carries the original message."""
+
+
+def _worker_main(conn):
+    """Worker loop: keeps YoutubeDL instances warm and serves jobs sent over `conn`.
+
+    Only extraction reuses a warm instance. A download gets a fresh YoutubeDL per job, since its
+    output template and hooks differ every time; it still skips importing yt-dlp and loading
+    the extractors, which the worker did once at start.
+    """
+    import yt_dlp
+
+    warm = {}
+
+    def get_ydl(opts):
+        # Extraction options rarely vary, so instances are kept per option set
+        key = repr(sorted(opts.items()))
+        if key not in warm:
+            warm[key] = yt_dlp.YoutubeDL(opts)
+        return warm[key]
+
+    get_ydl(WARM_OPTS).get_info_extractor('Youtube')
+
+    def progress_hook(d):
+        conn.send(("progress", {key: d.get(key) for key in PROGRESS_KEYS}))
+        # Wait for the parent to acknowledge so its hook can pace (bandwidth shaping) this download
+        conn.recv()
+
+    while True:
+        try:
+            kind, url, opts = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        try:
+            if kind == "extract":
+                ydl = get_ydl(opts)
+                result = ydl.sanitize_info(ydl.extract_info(url, download=False))
+            elif kind == "download":
+                with yt_dlp.YoutubeDL({**opts, 'progress_hooks': [progress_hook]}) as ydl:
+                    ydl.download([url])
+                result = None
+            else:
+                raise ValueError(f"Unknown job kind: {kind}")
+            conn.send(("result", result))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+
+class YtdlpWorker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    def run_job(self, kind, url, opts, progress_hook=None):
+        """Blocking: send one job and relay its progress until the result arrives."""
+        self.jobs += 1
+        try:
+            self.conn.send((kind, url, opts))
+            while True:
+                tag, payload = self.conn.recv()
+                if tag == "progress":
+                    if progress_hook:
+                        try:
+                            progress_hook(payload)
+                        except Exception as e:
+                            LOGGER.error(f"Progress hook error: {e}")
+                    self.conn.send(("ack",))
+                elif tag == "result":
+                    return payload
+                else:
+                    raise YtdlpError(payload)
+        except (EOFError, OSError) as e:
+            raise WorkerCrashed(f"yt-dlp worker {self.process.pid} died: {e}") from e
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class YtdlpPool:
+    """Long-lived yt-dlp worker processes, so extraction neither re-initializes nor holds the GIL.
+
+    Downloads run in the workers too, off the GIL, but on a fresh YoutubeDL each (see _worker_main).
+    """
+
+    def __init__(self, size: int = YTDLP_POOL_SIZE, max_jobs: int = YTDLP_WORKER_MAX_JOBS):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.ctx = multiprocessing.get_context("spawn")
+        # One thread per in-flight job waits on the worker's pipe; it never parses anything itself
+        self.io_executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="ytdlp-ipc")
+        self.stats = {"jobs": 0, "crashes": 0, "recycled": 0}
+        self._idle = None
+        # Replacements spawned from cancelled jobs; held so they are not collected mid-run
+        self._respawns = set()
+
+    async def start(self):
+        if self._idle is not None:
+            return
+        self._idle = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        for _ in range(self.size):
+            self._idle.put_nowait(await loop.run_in_executor(self.io_executor, YtdlpWorker, self.ctx))
+        LOGGER.info(f"Started {self.size} yt-dlp workers")
+
+    async def _replace(self, worker):
+        worker.stop()
+        loop = asyncio.get_running_loop()
+        self._idle.put_nowait(await loop.run_in_executor(self.io_executor, YtdlpWorker, self.ctx))
+
+    def _respawned(self, task):
+        self._respawns.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            LOGGER.error(f"Failed to replace a cancelled yt-dlp worker: {task.exception()}")
+
+    async def _release(self, worker):
+        if worker.jobs >= self.max_jobs:
+            self.stats["recycled"] += 1
+            await self._replace(worker)
+        else:
+            self._idle.put_nowait(worker)
+
+    async def _run(self, kind, url, opts, progress_hook=None):
+        await self.start()
+        loop = asyncio.get_running_loop()
+        for attempt in (1, 2):
+            worker = await self._idle.get()
+            try:
+                result = await loop.run_in_executor(
+                    self.io_executor, worker.run_job, kind, url, opts, progress_hook
+                )
+            except WorkerCrashed as e:
+                self.stats["crashes"] += 1
+                LOGGER.error(f"{e}; restarting worker (attempt {attempt})")
+                await self._replace(worker)
+                if attempt == 2:
+                    raise
+                continue
+            except asyncio.CancelledError:
+                # Killing the worker is the only way to stop a job mid-flight; its successor
+                # is spawned on io_executor like any other, not on the event loop
+                worker.stop()
+                respawn = asyncio.ensure_future(self._replace(worker))
+                self._respawns.add(respawn)
+                respawn.add_done_callback(self._respawned)
+                raise
+            except BaseException:
+                await self._release(worker)
+                raise
+            self.stats["jobs"] += 1
+            await self._release(worker)
+            return result
+
+    async def extract_info(self, url, opts):
+        """Equivalent of YoutubeDL(opts).extract_info(url, download=False), sanitized."""
+        return await self._run("extract", url, opts)
+
+    async def download(self, url, opts, progress_hook=None):
+        """Download `url`; `progress_hook` is called from a thread, like a yt-dlp hook."""
+        opts = {key: value for key, value in opts.items() if key != 'progress_hooks'}
+        return await self._run("download", url, opts, progress_hook)
+
+    def close(self):
+        while self._idle is not None and not self._idle.empty():
+            self._idle.get_nowait().stop()
+        self.io_executor.shutdown(wait=False)
+
+
+_pool = None
+
+
+def get_ytdlp_pool():
+    """The process-wide pool, created on first use."""
+    global _pool
+    if _pool is None:
+        _pool = YtdlpPool()
+    return _pool
+
+
+def _summary(samples):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return f"mean {statistics.mean(samples):.3f}s  p50 {statistics.median(samples):.3f}s  p95 {p95:.3f}s"
+
+
+async def benchmark(urls, rounds=3):
+    """Compare extraction latency of the thread executor path against the warm worker pool."""
+    import yt_dlp
+
+    opts = {'quiet': True, 'no_warnings': True, 'extract_flat': True}
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=4)
+
+    def extract_fresh(url):
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            return ydl.extract_info(url, download=False)
+
+    thread_samples = []
+    pool_samples = []
+    pool = YtdlpPool()
+    await pool.start()
+    for _ in range(rounds):
+        for url in urls:
+            start = time.perf_counter()
+            await loop.run_in_executor(executor, extract_fresh, url)
+            thread_samples.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await pool.extract_info(url, opts)
+            pool_samples.append(time.perf_counter() - start)
+    pool.close()
+
+    print(f"thread executor: {_summary(thread_samples)}")
+    print(f"worker pool:     {_summary(pool_samples)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark yt-dlp extraction latency")
+    parser.add_argument("urls", nargs="+")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(benchmark(args.urls, args.rounds))
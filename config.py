@@ -24,3 +24,128 @@ COOKIES_PATH = 'cookies.json'
 FFMPEG_LOCATION = '/usr/bin/ffmpeg'  # Replace with your actual FFmpeg path
 # config.py
 AUTH_USERS = [1908235162]  # Replace with your authorized user IDs
+
+# Bandwidth shaping in bytes per second (0 = unlimited)
+BANDWIDTH_UP = int(os.getenv('BANDWIDTH_UP', '0'))
+BANDWIDTH_DOWN = int(os.getenv('BANDWIDTH_DOWN', '0'))
+# Per-user weights as "user_id:weight,user_id:weight"; everyone else gets 1
+BANDWIDTH_USER_WEIGHTS = {
+    int(user_id): float(weight)
+    for user_id, weight in (item.split(':') for item in os.getenv('BANDWIDTH_USER_WEIGHTS', '').split(',') if item)
+}
+# Share multiplier for transfers that are almost done
+BANDWIDTH_FINISH_BOOST = float(os.getenv('BANDWIDTH_FINISH_BOOST', '2'))
+
+# Playlist / multi-URL batch mode for /yl and /ylc
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '2'))
+BATCH_RETRIES = int(os.getenv('BATCH_RETRIES', '2'))
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '50'))
+BATCH_DEFAULT_HEIGHT = int(os.getenv('BATCH_DEFAULT_HEIGHT', '720'))
+# Upper bound on files a single batch /add will fetch
+ADD_BATCH_MAX_FILES = int(os.getenv('ADD_BATCH_MAX_FILES', '20'))
+
+# Format keyboard sessions: seconds a keyboard stays valid and how many are kept
+SESSION_TTL = int(os.getenv('SESSION_TTL', '1800'))
+SESSION_MAX_SIZE = int(os.getenv('SESSION_MAX_SIZE', '500'))
+
+# Warm yt-dlp worker processes (0 = use the thread executor) and jobs per worker before recycling
+YTDLP_POOL_SIZE = int(os.getenv('YTDLP_POOL_SIZE', '2'))
+YTDLP_WORKER_MAX_JOBS = int(os.getenv('YTDLP_WORKER_MAX_JOBS', '50'))
+
+# Sample-encode preflight before long compressions (skipped for stream copy)
+PREFLIGHT_ENABLED = os.getenv('PREFLIGHT_ENABLED', 'true').lower() == 'true'
+PREFLIGHT_MIN_DURATION = int(os.getenv('PREFLIGHT_MIN_DURATION', '300'))
+PREFLIGHT_SAMPLES = int(os.getenv('PREFLIGHT_SAMPLES', '3'))
+PREFLIGHT_SAMPLE_SECONDS = int(os.getenv('PREFLIGHT_SAMPLE_SECONDS', '5'))
+PREFLIGHT_TIMEOUT = int(os.getenv('PREFLIGHT_TIMEOUT', '120'))
+
+# Block size for ordered ranged streaming into FFmpeg (/lc)
+STREAM_BLOCK_SIZE = int(os.getenv('STREAM_BLOCK_SIZE', str(4 * 1024 * 1024)))
+
+# Parallel Telegram transfers: media sessions, concurrent parts per session and retries per part
+UPLOAD_SESSIONS = int(os.getenv('UPLOAD_SESSIONS', '4'))
+UPLOAD_WORKERS_PER_SESSION = int(os.getenv('UPLOAD_WORKERS_PER_SESSION', '2'))
+DOWNLOAD_SESSIONS = int(os.getenv('DOWNLOAD_SESSIONS', '4'))
+DOWNLOAD_WORKERS_PER_SESSION = int(os.getenv('DOWNLOAD_WORKERS_PER_SESSION', '2'))
+TRANSFER_PART_RETRIES = int(os.getenv('TRANSFER_PART_RETRIES', '3'))
+
+# Per-user admission control (AUTH_USERS are exempt); 0 disables a limit
+MAX_JOBS_PER_USER = int(os.getenv('MAX_JOBS_PER_USER', '2'))
+DAILY_BYTES_PER_USER = int(os.getenv('DAILY_BYTES_PER_USER', str(20 * 1024 ** 3)))
+MAX_INPUT_SIZE = int(os.getenv('MAX_INPUT_SIZE', str(4 * 1024 ** 3)))
+
+# Days of job stage traces covered by /stats
+STATS_WINDOW_DAYS = int(os.getenv('STATS_WINDOW_DAYS', '7'))
+
+# Per-job workspaces: optional tmpfs mount (e.g. /dev/shm) for jobs up to WORKSPACE_TMPFS_MAX_JOB bytes
+WORKSPACE_TMPFS_DIR = os.getenv('WORKSPACE_TMPFS_DIR', '')
+WORKSPACE_TMPFS_MAX_JOB = int(os.getenv('WORKSPACE_TMPFS_MAX_JOB', str(512 * 1024 * 1024)))
+
+# Extra bot tokens used only as upload workers (comma separated); they must be admins of DUMP_CHANNEL
+UPLOADER_TOKENS = [token.strip() for token in os.getenv('UPLOADER_TOKENS', '').split(',') if token.strip()]
+
+# Telegram call scheduling: concurrent requests on the main bot and retries for idempotent ones
+TG_CALL_CONCURRENCY = int(os.getenv('TG_CALL_CONCURRENCY', '8'))
+TG_CALL_RETRIES = int(os.getenv('TG_CALL_RETRIES', '3'))
+
+# /trim and /clip: ranges per command, and x264/x265 settings for the re-encoded partial GOPs at cut points
+TRIM_MAX_RANGES = int(os.getenv('TRIM_MAX_RANGES', '10'))
+TRIM_PRESET = os.getenv('TRIM_PRESET', 'veryfast')
+TRIM_CRF = int(os.getenv('TRIM_CRF', '18'))
+
+# /ladder renditions as height:video bitrate, all encoded from one decode of the input
+def _parse_ladder_rungs(spec):
+    """(height, kbit/s) pairs from LADDER_RUNGS; bitrates take ffmpeg forms like 4500k, 4M or 4500000."""
+    rungs = []
+    for rung in filter(None, (entry.strip() for entry in spec.split(','))):
+        height, _, bitrate = rung.partition(':')
+        scale = {'k': 1, 'm': 1000}.get(bitrate[-1:].lower())
+        try:
+            kbps = int(float(bitrate[:-1]) * scale if scale else float(bitrate) / 1000)
+        except (ValueError, OverflowError):
+            kbps = 0
+        if not height.isdigit() or int(height) < 1 or kbps < 1:
+            raise ValueError(f"Invalid LADDER_RUNGS entry {rung!r}: expected height:bitrate like 720:2500k")
+        rungs.append((int(height), kbps))
+    return rungs
+
+LADDER_RUNGS = _parse_ladder_rungs(os.getenv('LADDER_RUNGS', '1080:4500k,720:2500k,480:1000k'))
+LADDER_PRESET = os.getenv('LADDER_PRESET', 'veryfast')
+
+# Event loop watchdog: heartbeat interval and the lag (seconds) reported as a stall with the blocking stack
+LOOP_WATCHDOG_INTERVAL = float(os.getenv('LOOP_WATCHDOG_INTERVAL', '0.1'))
+LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', '0.5'))
+
+# Speculative prefetch while a /yl or /ylc format keyboard is open (off by default)
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', 'false').lower() == 'true'
+PREFETCH_MAX_ACTIVE = int(os.getenv('PREFETCH_MAX_ACTIVE', '2'))
+PREFETCH_BANDWIDTH = int(os.getenv('PREFETCH_BANDWIDTH', str(2 * 1024 * 1024)))
+PREFETCH_DISK_BUDGET = int(os.getenv('PREFETCH_DISK_BUDGET', str(2 * 1024 ** 3)))
+PREFETCH_TTL = int(os.getenv('PREFETCH_TTL', '600'))
+
+# Progressive upload: encode to fragmented MP4 and upload finished parts while FFmpeg runs (main bot only)
+PROGRESSIVE_UPLOAD = os.getenv('PROGRESSIVE_UPLOAD', 'false').lower() == 'true'
+PROGRESSIVE_POLL_INTERVAL = float(os.getenv('PROGRESSIVE_POLL_INTERVAL', '1'))
+
+# Logging: level, "json" or "text" lines, queue size before records are dropped, and per-logger
+# sampling of INFO/DEBUG records as "logger=N,..." (keep 1 in N)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_SAMPLE = os.getenv('LOG_SAMPLE', 'pyrogram.session.session=20,pyrogram.connection.connection=20')
+
+# Encoder calibration (/calibrate): synthetic clip length, the encoders/presets/thread counts to measure
+# (empty threads = 0 (auto) plus powers of two up to the CPU count) and the CRF every run uses
+CALIBRATION_SECONDS = int(os.getenv('CALIBRATION_SECONDS', '5'))
+CALIBRATION_ENCODERS = os.getenv('CALIBRATION_ENCODERS', 'libx264,libx265').split(',')
+CALIBRATION_PRESETS = os.getenv(
+    'CALIBRATION_PRESETS', 'ultrafast,superfast,veryfast,faster,fast,medium,slow'
+).split(',')
+CALIBRATION_THREADS = [int(t) for t in os.getenv('CALIBRATION_THREADS', '').split(',') if t.strip()]
+CALIBRATION_CRF = int(os.getenv('CALIBRATION_CRF', '23'))
+# What "-preset auto" aims for when the FFmpeg code does not say: "speed=<x realtime>" or "ssim=<0..1>"
+PRESET_AUTO_TARGET = os.getenv('PRESET_AUTO_TARGET', 'speed=1.0')
+PRESET_AUTO_FALLBACK = os.getenv('PRESET_AUTO_FALLBACK', 'medium')
+
+# Audio mode (/ya): bitrate of the AAC transcode for codecs Telegram cannot play as-is (opus, vorbis)
+AUDIO_BITRATE = os.getenv('AUDIO_BITRATE', '128k')
@@ -1,23 +1,34 @@
+from bot.utils.startup import profiler
+profiler.install()
+
 import logging
 import os
 import asyncio
 from bot.client import Bot
+from bot.utils.watchdog import watchdog
+from bot.utils.logs import setup_logging, pipeline
 from config import DOWNLOADS_DIR
-from flask import Flask, jsonify
 
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO  # Change to DEBUG for detailed logging
-)
+# Configure logging: one queue, one writer thread (LOG_LEVEL / LOG_FORMAT in config)
+setup_logging()
+
+profiler.mark("imports")
+
+def run_health_server():
+    """Serve the health check endpoint; Flask is imported here so it stays off the bot's startup path."""
+    from flask import Flask, jsonify
+
+    # Flask app for health check
+    app = Flask(__name__)
 
-# Flask app for health check
-app = Flask(__name__)
+    @app.route('/health', methods=['GET'])
+    def health_check():
+        """Health check endpoint; includes event loop lag, the worst recent blockers and logging cost"""
+        return jsonify({
+            "status": "ok", "message": "Bot is running", "loop": watchdog.report(), "logging": pipeline.report()
+        }), 200
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Health check endpoint"""
-    return jsonify({"status": "ok", "message": "Bot is running"}), 200
+    app.run(host='0.0.0.0', port=8000)
 
 async def main():
     # Create downloads directory if it doesn't exist
@@ -26,10 +37,12 @@ async def main():
 
     # Start bot
     bot = Bot()
+    profiler.mark("bot_init")
 
     # Initialize the database
     await bot.db.initialize()
     logging.info("Database initialized.")
+    profiler.mark("db_init")
 
     await bot.run()  # Ensure this calls the correct run method of the bot
 
@@ -37,7 +50,7 @@ if __name__ == '__main__':
     try:
         # Start Flask in a separate thread
         from threading import Thread
-        flask_thread = Thread(target=lambda: app.run(host='0.0.0.0', port=8000))
+        flask_thread = Thread(target=run_health_server)
         flask_thread.daemon = True
         flask_thread.start()
 